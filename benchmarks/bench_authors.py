@@ -0,0 +1,63 @@
+"""Per-candidate featurization latency as papers get more authors.
+
+Every paper gets its author list replaced by n authors drawn from all of the
+authors in the file, for each n in --n-authors. "per paper" calls
+`make_paper_features` once per paper and "batch" calls `make_papers_features`
+once for all of them, which is what `S2Ranker.score` does.
+
+    python benchmarks/bench_authors.py --data-dir s2search/ --papers papers.jsonl --query 'wang neural networks'
+"""
+import argparse
+import random
+import time
+import numpy as np
+from common import load_papers
+from s2search.rank import S2Ranker
+from s2search.features import CompiledQuery, make_paper_features, make_papers_features
+
+
+def time_per_candidate(fn, papers, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(papers)
+        best = min(best, time.perf_counter() - start)
+    return best / len(papers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--papers', required=True, help='a JSON list or a JSONL file of papers')
+    parser.add_argument('--query', default='wang neural networks')
+    parser.add_argument('--n-authors', type=int, nargs='+', default=[5, 50, 500])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    ranker = S2Ranker(args.data_dir)
+    papers = load_papers(args.papers)
+    names = [author for paper in papers for author in paper.get('authors', [])]
+    rng = random.Random(0)
+
+    def per_paper(prepared):
+        compiled_query = CompiledQuery(args.query, ranker.lms)
+        return [make_paper_features(compiled_query, paper) for paper in prepared]
+
+    def batch(prepared):
+        return make_papers_features(CompiledQuery(args.query, ranker.lms), prepared)
+
+    print(f'{"authors":>8} {"per paper us":>13} {"batch us":>10}')
+    for n_authors in args.n_authors:
+        prepared = [
+            ranker.prepare_result(dict(paper, authors=[rng.choice(names) for _ in range(n_authors)]))
+            for paper in papers
+        ]
+        X_per_paper, X_batch = np.array(per_paper(prepared), dtype=float), np.array(batch(prepared), dtype=float)
+        assert np.array_equal(X_per_paper, X_batch, equal_nan=True), 'feature vectors differ'
+        t_per_paper = time_per_candidate(per_paper, prepared, args.repeats)
+        t_batch = time_per_candidate(batch, prepared, args.repeats)
+        print(f'{n_authors:>8} {1e6 * t_per_paper:>13.1f} {1e6 * t_batch:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
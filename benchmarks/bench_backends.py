@@ -0,0 +1,70 @@
+"""Parity and throughput of the inference backends, per batch size.
+
+The features of the papers for the query are computed once and tiled up to
+the largest batch size. Every backend is checked against the pickled model
+(the largest absolute score difference, and whether the scores are
+identical), then timed on batches of each size. The fastest backend at
+each batch size is the one to deploy for requests of that size.
+
+    python -c "from s2search.backends import export_model; export_model('s2search/')"
+    python benchmarks/bench_backends.py --data-dir s2search/ --papers papers.jsonl --num-threads 1 4
+"""
+import argparse
+import time
+import numpy as np
+from common import load_papers
+from s2search.rank import S2Ranker
+from s2search.backends import load_backend
+
+
+def rows_per_second(model, X, batch_size, repeats):
+    batches = [X[i:i + batch_size] for i in range(0, len(X), batch_size)]
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for batch in batches:
+            model.predict(batch)
+        best = min(best, time.perf_counter() - start)
+    return len(X) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--papers', required=True, help='a JSON list or a JSONL file of papers')
+    parser.add_argument('--query', default='"sentiment analysis" neural networks 2019')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('--num-threads', type=int, nargs='+', default=[0])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    ranker = S2Ranker(args.data_dir)
+    X = ranker.featurize(args.query, load_papers(args.papers))
+    X = np.tile(X, (int(np.ceil(max(args.batch_sizes) / len(X))), 1))[:max(args.batch_sizes)]
+
+    backends = {}
+    for num_threads in args.num_threads:
+        backends[f'pickle threads={num_threads}'] = load_backend(args.data_dir, 'pickle', num_threads=num_threads)
+        backends[f'booster threads={num_threads}'] = load_backend(args.data_dir, 'booster', num_threads=num_threads)
+    backends['numpy float32'] = load_backend(args.data_dir, 'numpy')
+    backends['numpy float64'] = load_backend(args.data_dir, 'numpy', dtype=np.float64)
+
+    reference = ranker.model.predict(X)
+    print(f'{"backend":<22} {"max abs diff":>13} {"identical":>10}')
+    for name, model in backends.items():
+        scores = model.predict(X)
+        print(f'{name:<22} {np.max(np.abs(scores - reference)):>13.3g} {str(np.array_equal(scores, reference)):>10}')
+
+    print()
+    print(f'{"backend":<22}' + ''.join(f'{f"batch {b} rows/s":>20}' for b in args.batch_sizes))
+    throughput = {}
+    for name, model in backends.items():
+        throughput[name] = [rows_per_second(model, X, b, args.repeats) for b in args.batch_sizes]
+        print(f'{name:<22}' + ''.join(f'{t:>20.0f}' for t in throughput[name]))
+    print(f'{"fastest":<22}' + ''.join(
+        f'{max(throughput, key=lambda name: throughput[name][i]):>20}' for i in range(len(args.batch_sizes))
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Per-candidate featurization latency, before and after compiling the query once.
+
+"before" calls `make_features` per paper, which re-parses the query and
+re-scores the nonsense unigram every time. "after" builds one `CompiledQuery`
+and calls `make_paper_features` per paper, which is what `S2Ranker.score` does.
+
+    python benchmarks/bench_compiled_query.py --data-dir s2search/ --papers papers.jsonl --query 'neural networks'
+"""
+import argparse
+import time
+import numpy as np
+from common import load_papers
+from s2search.rank import S2Ranker
+from s2search.features import CompiledQuery, make_features, make_paper_features
+
+
+def time_per_candidate(fn, papers, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(papers)
+        best = min(best, time.perf_counter() - start)
+    return best / len(papers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--papers', required=True, help='a JSON list or a JSONL file of papers')
+    parser.add_argument('--query', default='"sentiment analysis" neural networks 2019')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    ranker = S2Ranker(args.data_dir)
+    prepared = [ranker.prepare_result(paper) for paper in load_papers(args.papers)]
+
+    def before(papers):
+        return [make_features(args.query, paper, ranker.lms) for paper in papers]
+
+    def after(papers):
+        compiled_query = CompiledQuery(args.query, ranker.lms)
+        return [make_paper_features(compiled_query, paper) for paper in papers]
+
+    X_before, X_after = np.array(before(prepared), dtype=float), np.array(after(prepared), dtype=float)
+    assert np.array_equal(X_before, X_after, equal_nan=True), 'feature vectors differ'
+
+    t_before = time_per_candidate(before, prepared, args.repeats)
+    t_after = time_per_candidate(after, prepared, args.repeats)
+    print(f'candidates:             {len(prepared)}')
+    print(f'before (make_features): {1e6 * t_before:10.1f} us/candidate')
+    print(f'after (CompiledQuery):  {1e6 * t_after:10.1f} us/candidate')
+    print(f'speedup:                {t_before / t_after:10.2f}x')
+
+
+if __name__ == '__main__':
+    main()
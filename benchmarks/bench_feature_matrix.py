@@ -0,0 +1,140 @@
+"""Memory, allocations and time of building the feature matrix, on synthetic data.
+
+Compares, for each query's candidates:
+
+    rows        the rows as a list of lists of floats, which is what the features
+                were built as before they were written into a preallocated array
+    rows_array  the same, then copied into an array, which is what scoring did
+    float64     make_papers_features into a preallocated float64 array
+    float32     the same into a float32 array
+    cascade     only the columns of --cascade-groups (see FEATURE_GROUPS in
+                s2search.features), which skips the stages that they don't need
+
+and reports the peak and retained bytes per candidate measured with
+tracemalloc, the memory blocks that are retained per row, and the candidates
+per second. The retained memory is mostly the result. It's measured on a
+second pass over the queries, so that it includes less of what the compiled
+queries cache. Then it checks how much scoring with float32 features changes
+the scores of the tiny model.
+
+    python benchmarks/bench_feature_matrix.py --candidates-per-query 1000
+"""
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from synthetic import make_papers, make_queries, make_stub_ranker
+from s2search.rank import S2Ranker
+from s2search.features import CompiledQuery, make_papers_features, feature_mask, featurization_stages
+from s2search.features import match_paper_fields, match_authors_many, finish_paper_features
+
+
+def rows_features(compiled_query, prepared, columns=None):
+    # the list of lists that make_papers_features used to return
+    paper_matches = [match_paper_fields(compiled_query, paper) for paper in prepared]
+    match_authors_many(compiled_query, paper_matches)
+    return [finish_paper_features(compiled_query, matches, paper) for paper, matches in zip(prepared, paper_matches)]
+
+
+def rows_array_features(compiled_query, prepared, columns=None):
+    return np.array(rows_features(compiled_query, prepared))
+
+
+def float64_features(compiled_query, prepared, columns=None):
+    return make_papers_features(compiled_query, prepared, dtype=np.float64)
+
+
+def float32_features(compiled_query, prepared, columns=None):
+    return make_papers_features(compiled_query, prepared, dtype=np.float32)
+
+
+def cascade_features(compiled_query, prepared, columns=None):
+    return make_papers_features(compiled_query, prepared, columns, dtype=np.float32)
+
+
+METHODS = [('rows', rows_features), ('rows_array', rows_array_features), ('float64', float64_features),
+           ('float32', float32_features), ('cascade', cascade_features)]
+
+
+def measure_memory(fn, calls, columns):
+    """Peak and retained bytes per candidate, and the memory blocks that are
+    retained per row, over all of calls
+    """
+    n_candidates, peak, retained, blocks = 0, 0, 0, 0
+    for compiled_query, prepared in calls:
+        tracemalloc.start()
+        blocks_before = sys.getallocatedblocks()
+        before, _ = tracemalloc.get_traced_memory()
+        X = fn(compiled_query, prepared, columns)
+        after, call_peak = tracemalloc.get_traced_memory()
+        blocks_after = sys.getallocatedblocks()
+        tracemalloc.stop()
+        n_candidates += len(prepared)
+        peak += call_peak - before
+        retained += after - before
+        blocks += blocks_after - blocks_before
+        del X
+    return peak / n_candidates, retained / n_candidates, blocks / n_candidates
+
+
+def measure_time(fn, calls, columns, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for compiled_query, prepared in calls:
+            fn(compiled_query, prepared, columns)
+        best = min(best, time.perf_counter() - start)
+    return sum(len(prepared) for _, prepared in calls) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--n-papers', type=int, default=2000)
+    parser.add_argument('--n-queries', type=int, default=30)
+    parser.add_argument('--candidates-per-query', type=int, default=500)
+    parser.add_argument('--cascade-groups', default='abstract_is_available,year,title,citations',
+                        help='comma-separated feature groups or names for the cascade')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    papers = make_papers(args.n_papers, seed=args.seed)
+    queries, _ = make_queries(args.n_queries, papers, seed=args.seed)
+    prepared = [S2Ranker.prepare_result(paper) for paper in papers]
+    rng = np.random.default_rng(args.seed)
+    candidates = [rng.choice(len(papers), size=min(args.candidates_per_query, len(papers)), replace=False)
+                  for _ in queries]
+    columns = feature_mask(args.cascade_groups.split(','))
+    print(f'cascade columns: {int(columns.sum())} of {len(columns)}, '
+          f'stages: {", ".join(sorted(featurization_stages(columns))) or "none"}')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ranker = make_stub_ranker(tmp_dir, seed=args.seed)
+        ranker32 = S2Ranker(tmp_dir, lms=ranker.lms, feature_dtype=np.float32)
+        calls = [(CompiledQuery(query, ranker.lms), [prepared[i] for i in rows])
+                 for query, rows in zip(queries, candidates)]
+        # fill the caches of the compiled queries
+        for compiled_query, query_prepared in calls:
+            float64_features(compiled_query, query_prepared)
+
+        print()
+        print(f'{"method":<10} {"peak B/cand":>12} {"kept B/cand":>12} {"blocks/row":>11} {"cand/s":>9}')
+        for name, fn in METHODS:
+            peak, retained, blocks = measure_memory(fn, calls, columns)
+            per_s = measure_time(fn, calls, columns, args.repeats)
+            print(f'{name:<10} {peak:>12.0f} {retained:>12.1f} {blocks:>11.2f} {per_s:>9.0f}')
+
+        max_diff, same_top = 0.0, 0
+        for query, rows in zip(queries, candidates):
+            query_papers = [papers[i] for i in rows]
+            scores, scores32 = ranker.score(query, query_papers), ranker32.score(query, query_papers)
+            max_diff = max(max_diff, float(np.max(np.abs(scores - scores32))))
+            same_top += np.array_equal(np.argsort(-scores, kind='stable')[:10], np.argsort(-scores32, kind='stable')[:10])
+    print()
+    print(f'float32 features: max |score difference| {max_diff:.3g}, same top 10 for {same_top} of {len(queries)} queries')
+
+
+if __name__ == '__main__':
+    main()
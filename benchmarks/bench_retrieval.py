@@ -0,0 +1,72 @@
+"""Build time, size and query latency of the BM25 retriever (see s2search.retrieval)
+on synthetic data, and how many of the ranker's top 10 over the whole corpus a
+search that reranks only k BM25 candidates finds.
+
+    python benchmarks/bench_retrieval.py --n-papers 100000 --k 10,100,1000
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from synthetic import make_papers, make_queries, make_stub_ranker
+from s2search.corpus import build_corpus, Corpus
+from s2search.retrieval import build_bm25_index, BM25Index, Searcher
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def best_time(fn, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--n-papers', type=int, default=20000)
+    parser.add_argument('--n-queries', type=int, default=20)
+    parser.add_argument('--k', default='10,100,1000', help='comma-separated numbers of candidates to rerank')
+    parser.add_argument('--n-exhaustive', type=int, default=5,
+                        help='queries to also score against the whole corpus, for the recall of the top 10')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    papers = [dict(paper, id=f'p{i}') for i, paper in enumerate(make_papers(args.n_papers, seed=args.seed))]
+    queries, _ = make_queries(args.n_queries, papers, seed=args.seed)
+    ks = [int(k) for k in args.k.split(',')]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir, index_dir = os.path.join(tmp_dir, 'corpus'), os.path.join(tmp_dir, 'index')
+        build_corpus(papers, corpus_dir)
+        corpus = Corpus(corpus_dir)
+        start = time.perf_counter()
+        n_terms = build_bm25_index(corpus, index_dir)
+        build_seconds = time.perf_counter() - start
+        index = BM25Index(index_dir)
+        print(f'{len(corpus)} papers, {n_terms} terms, {index.meta["n_postings"]} postings, '
+              f'{directory_size(index_dir) / 2 ** 20:.1f} MiB, built in {build_seconds:.1f}s')
+
+        searcher = Searcher(make_stub_ranker(os.path.join(tmp_dir, 'model'), seed=args.seed), corpus, index)
+        exhaustive = []
+        for query in queries[:args.n_exhaustive]:
+            scores = searcher.ranker.score_corpus(query, corpus)
+            exhaustive.append(set(np.argsort(-scores, kind='stable')[:10]))
+
+        print()
+        print(f'{"k":>6} {"retrieve ms":>12} {"search ms":>10} {"recall@10":>10}')
+        for k in ks:
+            retrieve = np.mean([best_time(lambda: index.search(query, k), args.repeats) for query in queries])
+            search = np.mean([best_time(lambda: searcher.search(query, k), args.repeats) for query in queries])
+            recall = np.mean([len(top & set(searcher.search(query, k)[2][:10])) / 10
+                              for query, top in zip(queries, exhaustive)])
+            print(f'{k:>6} {1000 * retrieve:>12.2f} {1000 * search:>10.2f} {recall:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
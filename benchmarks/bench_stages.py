@@ -0,0 +1,214 @@
+"""Throughput and latency percentiles of each stage of scoring, on synthetic data.
+
+Runs without the real models: papers and queries come from the generators in
+benchmarks/synthetic.py, the language models are deterministic stubs, and the
+lightgbm model is a tiny one trained on the synthetic data at startup. The
+stages are timed one call at a time:
+
+    fix_text                    S2Ranker.prepare_text of one paper (fix_text and fix_author_text)
+    find_query_ngrams_in_text   one query against one title or abstract
+    make_features               CompiledQuery and make_papers_features for one query's candidates
+    predict                     the model on one query's features
+    posthoc_score_adjust        the posthoc correction of one query's scores
+    score                       S2Ranker.score of one query's candidates, end to end
+
+--save writes the results as JSON, and --baseline compares against such a
+file and exits with an error if any stage got slower by more than --tolerance,
+or if the features or scores changed. The stub outputs are deterministic, so a
+change of the checksums means that an optimization changed what is computed.
+
+    python benchmarks/bench_stages.py --save benchmarks/baseline.json
+    python benchmarks/bench_stages.py --baseline benchmarks/baseline.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+from synthetic import make_papers, make_queries, make_stub_ranker
+from s2search.rank import S2Ranker
+from s2search.text import fix_text, find_query_ngrams_in_text
+from s2search.features import CompiledQuery, make_papers_features, posthoc_score_adjust
+
+STAGES = ['fix_text', 'find_query_ngrams_in_text', 'make_features', 'predict', 'posthoc_score_adjust', 'score']
+
+
+def time_calls(fn, calls):
+    """Time fn(*args) for each args of calls
+
+    Returns:
+        seconds {np.array} -- how long each call took
+        outputs {list} -- what each call returned
+    """
+    seconds = np.zeros(len(calls))
+    outputs = []
+    for i, args in enumerate(calls):
+        start = time.perf_counter()
+        outputs.append(fn(*args))
+        seconds[i] = time.perf_counter() - start
+    return seconds, outputs
+
+
+def summarize(passes, n_items):
+    """Throughput of the fastest pass, which is the least noisy, and
+    latency percentiles over the calls of all of the passes
+
+    Arguments:
+        passes {list of np.array} -- the seconds of each call, per pass
+        n_items {int} -- how many items a pass processes
+    """
+    seconds = np.concatenate(passes)
+    best = min(p.sum() for p in passes)
+    return {
+        'calls': len(passes[0]),
+        'items': n_items,
+        'seconds': float(best),
+        'items_per_s': float(n_items / best),
+        'p50_ms': float(np.percentile(seconds, 50) * 1000),
+        'p90_ms': float(np.percentile(seconds, 90) * 1000),
+        'p99_ms': float(np.percentile(seconds, 99) * 1000),
+    }
+
+
+def checksum(arrays):
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def run_stages(ranker, papers, queries, candidates_per_query, seed):
+    """One timed pass over every stage
+
+    Returns:
+        seconds {dict} -- the seconds of each call, by stage
+        n_items {dict} -- how many items each stage processed
+        checksums {dict} -- of the features and scores
+    """
+    rng = np.random.default_rng(seed)
+    candidates = [[papers[i] for i in rng.choice(len(papers), size=candidates_per_query, replace=False)]
+                  for _ in queries]
+    seconds, n_items = {}, {}
+
+    seconds['fix_text'], prepared = time_calls(S2Ranker.prepare_text, [(paper,) for paper in papers])
+    n_items['fix_text'] = len(papers)
+    prepared = {id(paper): dict(S2Ranker.prepare_result(paper), **text) for paper, text in zip(papers, prepared)}
+
+    calls = []
+    for query, query_candidates in zip(queries, candidates):
+        q = fix_text(query)
+        for paper in query_candidates[:20]:
+            text = prepared[id(paper)]
+            calls.append((q, text['paper_title_cleaned']))
+            calls.append((q, text['paper_abstract_cleaned']))
+    seconds['find_query_ngrams_in_text'], _ = time_calls(find_query_ngrams_in_text, calls)
+    n_items['find_query_ngrams_in_text'] = len(calls)
+
+    def featurize(query, query_candidates):
+        return make_papers_features(CompiledQuery(query, ranker.lms), query_candidates)
+
+    calls = [(query, [prepared[id(paper)] for paper in query_candidates])
+             for query, query_candidates in zip(queries, candidates)]
+    seconds['make_features'], features = time_calls(featurize, calls)
+    seconds['predict'], raw_scores = time_calls(ranker.model.predict, [(X,) for X in features])
+    calls = [(scores.copy(), X, query) for scores, X, query in zip(raw_scores, features, queries)]
+    seconds['posthoc_score_adjust'], _ = time_calls(posthoc_score_adjust, calls)
+    seconds['score'], scores = time_calls(ranker.score, list(zip(queries, candidates)))
+    for stage in ['make_features', 'predict', 'posthoc_score_adjust', 'score']:
+        n_items[stage] = len(queries) * candidates_per_query
+
+    checksums = {'features': checksum(features), 'scores': checksum(scores)}
+    return seconds, n_items, checksums
+
+
+def environment():
+    import lightgbm
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'lightgbm': lightgbm.__version__,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Print how each stage compares to the baseline
+
+    Returns:
+        ok {bool} -- whether nothing regressed
+    """
+    ok = True
+    print()
+    print(f'{"stage":<27} {"baseline/s":>12} {"now/s":>12} {"ratio":>7}')
+    for stage in STAGES:
+        if stage not in baseline['stages']:
+            continue
+        before, after = baseline['stages'][stage]['items_per_s'], report['stages'][stage]['items_per_s']
+        regressed = after < (1 - tolerance) * before
+        ok &= not regressed
+        print(f'{stage:<27} {before:>12.0f} {after:>12.0f} {after / before:>7.2f}' + ('  REGRESSED' if regressed else ''))
+    if baseline['config'] != report['config']:
+        print('the baseline was made with different arguments, so its outputs are not comparable')
+        return ok
+    if report['checksums']['features'] != baseline['checksums']['features']:
+        print('the features changed')
+        ok = False
+    if baseline['environment']['lightgbm'] == report['environment']['lightgbm']:
+        # other lightgbm versions may train a different tiny model
+        if report['checksums']['scores'] != baseline['checksums']['scores']:
+            print('the scores changed')
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--n-papers', type=int, default=2000)
+    parser.add_argument('--n-queries', type=int, default=100)
+    parser.add_argument('--candidates-per-query', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3, help='timed passes over all of the stages')
+    parser.add_argument('--model-dir', help='where the tiny model is trained (or loaded from). a temporary directory if not given')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='a JSON file of earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='how much slower a stage may get')
+    args = parser.parse_args()
+
+    papers = make_papers(args.n_papers, seed=args.seed)
+    queries, _ = make_queries(args.n_queries, papers, seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ranker = make_stub_ranker(args.model_dir or tmp_dir, seed=args.seed)
+        # one untimed pass so that every stage is warmed up
+        run_stages(ranker, papers[:200], queries[:10], min(args.candidates_per_query, 200), args.seed)
+        passes = [run_stages(ranker, papers, queries, args.candidates_per_query, args.seed) for _ in range(args.repeats)]
+    stages = {stage: summarize([seconds[stage] for seconds, _, _ in passes], passes[0][1][stage]) for stage in STAGES}
+    checksums = passes[0][2]
+
+    report = {
+        'environment': environment(),
+        'config': {key: getattr(args, key) for key in ['n_papers', 'n_queries', 'candidates_per_query', 'seed']},
+        'stages': stages,
+        'checksums': checksums,
+    }
+    print(f'{"stage":<27} {"calls":>7} {"items/s":>12} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9}')
+    for stage in STAGES:
+        s = stages[stage]
+        print(f'{stage:<27} {s["calls"]:>7} {s["items_per_s"]:>12.0f} {s["p50_ms"]:>9.3f} {s["p90_ms"]:>9.3f} {s["p99_ms"]:>9.3f}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
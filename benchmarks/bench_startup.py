@@ -0,0 +1,91 @@
+"""Startup time and memory of S2Ranker for each way of loading the language models.
+
+Every configuration runs in a fresh process. For each one we report the time
+to construct S2Ranker, the time of the first score call (which is when lazy
+models get loaded), and the resident memory split into file-backed pages
+(shared through the page cache between processes) and anonymous pages
+(private to the process).
+
+    python benchmarks/bench_startup.py --data-dir s2search/
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import common  # noqa: F401 puts the repo root on sys.path, for the child processes too
+
+CONFIGS = [
+    {'lm_load_method': 'populate'},
+    {'lm_load_method': 'read'},
+    {'lm_load_method': 'lazy'},
+    {'lm_load_method': 'lazy', 'lazy_lms': True},
+    {'lm_load_method': 'populate_or_lazy', 'lazy_lms': True},
+]
+
+PAPERS = [
+    {
+        'title': 'Neural Networks are Great',
+        'abstract': 'Neural networks are known to be really great models. You should use them.',
+        'venue': 'Deep Learning Notions',
+        'authors': ['Sergey Feldman', 'Gottfried W. Leibniz'],
+        'year': 2019,
+        'n_citations': 100,
+        'n_key_citations': 10
+    },
+]
+
+
+def memory_mb():
+    """Resident memory in MB, as (file-backed, anonymous). Linux only.
+    """
+    stats = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('RssFile', 'RssAnon'):
+                stats[key] = int(value.split()[0]) / 1024
+    return stats.get('RssFile', float('nan')), stats.get('RssAnon', float('nan'))
+
+
+def child(data_dir, config):
+    start = time.perf_counter()
+    from s2search.rank import S2Ranker
+    ranker = S2Ranker(data_dir, **config)
+    constructed = time.perf_counter()
+    file_mb_init, anon_mb_init = memory_mb()
+    ranker.score('neural networks feldman', PAPERS)
+    scored = time.perf_counter()
+    file_mb, anon_mb = memory_mb()
+    print(json.dumps({
+        'init_s': constructed - start,
+        'first_score_s': scored - constructed,
+        'rss_file_mb_after_init': file_mb_init,
+        'rss_anon_mb_after_init': anon_mb_init,
+        'rss_file_mb': file_mb,
+        'rss_anon_mb': anon_mb,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        return child(args.data_dir, json.loads(args.child))
+
+    print(f'{"config":<55} {"init s":>8} {"1st score s":>12} {"file MB":>9} {"anon MB":>9}')
+    for config in CONFIGS:
+        out = subprocess.run(
+            [sys.executable, __file__, '--data-dir', args.data_dir, '--child', json.dumps(config)],
+            check=True, capture_output=True, text=True
+        )
+        result = json.loads(out.stdout.strip().split('\n')[-1])
+        print(f'{json.dumps(config):<55} {result["init_s"]:>8.2f} {result["first_score_s"]:>12.2f} '
+              f'{result["rss_file_mb"]:>9.1f} {result["rss_anon_mb"]:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Timing of fix_text and fix_author_text against the multi-pass implementations
+they replaced, on the titles, abstracts, venues and authors of synthetic papers,
+and of --papers if given. The outputs are compared on those fields too. The
+reference implementations, and the differential test on every unicode code point
+and on random strings, are in tests/test_text.py.
+
+    python benchmarks/bench_text.py --papers papers.jsonl
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from common import REPO_ROOT, load_papers
+from synthetic import make_papers
+
+sys.path.insert(0, os.path.join(REPO_ROOT, 'tests'))
+from test_text import PAIRS, differences  # noqa: E402
+
+
+def paper_fields(papers):
+    fields = {'title': [], 'abstract': [], 'venue': [], 'authors': []}
+    for paper in papers:
+        for field in ['title', 'abstract', 'venue']:
+            fields[field].append(paper.get(field, ''))
+        fields['authors'].extend(paper.get('authors', []))
+    return fields
+
+
+def time_per_string(fn, strings, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for s in strings:
+            fn(s)
+        best = min(best, time.perf_counter() - start)
+    return best / max(len(strings), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--papers', help='a JSON list or a JSONL file of papers to also check and time on')
+    parser.add_argument('--n-papers', type=int, default=5000, help='synthetic papers')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    papers = make_papers(args.n_papers, seed=0)
+    if args.papers:
+        papers += load_papers(args.papers)
+    fields = paper_fields(papers)
+
+    n_strings = sum(len(strings) for strings in fields.values())
+    found = differences(s for strings in fields.values() for s in strings)
+    for difference in found:
+        print(f'  {difference}')
+    print(f'paper fields: {n_strings} strings, {"some" if found else "no"} differences')
+
+    print()
+    print(f'{"field":<10} {"function":<16} {"reference us":>13} {"fused us":>10} {"speedup":>8}')
+    for field, strings in fields.items():
+        name, fn, reference = PAIRS[1] if field == 'authors' else PAIRS[0]
+        t_reference = time_per_string(reference, strings, args.repeats)
+        t_fn = time_per_string(fn, strings, args.repeats)
+        print(f'{field:<10} {name:<16} {1e6 * t_reference:>13.2f} {1e6 * t_fn:>10.2f} {t_reference / t_fn:>7.2f}x')
+    if found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
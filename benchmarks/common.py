@@ -0,0 +1,20 @@
+"""Helpers shared by the benchmark scripts. Importing this puts the repo root on
+sys.path, so the scripts run from a checkout without installing the package.
+Every script imports it (directly or through synthetic.py) before s2search.
+"""
+import os
+import sys
+import json
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def load_papers(path):
+    """Papers from a JSON list or a JSONL file
+    """
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
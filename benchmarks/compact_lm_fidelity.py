@@ -0,0 +1,96 @@
+"""Fidelity of the compact n-gram table (see s2search.compact_lm) against the
+full language models, on held-out queries.
+
+For each query, the papers are scored with both, and the report has:
+
+    coverage    the fraction of the strings that featurizing the query scores
+                that are in the table, i.e. that get exact log-probs
+    spearman    the rank correlation of the two sets of scores
+    top10       the overlap of the two top 10s, as a fraction
+    exact       whether the scores are identical
+
+summarized over all of the queries, plus the memory of the models and the table.
+
+    python -m s2search.compact_lm --data-dir s2search/ --queries train_queries.txt --papers papers.jsonl --output lm_table/
+    python benchmarks/compact_lm_fidelity.py --data-dir s2search/ --table lm_table/ --queries held_out_queries.txt --papers papers.jsonl
+"""
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from common import load_papers
+from s2search.rank import S2Ranker, LM_NAMES
+from s2search.features import CompiledQuery
+from s2search.compact_lm import CompactLanguageModelTable
+
+
+def load_queries(path):
+    with open(path) as f:
+        if path.endswith('.json'):
+            return json.load(f)
+        return [json.loads(line)['query'] if path.endswith('.jsonl') else line.strip() for line in f if line.strip()]
+
+
+def top_k_overlap(a, b, k=10):
+    k = min(k, len(a))
+    top_a = set(np.argsort(-a, kind='stable')[:k])
+    top_b = set(np.argsort(-b, kind='stable')[:k])
+    return len(top_a & top_b) / max(k, 1)
+
+
+def coverage(query, full_lms, table):
+    strings = list(CompiledQuery(query, full_lms).log_probs.table)
+    if len(strings) == 0:
+        return np.nan
+    return np.mean([table.find(s) >= 0 for s in strings])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', required=True, help='where the full language models and the model live')
+    parser.add_argument('--table', required=True, help='the compact table directory')
+    parser.add_argument('--queries', required=True, help='held-out queries: one per line, JSONL or a JSON list')
+    parser.add_argument('--papers', required=True, help='a JSON list or a JSONL file of papers to score')
+    parser.add_argument('--candidates-per-query', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the per-query results to this CSV file')
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    papers = load_papers(args.papers)
+    full = S2Ranker(args.data_dir)
+    compact = S2Ranker(args.data_dir, lm_table=args.table)
+    table = CompactLanguageModelTable(args.table)
+    rng = np.random.default_rng(args.seed)
+
+    results = []
+    for query in queries:
+        rows = rng.choice(len(papers), size=min(args.candidates_per_query, len(papers)), replace=False)
+        candidates = [papers[i] for i in rows]
+        scores, compact_scores = full.score(query, candidates), compact.score(query, candidates)
+        results.append({
+            'query': query,
+            'coverage': coverage(query, full.lms, table),
+            'spearman': pd.Series(scores).corr(pd.Series(compact_scores), method='spearman'),
+            'top10': top_k_overlap(scores, compact_scores),
+            'exact': np.array_equal(scores, compact_scores),
+        })
+    results = pd.DataFrame(results)
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    model_bytes = sum(os.path.getsize(os.path.join(args.data_dir, f'{name}.binary')) for name in LM_NAMES)
+    print(f'queries: {len(results)}, candidates per query: {min(args.candidates_per_query, len(papers))}')
+    print(f'memory: models {model_bytes / 2 ** 20:.1f} MiB, table {table.nbytes / 2 ** 20:.1f} MiB '
+          f'({len(table)} entries)')
+    print()
+    print(f'{"":<10} {"mean":>8} {"p10":>8} {"min":>8}')
+    for column in ['coverage', 'spearman', 'top10']:
+        values = results[column].dropna()
+        print(f'{column:<10} {values.mean():>8.4f} {values.quantile(0.1):>8.4f} {values.min():>8.4f}')
+    print(f'{"exact":<10} {results["exact"].mean():>8.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Local load generator for the scoring server (see s2search/server.py).
+
+A number of client threads send POST /score requests back to back for the
+given duration, each with a random query and a random sample of the papers.
+Reports the latency percentiles and the requests per second that the server
+sustained, e.g. to pick --max-wait and the number of workers and threads.
+
+    S2SEARCH_DATA_DIR=s2search/ gunicorn --preload -w 4 -k gthread --threads 32 -b 127.0.0.1:8000 's2search.server:create_app()'
+    python benchmarks/load_server.py --papers papers.jsonl --concurrency 1 8 32 --papers-per-request 100
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+import numpy as np
+from common import load_papers
+
+QUERIES = ['neural networks', '"sentiment analysis" 2019', 'wang deep learning', 'graph neural networks survey',
+           'machine translation', 'reinforcement learning robotics', 'covid-19 transmission', 'bert']
+
+
+def wait_until_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url + '/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+        time.sleep(0.5)
+
+
+def run(url, papers, concurrency, duration, papers_per_request, seed):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(i):
+        rng = random.Random(seed + i)
+        while time.monotonic() < stop_at:
+            body = {'query': rng.choice(QUERIES), 'papers': rng.sample(papers, min(papers_per_request, len(papers)))}
+            request = urllib.request.Request(url + '/score', data=json.dumps(body).encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    response.read()
+                latency = time.perf_counter() - start
+                with lock:
+                    latencies.append(latency)
+            except OSError:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return np.array(latencies), errors[0], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--papers', required=True, help='a JSON list or a JSONL file of papers')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per concurrency level')
+    parser.add_argument('--papers-per-request', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    papers = load_papers(args.papers)
+    wait_until_ready(args.url, timeout=600)
+    print(f'{"concurrency":>11} {"requests":>9} {"errors":>7} {"QPS":>8} {"p50 ms":>8} {"p99 ms":>8}')
+    for concurrency in args.concurrency:
+        latencies, errors, elapsed = run(args.url, papers, concurrency, args.duration, args.papers_per_request, args.seed)
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if len(latencies) > 0 else (np.nan, np.nan)
+        print(f'{concurrency:>11} {len(latencies):>9} {errors:>7} {len(latencies) / elapsed:>8.1f} {p50:>8.1f} {p99:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""Synthetic fixtures for benchmarking without the real models: a corpus and
+query generator, a deterministic stand-in for kenlm's language models, and a
+tiny lightgbm ranker trained on them.
+
+Everything is a function of the seed, so two runs with the same arguments
+featurize and score exactly the same things.
+"""
+import os
+import zlib
+import random
+import pickle
+import numpy as np
+import common  # noqa: F401 puts the repo root on sys.path
+from s2search.rank import S2Ranker
+from s2search.features import CompiledQuery, make_papers_features, FEATURE_CONSTRAINTS
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ra', 'tu', 'shi', 'vo', 'den', 'gra', 'pho', 'tri', 'qua', 'zel', 'bor',
+             'net', 'lin', 'mor', 'sta', 'cy', 'ion', 'ex', 'al', 'ic', 'ent', 'ur', 'ph', 'ology', 'tion', 'ive']
+COMMON_WORDS = ['the', 'of', 'and', 'a', 'in', 'for', 'on', 'with', 'to', 'is', 'we', 'this', 'by', 'from', 'an',
+                'are', 'that', 'as', 'be', 'our', 'neural', 'network', 'networks', 'learning', 'deep', 'model',
+                'models', 'analysis', 'data', 'based', 'using', 'method', 'methods', 'results', 'approach', 'show',
+                'language', 'graph', 'image', 'protein', 'quantum', 'clinical', 'covid-19', 'state-of-the-art']
+ACCENTED_WORDS = ['café', 'naïve', 'résumé', 'über', 'señal', 'Schrödinger', 'Erdős', 'α-helix', 'β-sheet',
+                  'μm', 'façade', 'coöperative']
+SURNAMES = ['Wang', 'Li', 'Zhang', 'Smith', 'Müller', 'García', 'Kim', 'Nguyen', 'Feldman', 'Cambria', "O'Brien",
+            'Kowalski', 'Rossi', 'Singh', 'Sato', 'Dubois', 'Ivanov', 'Andersson', 'López', 'Chen', 'Park', 'Novák']
+FIRST_NAMES = ['Wei', 'John', 'Maria', 'Sergey', 'Aisha', 'Jürgen', 'Yuki', 'Carlos', 'Priya', 'Emma', 'Lucas',
+               'Fatima', 'Hiroshi', 'Olga', 'Ahmed', 'Zoë', 'J.', 'M.', 'E.', 'S. K.']
+VENUE_WORDS = ['Journal', 'Proceedings', 'Conference', 'International', 'Transactions', 'Letters', 'Review',
+               'IEEE', 'ACM', 'Symposium', 'Workshop', 'Annual', 'Nature', 'Science', 'Physical']
+
+# what kinds of queries are generated, and how often
+QUERY_MIX = {'plain': 0.55, 'quoted': 0.15, 'year': 0.1, 'author': 0.15, 'short': 0.05}
+
+
+def _zipf_choice(rng, items, n, exponent=1.1):
+    weights = 1.0 / np.arange(1, len(items) + 1) ** exponent
+    return [items[i] for i in rng.choice(len(items), size=n, p=weights / weights.sum())]
+
+
+def make_vocabulary(n_words=20000, seed=0):
+    """Common words first, then made up words from syllables, so that
+    drawing from it with a Zipf distribution looks like text
+    """
+    rng = random.Random(seed)
+    words = list(COMMON_WORDS)
+    seen = set(words)
+    while len(words) < n_words:
+        word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.choice([1, 2, 2, 3, 3, 4])))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def _sentence(rng, vocabulary, n_words):
+    words = _zipf_choice(rng, vocabulary, n_words)
+    for i in range(n_words):
+        # a few accented words and bits of punctuation keep unidecode and the tokenizer busy
+        roll = rng.random()
+        if roll < 0.01:
+            words[i] = ACCENTED_WORDS[rng.integers(len(ACCENTED_WORDS))]
+        elif roll < 0.06:
+            words[i] += rng.choice([',', '.', ':', ';'])
+        elif roll < 0.07:
+            words[i] = f'({words[i]})'
+    return ' '.join(words)
+
+
+def _author(rng):
+    return f'{FIRST_NAMES[rng.integers(len(FIRST_NAMES))]} {SURNAMES[rng.integers(len(SURNAMES))]}'
+
+
+def make_papers(n_papers, seed=0, vocabulary=None):
+    """Papers whose field lengths and author counts are heavy-tailed like real search results:
+    ~10 word titles, ~180 word abstracts (with 15% missing), mostly a handful of authors but
+    a few large collaborations, and citation counts that are mostly small
+
+    Arguments:
+        n_papers {int} -- how many papers to make
+        seed {int} -- random seed
+        vocabulary {list of str} -- words to draw from, most common first
+
+    Returns:
+        papers {list of dicts} -- papers in the format S2Ranker.score takes
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = vocabulary or make_vocabulary(seed=seed)
+    venues = [
+        ' '.join(VENUE_WORDS[i] for i in rng.choice(len(VENUE_WORDS), size=rng.integers(2, 5), replace=False))
+        for _ in range(300)
+    ]
+    papers = []
+    for _ in range(n_papers):
+        n_title = int(np.clip(rng.lognormal(np.log(10), 0.4), 1, 40))
+        n_abstract = int(np.clip(rng.lognormal(np.log(180), 0.5), 20, 600))
+        if rng.random() < 0.01:
+            n_authors = int(rng.integers(50, 500))
+        else:
+            n_authors = int(np.clip(rng.lognormal(np.log(3.5), 0.6), 1, 30))
+        paper = {
+            'title': _sentence(rng, vocabulary, n_title).capitalize(),
+            'abstract': _sentence(rng, vocabulary, n_abstract) if rng.random() > 0.15 else '',
+            'venue': _zipf_choice(rng, venues, 1)[0] if rng.random() > 0.1 else '',
+            'authors': [_author(rng) for _ in range(n_authors)],
+            'n_citations': int(rng.pareto(1.2) * 5),
+        }
+        if rng.random() > 0.03:
+            paper['year'] = int(np.clip(2024 - rng.exponential(8), 1950, 2024))
+        if rng.random() > 0.5:
+            paper['n_key_citations'] = int(paper['n_citations'] * rng.random() * 0.2)
+        papers.append(paper)
+    return papers
+
+
+def make_queries(n_queries, papers, seed=0):
+    """Queries that partly match the papers, in the proportions of QUERY_MIX: plain keyword
+    queries, ones with a quoted phrase, ones with a year, ones with an author and short ones
+
+    Arguments:
+        n_queries {int} -- how many queries to make
+        papers {list of dicts} -- the papers the queries are taken from
+        seed {int} -- random seed
+
+    Returns:
+        queries {list of str} -- the queries
+        kinds {list of str} -- the key of QUERY_MIX that each query is
+    """
+    rng = np.random.default_rng(seed)
+    kinds = list(rng.choice(list(QUERY_MIX), size=n_queries, p=list(QUERY_MIX.values())))
+    queries = []
+    for kind in kinds:
+        paper = papers[rng.integers(len(papers))]
+        words = paper['title'].lower().split()
+        n = min(len(words), int(rng.integers(2, 5)))
+        start = int(rng.integers(0, len(words) - n + 1))
+        phrase = ' '.join(words[start:start + n])
+        if kind == 'quoted':
+            query = f'"{phrase}"' + (f' {words[0]}' if rng.random() < 0.5 else '')
+        elif kind == 'year':
+            query = f'{phrase} {paper.get("year", 2019)}'
+        elif kind == 'author':
+            query = f'{paper["authors"][0].split()[-1]} {words[start]}'
+        elif kind == 'short':
+            query = words[start]
+        else:
+            query = phrase
+        queries.append(query)
+    return queries, [str(kind) for kind in kinds]
+
+
+class State:
+    """Stand-in for kenlm.State: the last words that were scored
+    """
+    __slots__ = ['words']
+
+    def __init__(self):
+        self.words = ()
+
+
+class StubLanguageModel:
+    """A deterministic stand-in for a kenlm.Model with the parts of its interface that
+    s2search uses (score, BaseScore, NullContextWrite and BeginSentenceWrite). The
+    log-probabilities are made up from hashes of the n-grams, so they are the same
+    on every machine and in every process, and scores accumulate in a float32 like
+    kenlm's, so score and chained BaseScore calls agree exactly.
+
+    Arguments:
+        name {str} -- makes different models give different scores
+        order {int} -- the n-gram order
+    """
+    def __init__(self, name, order=3):
+        self.name = name
+        self.order = order
+        self.n_calls = 0
+
+    def _log_prob(self, context, word):
+        key = f'{self.name}\x00{word}'
+        log_prob = -1.0 - 6.0 * (zlib.crc32(key.encode('utf-8')) % 10007) / 10007
+        # some n-grams were "seen" and are more likely than their backoff
+        for n in range(1, len(context) + 1):
+            key = '\x00'.join((self.name,) + context[-n:] + (word,))
+            if zlib.crc32(key.encode('utf-8')) % 3 == 0:
+                log_prob += 0.75 * n
+        return float(np.float32(min(log_prob, -0.01)))
+
+    def NullContextWrite(self, state):
+        state.words = ()
+
+    def BeginSentenceWrite(self, state):
+        state.words = ('<s>',)
+
+    def BaseScore(self, in_state, word, out_state):
+        self.n_calls += 1
+        out_state.words = (in_state.words + (word,))[-(self.order - 1):]
+        return self._log_prob(in_state.words, word)
+
+    def score_prefixes(self, words):
+        # s2search.lm.score_prefixes would make kenlm.State objects, which the stub can't use
+        state, out_state = State(), State()
+        total = np.float32(0)
+        scores = []
+        for word in words:
+            total = np.float32(total + np.float32(self.BaseScore(state, word, out_state)))
+            state, out_state = out_state, state
+            scores.append(float(total))
+        return scores
+
+    def score(self, sentence, bos=True, eos=True):
+        words = sentence.split() + (['</s>'] if eos else [])
+        state = State()
+        if bos:
+            self.BeginSentenceWrite(state)
+        out_state = State()
+        total = np.float32(0)
+        for word in words:
+            total = np.float32(total + np.float32(self.BaseScore(state, word, out_state)))
+            state, out_state = out_state, state
+        return float(total)
+
+
+def make_stub_lms():
+    """Stub title/abstract, author and venue language models, in the order of LM_NAMES
+    """
+    return tuple(StubLanguageModel(name) for name in ('titles_abstracts', 'authors', 'venues'))
+
+
+def train_tiny_model(data_dir, papers, queries, candidates_per_query=50, seed=0):
+    """Train a small lightgbm ranker on the synthetic data and pickle it into data_dir
+    as lightgbm_model.pickle, in place of the real model. The labels are how much of
+    each query is in the paper's title, with a bit of noise.
+
+    Arguments:
+        data_dir {str} -- where the model is written
+        papers {list of dicts} -- the papers
+        queries {list of str} -- the training queries
+        candidates_per_query {int} -- papers per query
+        seed {int} -- random seed
+
+    Returns:
+        path {str} -- the pickled model
+    """
+    import lightgbm
+
+    rng = np.random.default_rng(seed)
+    lms = make_stub_lms()
+    X, y, groups = [], [], []
+    for query in queries:
+        candidates = [papers[i] for i in rng.choice(len(papers), size=candidates_per_query, replace=False)]
+        rows = make_papers_features(CompiledQuery(query, lms), [S2Ranker.prepare_result(p) for p in candidates])
+        query_words = set(query.replace('"', '').lower().split())
+        for paper, row in zip(candidates, rows):
+            overlap = len(query_words & set(paper['title'].lower().split())) / max(len(query_words), 1)
+            y.append(int(np.clip(round(3 * overlap + rng.normal(0, 0.5)), 0, 3)))
+            X.append(row)
+        groups.append(candidates_per_query)
+    # with the same monotone constraints as the real model
+    model = lightgbm.LGBMRanker(n_estimators=40, num_leaves=15, min_child_samples=5, learning_rate=0.1,
+                                monotone_constraints=[int(c) for c in FEATURE_CONSTRAINTS.split(',')],
+                                random_state=seed, deterministic=True, n_jobs=1, verbose=-1)
+    model.fit(np.array(X, dtype=float), np.array(y), group=groups)
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, 'lightgbm_model.pickle')
+    with open(path, 'wb') as f:
+        pickle.dump(model, f)
+    return path
+
+
+def make_stub_ranker(data_dir, n_papers=2000, n_queries=100, seed=0, **ranker_options):
+    """An S2Ranker with stub language models and a tiny model trained on synthetic data,
+    which is written to data_dir on first use
+
+    Returns:
+        ranker {S2Ranker} -- the ranker
+    """
+    if not os.path.exists(os.path.join(data_dir, 'lightgbm_model.pickle')):
+        papers = make_papers(n_papers, seed=seed + 1)
+        queries, _ = make_queries(n_queries, papers, seed=seed + 1)
+        train_tiny_model(data_dir, papers, queries, seed=seed)
+    return S2Ranker(data_dir, lms=make_stub_lms(), **ranker_options)
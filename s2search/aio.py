@@ -0,0 +1,226 @@
+"""An asyncio front end for S2Ranker. Scoring runs in a thread or process pool,
+so the event loop is never blocked, and:
+
+    - at most max_in_flight calls are in the pool at a time. the others wait in
+      the event loop, where a call that is cancelled or times out costs nothing
+    - every call can have a timeout, and cancelling a call that hasn't started
+      yet takes it out of the queue
+    - with coalesce=True, calls that arrive within max_wait of each other are
+      scored together with one `S2Ranker.score_many` call
+
+    async with AsyncS2Ranker(S2Ranker(data_dir), executor='process', max_workers=4, coalesce=True) as ranker:
+        scores = await ranker.score('neural networks', papers, timeout=1.0)
+"""
+import os
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+EXECUTORS = ['thread', 'process']
+
+# the ranker of a process of the process pool, which is inherited when it is forked
+_worker_ranker = None
+
+
+def _init_worker(ranker):
+    global _worker_ranker
+    _worker_ranker = ranker
+
+
+def _call_worker_ranker(method, *args):
+    return getattr(_worker_ranker, method)(*args)
+
+
+class AsyncS2Ranker:
+    """Scores with an S2Ranker from coroutines.
+
+    Arguments:
+        ranker {S2Ranker} -- the ranker
+        executor {str} -- 'thread' or 'process'. featurization is mostly pure Python, so
+                          only processes (which are forked, and share the ranker's memory)
+                          score calls in parallel
+        max_workers {int} -- threads or processes in the pool. the number of CPUs if None
+        max_in_flight {int} -- the most calls (or batches, when coalescing) in the pool at a time.
+                               max_workers if None, so that calls only wait where they can be cancelled
+        coalesce {bool} -- whether to merge concurrent calls into `score_many` batches
+        max_wait {float} -- how long the first call of a batch waits for others, in seconds
+        max_batch_size {int} -- the most calls per batch
+        max_batch_papers {int} -- a batch is closed once it has this many papers
+    """
+    def __init__(self, ranker, executor='thread', max_workers=None, max_in_flight=None, coalesce=False,
+                 max_wait=0.005, max_batch_size=64, max_batch_papers=20000):
+        if executor not in EXECUTORS:
+            raise ValueError(f'executor should be one of {EXECUTORS}, not {executor!r}')
+        self.ranker = ranker
+        self.executor_kind = executor
+        self.max_workers = max_workers or os.cpu_count()
+        self.max_in_flight = max_in_flight or self.max_workers
+        self.coalesce = coalesce
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_batch_papers = max_batch_papers
+        if executor == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        else:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise RuntimeError('the process executor needs the fork start method')
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_worker, initargs=(ranker,)
+            )
+        # made in the event loop on first use
+        self._slots = None
+        self._in_flight = 0
+        self._pending = []
+        self._pending_papers = 0
+        self._flush_handle = None
+        self._batches = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the pool. Calls that haven't started are cancelled
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for _, _, future in self._pending:
+            future.cancel()
+        self._pending = []
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def in_flight(self):
+        """How many calls (or batches) are in the pool
+        """
+        return self._in_flight
+
+    async def score(self, query, papers, timeout=None):
+        """Score each pair of (query, paper) for all papers, like `S2Ranker.score`
+
+        Arguments:
+            query {str} -- plain text search query
+            papers {list of dicts} -- A list of candidate papers, each of which
+                                      is a dictionary.
+            timeout {float} -- seconds to wait for the scores, including the time spent
+                               waiting for room in the pool. None means no limit
+
+        Returns:
+            scores {np.array} -- an array of scores, one per paper in papers
+
+        Raises:
+            asyncio.TimeoutError -- if the scores took longer than timeout
+        """
+        query, papers = str(query), list(papers)
+        if self.coalesce:
+            return await asyncio.wait_for(self._score_coalesced(query, papers), timeout)
+        return await asyncio.wait_for(self._run('score', query, papers), timeout)
+
+    async def _acquire(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        await self._slots.acquire()
+
+    def _submit(self, method, *args):
+        # the slot is only given back when the pool is done with the call, so that
+        # calls whose callers gave up while they were running still count
+        loop = asyncio.get_running_loop()
+        slots = self._slots
+        try:
+            if self.executor_kind == 'thread':
+                future = self.executor.submit(getattr(self.ranker, method), *args)
+            else:
+                future = self.executor.submit(_call_worker_ranker, method, *args)
+        except BaseException:
+            slots.release()
+            raise
+        self._in_flight += 1
+
+        def finished():
+            self._in_flight -= 1
+            slots.release()
+
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(finished)
+            except RuntimeError:
+                # the loop is closed
+                pass
+
+        future.add_done_callback(release)
+        return future
+
+    async def _run(self, method, *args):
+        await self._acquire()
+        # cancelling this cancels the pool's future too, which drops the call if it hasn't started
+        return await asyncio.wrap_future(self._submit(method, *args))
+
+    async def _score_coalesced(self, query, papers):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        call = (query, papers, future)
+        self._pending.append(call)
+        self._pending_papers += len(papers)
+        # a timeout or cancellation cancels the future, which takes the call out of its batch
+        future.add_done_callback(lambda _: self._drop_cancelled(call))
+        if len(self._pending) >= self.max_batch_size or self._pending_papers >= self.max_batch_papers:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _drop_cancelled(self, call):
+        # a call that is cancelled before its batch is flushed shouldn't count towards the batch's limits
+        if not call[2].cancelled():
+            return
+        for i, pending in enumerate(self._pending):
+            if pending is call:
+                del self._pending[i]
+                self._pending_papers -= len(call[1])
+                break
+        if len(self._pending) == 0 and self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending, self._pending_papers = self._pending, [], 0
+        if len(batch) > 0:
+            # the event loop only keeps weak references to tasks
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch):
+        await self._acquire()
+        # the calls that were cancelled or timed out while the batch waited for room
+        batch = [call for call in batch if not call[2].done()]
+        if len(batch) == 0:
+            self._slots.release()
+            return
+        try:
+            future = self._submit('score_many', [call[0] for call in batch], [call[1] for call in batch])
+            scores = await asyncio.wrap_future(future)
+        except Exception:
+            # score the calls one at a time so a bad one doesn't fail the others
+            for query, papers, call_future in batch:
+                if call_future.done():
+                    continue
+                try:
+                    call_scores = await self._run('score', query, papers)
+                except Exception as e:
+                    if not call_future.done():
+                        call_future.set_exception(e)
+                else:
+                    if not call_future.done():
+                        call_future.set_result(call_scores)
+        else:
+            for (_, _, call_future), call_scores in zip(batch, scores):
+                if not call_future.done():
+                    call_future.set_result(call_scores)
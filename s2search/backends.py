@@ -0,0 +1,258 @@
+import os
+import pickle
+import numpy as np
+
+# lightgbm treats feature values this close to 0 as 0
+ZERO_THRESHOLD = 1e-35
+
+# bits of a lightgbm decision_type
+CATEGORICAL_MASK = 1
+DEFAULT_LEFT_MASK = 2
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+
+
+class PickleBackend:
+    """The pickled sklearn-wrapper model (`lightgbm_model.pickle`), which is
+    how S2Ranker has always scored. Anything other than predict is passed
+    through to the model.
+
+    Arguments:
+        path {str} -- the pickle file
+        num_threads {int} -- threads lightgbm predicts with. 0 means its default
+    """
+    def __init__(self, path, num_threads=0):
+        with open(path, 'rb') as f:
+            self.model = pickle.load(f)
+        self.num_threads = num_threads
+
+    def __getattr__(self, attr):
+        return getattr(self.model, attr)
+
+    def predict(self, X):
+        return self.model.predict(X, num_threads=self.num_threads)
+
+    def predict_contrib(self, X):
+        return self.model.predict(X, pred_contrib=True, num_threads=self.num_threads)
+
+
+class BoosterBackend:
+    """A native lightgbm Booster loaded from a text model file (see `export_model`),
+    without the sklearn wrapper or pickle.
+
+    Arguments:
+        path {str} -- the text model file
+        num_threads {int} -- threads lightgbm predicts with. 0 means its default
+    """
+    def __init__(self, path, num_threads=0):
+        import lightgbm
+        self.booster = lightgbm.Booster(model_file=path)
+        self.num_threads = num_threads
+
+    def __getattr__(self, attr):
+        return getattr(self.booster, attr)
+
+    def predict(self, X):
+        return self.booster.predict(X, num_threads=self.num_threads)
+
+    def predict_contrib(self, X):
+        return self.booster.predict(X, pred_contrib=True, num_threads=self.num_threads)
+
+
+def parse_model_file(path):
+    """Read a lightgbm text model file
+
+    Arguments:
+        path {str} -- the text model file
+
+    Returns:
+        header {dict} -- the key=value lines before the trees
+        trees {list of dicts} -- the key=value lines of each tree
+    """
+    header = {}
+    trees = []
+    current = header
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == 'end of trees':
+                break
+            if line.startswith('Tree='):
+                current = {}
+                trees.append(current)
+            elif '=' in line:
+                key, _, value = line.partition('=')
+                current[key] = value
+            elif len(line) > 0:
+                # flags like average_output have no value
+                current[line] = ''
+    return header, trees
+
+
+class NumpyTreeBackend:
+    """Evaluates the trees of a lightgbm text model file with numpy alone, so
+    lightgbm doesn't need to be installed (or imported) to score. All of the
+    trees are walked at once, one level per step, over a float32 copy of the
+    features. With dtype=np.float64 the scores are the same as lightgbm's.
+    Feature contributions are computed by lightgbm, which is only imported
+    the first time they are asked for.
+
+    Arguments:
+        path {str} -- the text model file
+        dtype {np.dtype} -- what the features are cast to before evaluating
+        chunk_size {int} -- rows evaluated at a time, which bounds the memory used
+    """
+    def __init__(self, path, dtype=np.float32, chunk_size=8192):
+        header, trees = parse_model_file(path)
+        self.path = path
+        self._booster = None
+        if int(header.get('num_tree_per_iteration', 1)) != 1:
+            raise ValueError('only models with one tree per iteration (not multiclass) are supported')
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.average_output = 'average_output' in header
+        self.n_features = int(header['max_feature_idx']) + 1
+
+        # the nodes of all of the trees, one after the other. children that are
+        # leaves are stored as ~(index into leaf_value), like lightgbm does per tree
+        split_feature, threshold, decision_type, left_child, right_child, leaf_value = [], [], [], [], [], []
+        roots = []
+        for tree in trees:
+            if int(tree.get('num_cat', 0)) > 0:
+                raise ValueError('categorical splits are not supported')
+            if int(tree.get('is_linear', 0)) > 0:
+                raise ValueError('linear trees are not supported')
+            node_offset, leaf_offset = len(split_feature), len(leaf_value)
+            leaves = [float(i) for i in tree['leaf_value'].split()]
+            if int(tree['num_leaves']) == 1:
+                roots.append(~leaf_offset)
+            else:
+                roots.append(node_offset)
+                split_feature.extend(int(i) for i in tree['split_feature'].split())
+                threshold.extend(float(i) for i in tree['threshold'].split())
+                decision_type.extend(int(i) for i in tree['decision_type'].split())
+                for children, key in [(left_child, 'left_child'), (right_child, 'right_child')]:
+                    for child in tree[key].split():
+                        child = int(child)
+                        children.append(child + node_offset if child >= 0 else ~(~child + leaf_offset))
+            leaf_value.extend(leaves)
+
+        decision_type = np.array(decision_type, dtype=np.int64)
+        threshold = np.array(threshold, dtype=np.float64)
+        default_left = (decision_type & DEFAULT_LEFT_MASK) > 0
+        missing_type = (decision_type >> 2) & 3
+        self.roots = np.array(roots, dtype=np.int64)
+        self.split_feature = np.array(split_feature, dtype=np.int64)
+        self.threshold = threshold
+        # the children of node i are at 2 * i (left) and 2 * i + 1 (right)
+        self.children = np.stack([left_child, right_child], axis=1).ravel().astype(np.int64)
+        self.leaf_value = np.array(leaf_value, dtype=np.float64)
+        # which way zeros and nans go at each node. nans are zeros
+        # unless the split has a direction for missing values
+        self.zero_left = np.where(missing_type == MISSING_ZERO, default_left, 0 <= threshold)
+        self.nan_left = np.where(missing_type == MISSING_NAN, default_left, self.zero_left)
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def _leaves(self, X):
+        # which leaf each row ends up in, for every tree
+        n_trees, n_features = self.n_trees, X.shape[1]
+        X = X.ravel()
+        nodes = np.tile(self.roots, len(X) // n_features)
+        active = np.flatnonzero(nodes >= 0)
+        while len(active) > 0:
+            node = nodes[active]
+            x = X[(active // n_trees) * n_features + self.split_feature[node]]
+            go_left = x <= self.threshold[node]
+            is_zero = np.abs(x) <= ZERO_THRESHOLD
+            if is_zero.any():
+                go_left[is_zero] = self.zero_left[node[is_zero]]
+            is_nan = np.isnan(x)
+            if is_nan.any():
+                go_left[is_nan] = self.nan_left[node[is_nan]]
+            node = self.children[2 * node + 1 - go_left]
+            nodes[active] = node
+            active = active[node >= 0]
+        return ~nodes.reshape(-1, n_trees)
+
+    def predict(self, X):
+        """The raw scores of rows of features, like lightgbm's predict
+
+        Arguments:
+            X {np.array} -- features, one row per paper
+
+        Returns:
+            scores {np.array} -- one score per row
+        """
+        X = np.ascontiguousarray(X, dtype=self.dtype)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f'expected a matrix with {self.n_features} columns, got shape {X.shape}')
+        scores = np.zeros(len(X))
+        for start in range(0, len(X), self.chunk_size):
+            values = self.leaf_value[self._leaves(X[start:start + self.chunk_size])]
+            # lightgbm adds up the trees one at a time, in order
+            chunk_scores = np.zeros(len(values))
+            for t in range(self.n_trees):
+                chunk_scores += values[:, t]
+            scores[start:start + self.chunk_size] = chunk_scores
+        if self.average_output and self.n_trees > 0:
+            scores /= self.n_trees
+        return scores
+
+    def predict_contrib(self, X):
+        """lightgbm's exact tree contributions (pred_contrib) of rows of features,
+        from a Booster of the same model file
+        """
+        if self._booster is None:
+            try:
+                self._booster = BoosterBackend(self.path)
+            except ImportError as e:
+                raise ImportError("the 'numpy' backend scores without lightgbm, but feature contributions "
+                                  "need lightgbm to be installed") from e
+        return self._booster.predict_contrib(X)
+
+
+BACKENDS = {
+    'pickle': (PickleBackend, 'lightgbm_model.pickle'),
+    'booster': (BoosterBackend, 'lightgbm_model.txt'),
+    'numpy': (NumpyTreeBackend, 'lightgbm_model.txt'),
+}
+
+
+def load_backend(data_dir, backend='pickle', **options):
+    """Load the ranking model of data_dir for one of the inference backends
+
+    Arguments:
+        data_dir {str} -- where the model files live
+        backend {str} -- one of the keys of BACKENDS
+        options -- passed on to the backend, e.g. num_threads or dtype
+
+    Returns:
+        model -- an object with a predict(X) method
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'backend should be one of {sorted(BACKENDS)}, not {backend!r}')
+    backend_class, filename = BACKENDS[backend]
+    path = os.path.join(data_dir, filename)
+    if not os.path.exists(path) and filename == 'lightgbm_model.txt':
+        raise FileNotFoundError(f'{path} does not exist. create it with s2search.backends.export_model')
+    return backend_class(path, **options)
+
+
+def export_model(data_dir):
+    """Offline step to write the pickled model of data_dir out as a lightgbm
+    text model file, which the 'booster' and 'numpy' backends load.
+
+    Arguments:
+        data_dir {str} -- where lightgbm_model.pickle lives
+
+    Returns:
+        path {str} -- the text model file
+    """
+    with open(os.path.join(data_dir, 'lightgbm_model.pickle'), 'rb') as f:
+        model = pickle.load(f)
+    booster = getattr(model, 'booster_', model)
+    path = os.path.join(data_dir, 'lightgbm_model.txt')
+    booster.save_model(path)
+    return path
@@ -0,0 +1,315 @@
+"""Batch scoring of JSONL files of papers, e.g. for offline experiments over many
+files with millions of papers each.
+
+The ranker is loaded once, and records are streamed from each file in chunks of
+bounded size. Every file gets its own output and checkpoint in the output
+directory, so files can be scored in parallel and a job that is killed part of
+the way through picks up where it stopped when it is run again.
+
+    python -m s2search.batch --data-dir s2search/ --output-dir scores/ --query 'machine learning' papers/*.jsonl
+
+The scores of papers/foo.jsonl end up in scores/foo.npy, in the same order as
+its records. Outputs are named after the files' paths relative to the directory
+they are all in, so papers/a/foo.jsonl and papers/b/foo.jsonl go to
+scores/a__foo.npy and scores/b__foo.npy. While a file is being scored, the scores so far are appended to
+scores/foo.scores.f8, which can be read with np.memmap(..., dtype=np.float64).
+With posthoc correction these are only final once the file is done, because the
+most common match pattern boost depends on all of the papers of a query.
+
+A checkpoint only counts if the input file has the same size and modification
+time as when it was made, and the job has the same query, query field and
+posthoc correction. Otherwise the file is scored again from the start.
+"""
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+from s2search.rank import S2Ranker
+from s2search.features import CompiledQuery, FEATURE_NAMES, _posthoc_row_adjust, posthoc_pattern_boost
+
+# the ranker that the file workers use. it is set right before
+# the workers are forked so that they inherit the loaded models
+_batch_ranker = None
+
+
+def iter_jsonl_chunks(path, chunk_size, offset=0):
+    """Stream the records of a JSONL file in chunks
+
+    Arguments:
+        path {str} -- the JSONL file
+        chunk_size {int} -- the most records per chunk
+        offset {int} -- byte offset in the file to start from
+
+    Returns:
+        chunks {generator} -- (records, offset after the last of them)
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        records = []
+        while True:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            line = line.strip()
+            if len(line) > 0:
+                records.append(json.loads(line, strict=False))
+            if len(records) == chunk_size:
+                yield records, f.tell()
+                records = []
+        if len(records) > 0:
+            yield records, f.tell()
+
+
+def output_prefix(path, output_dir, root=None):
+    """Where the outputs of a file go, without an extension
+
+    Arguments:
+        path {str} -- the JSONL file
+        output_dir {str} -- the output directory
+        root {str} -- if given, the output is named after the path relative to root, with
+                      '__' for os.sep, so that files with the same name in different
+                      directories get different outputs. otherwise after the file's name
+
+    Returns:
+        prefix {str} -- the path of the outputs, without an extension
+    """
+    if root is None:
+        name = os.path.basename(path)
+    else:
+        name = os.path.relpath(os.path.abspath(path), root).replace(os.sep, '__')
+    for extension in ('.jsonl', '.json'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return os.path.join(output_dir, name)
+
+
+def _write_json(path, obj):
+    # write and rename, so that a crash never leaves half of a checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _append(f, array):
+    f.write(np.ascontiguousarray(array).tobytes())
+
+
+class FileScorer:
+    """Scores one JSONL file of papers into `<prefix>.npy`, checkpointing after every chunk.
+
+    Arguments:
+        ranker {S2Ranker} -- the ranker
+        path {str} -- the JSONL file, one paper per line
+        prefix {str} -- where the outputs go, without an extension
+        query {str} -- the query of the papers that don't have their own
+        query_field {str} -- the record field that holds a paper's own query, if it has one
+        chunk_size {int} -- how many records to featurize and predict at a time
+    """
+    def __init__(self, ranker, path, prefix, query=None, query_field='query', chunk_size=1000):
+        self.ranker = ranker
+        self.path = path
+        self.prefix = prefix
+        self.query = query
+        self.query_field = query_field
+        self.chunk_size = chunk_size
+        self.checkpoint_path = prefix + '.checkpoint.json'
+        # per row: the score so far, the posthoc match pattern and cutoff flag, and which query it's for
+        self.row_files = {
+            'scores': (prefix + '.scores.f8', np.float64),
+            'posthoc': (prefix + '.posthoc.u1', np.uint8),
+            'query': (prefix + '.query.i4', np.int32),
+        }
+        self.compiled_queries = {}
+
+    def settings(self):
+        """What the scores depend on besides the ranker's models: the input file as it
+        is now, the queries and the posthoc correction
+        """
+        stat = os.stat(self.path)
+        return {
+            'input': os.path.abspath(self.path),
+            'input_size': stat.st_size,
+            'input_mtime_ns': stat.st_mtime_ns,
+            'query': self.query,
+            'query_field': self.query_field,
+            'use_posthoc_correction': self.ranker.use_posthoc_correction,
+        }
+
+    def load_checkpoint(self):
+        settings = self.settings()
+        new_checkpoint = dict(settings, offset=0, n_records=0, queries=[], done=False)
+        if not os.path.exists(self.checkpoint_path):
+            return new_checkpoint
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['input'] != settings['input']:
+            raise ValueError(f"{self.checkpoint_path} is for {checkpoint['input']}, not {self.path}")
+        if any(checkpoint.get(key) != value for key, value in settings.items()):
+            # the input changed or the job was run with other settings, so the file is scored
+            # from the start. the old scores are removed so they can't be mistaken for new ones
+            if os.path.exists(self.prefix + '.npy'):
+                os.remove(self.prefix + '.npy')
+            return new_checkpoint
+        return checkpoint
+
+    def record_query(self, record):
+        query = record.get(self.query_field, self.query) if self.query_field is not None else self.query
+        if query is None:
+            raise ValueError(f'a record of {self.path} has no {self.query_field!r} and there is no query for the file')
+        return str(query)
+
+    def score_chunk(self, records, query_ids, queries):
+        """Featurize and predict a chunk, with the row-wise part of the posthoc correction
+        """
+        X = np.zeros((len(records), len(FEATURE_NAMES)), dtype=self.ranker.feature_dtype)
+        for query_id in np.unique(query_ids):
+            rows = np.flatnonzero(query_ids == query_id)
+            query = queries[query_id]
+            if query not in self.compiled_queries:
+                self.compiled_queries[query] = CompiledQuery(query, self.ranker.lms, recorder=self.ranker.metrics)
+            X[rows] = self.ranker.featurize(
+                query, [records[i] for i in rows], parallel=False, compiled_query=self.compiled_queries[query]
+            )
+        scores = self.ranker.model.predict(X)
+        posthoc = np.zeros(len(records), dtype=np.uint8)
+        if self.ranker.use_posthoc_correction:
+            long_query = np.array([len(query.split(' ')) > 1 for query in queries])[query_ids]
+            has_quotes = np.array(['"' in query for query in queries])[query_ids]
+            scores, qualifying, pattern = _posthoc_row_adjust(scores, X, long_query, has_quotes)
+            posthoc = (pattern + 16 * qualifying).astype(np.uint8)
+        return scores, posthoc
+
+    def run(self):
+        """Score the file, starting from the last checkpoint if there is one
+
+        Returns:
+            path {str} -- the .npy file of scores
+        """
+        checkpoint = self.load_checkpoint()
+        if checkpoint['done']:
+            return self.prefix + '.npy'
+        queries = checkpoint['queries']
+        query_index = {query: i for i, query in enumerate(queries)}
+
+        files = {}
+        try:
+            for name, (path, dtype) in self.row_files.items():
+                files[name] = open(path, 'ab')
+                # anything after the checkpoint was written by a chunk that didn't finish
+                files[name].truncate(checkpoint['n_records'] * np.dtype(dtype).itemsize)
+            for records, offset in iter_jsonl_chunks(self.path, self.chunk_size, checkpoint['offset']):
+                query_ids = []
+                for record in records:
+                    query = self.record_query(record)
+                    if query not in query_index:
+                        query_index[query] = len(queries)
+                        queries.append(query)
+                    query_ids.append(query_index[query])
+                query_ids = np.array(query_ids, dtype=np.int32)
+                scores, posthoc = self.score_chunk(records, query_ids, queries)
+                _append(files['scores'], scores.astype(np.float64))
+                _append(files['posthoc'], posthoc)
+                _append(files['query'], query_ids)
+                for f in files.values():
+                    f.flush()
+                    os.fsync(f.fileno())
+                checkpoint.update(offset=offset, n_records=checkpoint['n_records'] + len(records), queries=queries)
+                _write_json(self.checkpoint_path, checkpoint)
+        finally:
+            for f in files.values():
+                f.close()
+
+        self.finish(checkpoint)
+        return self.prefix + '.npy'
+
+    def finish(self, checkpoint):
+        # the part of the posthoc correction that needs all of the rows of each query
+        n = checkpoint['n_records']
+        rows = {}
+        for name, (path, dtype) in self.row_files.items():
+            rows[name] = np.fromfile(path, dtype=dtype, count=n)
+        scores = rows['scores']
+        if self.ranker.use_posthoc_correction and n > 0:
+            queries = checkpoint['queries']
+            long_query = np.array([len(query.split(' ')) > 1 for query in queries])
+            scores = posthoc_pattern_boost(scores, (rows['posthoc'] & 16) > 0, rows['posthoc'] & 15,
+                                           rows['query'].astype(np.int64), long_query)
+        with open(self.prefix + '.npy.tmp', 'wb') as f:
+            np.save(f, scores)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.prefix + '.npy.tmp', self.prefix + '.npy')
+        checkpoint['done'] = True
+        _write_json(self.checkpoint_path, checkpoint)
+        for path, _ in self.row_files.values():
+            os.remove(path)
+
+
+def _score_file(args):
+    path, prefix, query, query_field, chunk_size = args
+    return FileScorer(_batch_ranker, path, prefix, query, query_field, chunk_size).run()
+
+
+def score_files(ranker, paths, output_dir, query=None, queries=None, query_field='query', chunk_size=1000, n_workers=1):
+    """Score many JSONL files of papers, resuming from the checkpoints of an earlier run
+
+    Arguments:
+        ranker {S2Ranker} -- the ranker, which is shared by all of the workers
+        paths {list of str} -- the JSONL files
+        output_dir {str} -- where the outputs and checkpoints go
+        query {str} -- the query for papers that don't have their own
+        queries {dict} -- optionally, a query per file, by path
+        query_field {str} -- the record field that holds a paper's own query
+        chunk_size {int} -- how many records to featurize and predict at a time
+        n_workers {int} -- how many files to score at the same time, in forked processes
+
+    Returns:
+        outputs {list of str} -- the .npy file of scores of each file
+    """
+    global _batch_ranker
+    os.makedirs(output_dir, exist_ok=True)
+    queries = queries or {}
+    # outputs are named after the paths relative to the directory all of the files are in
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else None
+    prefixes = [output_prefix(path, output_dir, root) for path in paths]
+    if len(set(prefixes)) < len(prefixes):
+        raise ValueError('two of the files would have the same outputs, e.g. foo.json and foo.jsonl in one directory')
+    jobs = [(path, prefix, queries.get(path, query), query_field, chunk_size) for path, prefix in zip(paths, prefixes)]
+
+    _batch_ranker = ranker
+    if n_workers <= 1 or len(jobs) <= 1:
+        return [_score_file(job) for job in jobs]
+    with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+        return pool.map(_score_file, jobs, chunksize=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('paths', nargs='+', help='JSONL files of papers')
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--query', help='the query for papers that do not have their own')
+    parser.add_argument('--queries', help='a JSON file that maps file paths to their queries')
+    parser.add_argument('--query-field', default='query', help='the record field that holds its own query')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--n-workers', type=int, default=1)
+    parser.add_argument('--no-posthoc-correction', action='store_true')
+    args = parser.parse_args()
+
+    queries = None
+    if args.queries is not None:
+        with open(args.queries) as f:
+            queries = json.load(f)
+    ranker = S2Ranker(args.data_dir, use_posthoc_correction=not args.no_posthoc_correction)
+    outputs = score_files(ranker, args.paths, args.output_dir, args.query, queries, args.query_field,
+                          args.chunk_size, args.n_workers)
+    for path, output in zip(args.paths, outputs):
+        print(path, '->', output)
+
+
+if __name__ == '__main__':
+    main()
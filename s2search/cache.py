@@ -0,0 +1,244 @@
+import os
+import json
+import pickle
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A bounded in-process cache that evicts the least recently used entries.
+
+    Arguments:
+        maxsize {int} -- the most entries to keep
+    """
+    def __init__(self, maxsize=1000000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SQLiteCache:
+    """A persistent key-value store in a SQLite file. Any number of processes
+    (e.g. gunicorn workers) can read and write the same file concurrently.
+    Keys are strings and values are pickled.
+
+    Arguments:
+        path {str} -- the SQLite file, which is created if it doesn't exist
+        table {str} -- the table to keep the entries in
+    """
+    def __init__(self, path, table='cache'):
+        self.path = path
+        self.table = table
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared across a fork, so each process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value BLOB)')
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def get_many(self, keys):
+        """Look up several keys at once. Missing keys are left out of the result.
+        """
+        if len(keys) == 0:
+            return {}
+        with self.lock:
+            found = {}
+            # sqlite limits the number of parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.conn.execute(
+                    f'SELECT key, value FROM {self.table} WHERE key IN ({",".join("?" * len(chunk))})', chunk
+                ).fetchall()
+                found.update((key, pickle.loads(value)) for key, value in rows)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def put_many(self, items):
+        """Store several (key, value) pairs in one transaction.
+        """
+        items = [(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)) for key, value in items]
+        if len(items) == 0:
+            return
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)', items)
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class LMScoreCache:
+    """Language model scores keyed by (model, string), in a bounded LRU tier
+    and optionally a shared SQLite tier behind it. A single instance can be
+    shared by all of the language models of an S2Ranker.
+
+    Arguments:
+        maxsize {int} -- the most scores to keep in memory
+        path {str} -- a SQLite file for the shared tier, or None to keep
+                      scores in memory only
+    """
+    def __init__(self, maxsize=1000000, path=None):
+        self.memory = LRUCache(maxsize)
+        self.shared = None if path is None else SQLiteCache(path, table='lm_scores')
+
+    @staticmethod
+    def make_key(model_name, s):
+        return f'{model_name}\t{s}'
+
+    def get_many(self, model_name, strings):
+        """The cached scores of strings under model_name. Missing strings are left out.
+        """
+        found = {}
+        missing = []
+        for s in strings:
+            value = self.memory.get(self.make_key(model_name, s))
+            if value is None:
+                missing.append(s)
+            else:
+                found[s] = value
+        if self.shared is not None and len(missing) > 0:
+            from_shared = self.shared.get_many([self.make_key(model_name, s) for s in missing])
+            for s in missing:
+                key = self.make_key(model_name, s)
+                if key in from_shared:
+                    found[s] = from_shared[key]
+                    self.memory.put(key, from_shared[key])
+        return found
+
+    def put_many(self, model_name, items):
+        """Store (string, score) pairs for model_name in both tiers.
+        """
+        items = [(self.make_key(model_name, s), value) for s, value in items]
+        for key, value in items:
+            self.memory.put(key, value)
+        if self.shared is not None:
+            self.shared.put_many(items)
+
+    def stats(self):
+        """Hit, miss and eviction counters, for sizing the cache
+        """
+        stats = {'memory': self.memory.stats()}
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
+
+
+class PreparedPaperCache(LRUCache):
+    """The prepared text fields of papers (see `S2Ranker.prepare_text`), so that
+    papers which show up for many queries are only cleaned once. Papers are keyed
+    by their id or, if they don't have one, by a hash of their text fields.
+    Note that this means a paper whose text changes needs a new id.
+
+    Arguments:
+        maxsize {int} -- the most papers to keep
+        id_field {str} -- the paper field that holds a stable paper id
+    """
+    TEXT_FIELDS = ('title', 'abstract', 'venue', 'authors')
+
+    def __init__(self, maxsize=100000, id_field='id'):
+        super().__init__(maxsize)
+        self.id_field = id_field
+
+    def make_key(self, paper):
+        paper_id = paper.get(self.id_field)
+        if paper_id is not None:
+            return f'id:{paper_id}'
+        content = json.dumps([paper.get(field) for field in self.TEXT_FIELDS], default=str)
+        return 'sha1:' + hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get_or_prepare(self, paper, prepare):
+        """The cached value for paper, computing it with prepare(paper) if needed
+        """
+        key = self.make_key(paper)
+        value = self.get(key)
+        if value is None:
+            value = prepare(paper)
+            self.put(key, value)
+        return value
+
+    def save(self, path):
+        """Save the cache to a file, e.g. before a worker restarts
+        """
+        with self.lock:
+            items = list(self.data.items())
+        with open(path, 'wb') as f:
+            pickle.dump({'id_field': self.id_field, 'items': items}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        """Add the papers from a file written by `save`. If there are more than
+        maxsize of them, the most recently used ones are kept.
+        """
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['id_field'] != self.id_field:
+            raise ValueError(f"the saved cache is keyed by {saved['id_field']!r}, not {self.id_field!r}")
+        for key, value in saved['items']:
+            self.put(key, value)
@@ -0,0 +1,240 @@
+"""A compact stand-in for the kenlm language models. Featurization only ever
+scores n-grams of the query (see `CompiledQuery`), so a table of the log-probs
+of the n-grams of a query log, plus the unigrams of a corpus, covers almost
+every call at a small fraction of the models' memory. N-grams that aren't in
+the table are estimated with a backoff, so they are approximate.
+
+Build the table once with the full models:
+
+    python -m s2search.compact_lm --data-dir s2search/ --queries queries.txt --papers papers.jsonl --output lm_table/
+
+and then use it in place of the models with `S2Ranker(data_dir, lm_table='lm_table/')`.
+"""
+import os
+import json
+import hashlib
+import argparse
+import collections
+import numpy as np
+from s2search.lm import score_prefixes
+from s2search.features import CompiledQuery
+
+FORMAT_VERSION = 1
+UNKNOWN_WORD = '<unk>'
+
+
+def hash_ngram(s):
+    """The 64-bit key of a string in the table. Collisions are possible but
+    so unlikely at this size that they are ignored.
+    """
+    return int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _unigram_backoffs(lm, words, unknown_log_prob):
+    # kenlm has no unigram model of its own, so p(<unk> | word) = backoff(word) + p(<unk>)
+    # gives the backoff weight of each word
+    backoffs = np.zeros(len(words), dtype=np.float32)
+    for i, word in enumerate(words):
+        with_unknown = score_prefixes(lm, [word, UNKNOWN_WORD])
+        backoffs[i] = with_unknown[1] - with_unknown[0] - unknown_log_prob
+    return backoffs
+
+
+def build_compact_lm(lms, path, queries=(), texts=(), min_count=1, max_ngram_len=7):
+    """Build a compact log-prob table from the full language models.
+
+    The table has every string that featurizing the queries scores, with the
+    exact log-probs of the models, and every word of texts that appears at
+    least min_count times. Each word also gets its backoff weight, which is
+    what estimates the n-grams that aren't in the table.
+
+    Arguments:
+        lms {tuple} -- the title/abstract, author and venue language models (see LM_NAMES)
+        path {str} -- the table directory, which is created if needed
+        queries {iterable of str} -- the queries to cover, e.g. a query log
+        texts {iterable of str} -- cleaned text (see `S2Ranker.prepare_text`) whose words to add
+        min_count {int} -- how many times a word of texts needs to appear to be added
+        max_ngram_len {int} -- longest query n-grams, like CompiledQuery's
+
+    Returns:
+        n_entries {int} -- how many strings the table has
+    """
+    entries = {}
+    n_queries = 0
+    for query in queries:
+        compiled_query = CompiledQuery(query, lms, max_ngram_len=max_ngram_len)
+        for s, log_probs in compiled_query.log_probs.table.items():
+            entries[s] = log_probs[:3]
+        n_queries += 1
+
+    counts = collections.Counter()
+    for text in texts:
+        counts.update(text.split())
+    words = [word for word, count in counts.items() if count >= min_count and word not in entries]
+    for word in words:
+        entries[word] = tuple(score_prefixes(lm, [word])[0] for lm in lms)
+
+    unknown_log_probs = [score_prefixes(lm, [UNKNOWN_WORD])[0] for lm in lms]
+    strings = list(entries)
+    keys = np.array([hash_ngram(s) for s in strings], dtype=np.uint64)
+    log_probs = np.array([entries[s] for s in strings], dtype=np.float32).reshape(len(strings), len(lms))
+    backoffs = np.zeros((len(strings), len(lms)), dtype=np.float32)
+    unigrams = np.array([' ' not in s for s in strings], dtype=bool)
+    for j, lm in enumerate(lms):
+        backoffs[unigrams, j] = _unigram_backoffs(lm, [s for s in strings if ' ' not in s], unknown_log_probs[j])
+
+    order = np.argsort(keys)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'keys.npy'), keys[order])
+    np.save(os.path.join(path, 'log_probs.npy'), log_probs[order])
+    np.save(os.path.join(path, 'backoffs.npy'), backoffs[order])
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'n_entries': len(strings),
+        'n_queries': n_queries,
+        'n_words': len(words),
+        'max_ngram_len': max_ngram_len,
+        'unknown_log_probs': [float(p) for p in unknown_log_probs],
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return len(strings)
+
+
+class CompactLanguageModelTable:
+    """A table written by `build_compact_lm`. The arrays are memory-mapped, so
+    processes share one copy of it.
+
+    Arguments:
+        path {str} -- the table directory
+        mmap {bool} -- whether to memory-map the arrays or read them into memory
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"unsupported table format version {self.meta['format_version']}")
+        mmap_mode = 'r' if mmap else None
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode=mmap_mode)
+        self.log_probs = np.load(os.path.join(path, 'log_probs.npy'), mmap_mode=mmap_mode)
+        self.backoffs = np.load(os.path.join(path, 'backoffs.npy'), mmap_mode=mmap_mode)
+        self.unknown_log_probs = np.array(self.meta['unknown_log_probs'], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.log_probs.nbytes + self.backoffs.nbytes
+
+    def find(self, s):
+        """The row of s in the table, or -1 if it isn't there
+        """
+        key = np.uint64(hash_ngram(s))
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def models(self):
+        """One language model per column, in the order of LM_NAMES
+        """
+        return tuple(CompactLanguageModel(self, column) for column in range(len(self.unknown_log_probs)))
+
+
+class CompactLanguageModel:
+    """One of the language models of a `CompactLanguageModelTable`, with the
+    part of kenlm's interface that featurization uses. Strings without
+    sentence boundaries are scored exactly if they are in the table. Otherwise,
+    each word past the longest prefix that is in the table is scored as the
+    backoff weight of the word before it plus its own log-prob (the log-prob of
+    <unk> if it isn't in the table either), which is what kenlm does when only
+    unigrams are known.
+
+    Arguments:
+        table {CompactLanguageModelTable} -- the table
+        column {int} -- which language model of the table
+    """
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+    def _unigram(self, word):
+        i = self.table.find(word)
+        if i < 0:
+            return self.table.unknown_log_probs[self.column], np.float32(0)
+        return self.table.log_probs[i, self.column], self.table.backoffs[i, self.column]
+
+    def score_prefixes(self, words):
+        """The log10 probability of every prefix of words, like `s2search.lm.score_prefixes`
+        """
+        # accumulated in a float like kenlm does
+        total = np.float32(0)
+        backoff = np.float32(0)
+        scores = []
+        for n, word in enumerate(words, 1):
+            log_prob, next_backoff = self._unigram(word)
+            i = self.table.find(' '.join(words[:n])) if n > 1 else -1
+            if i >= 0:
+                total = self.table.log_probs[i, self.column]
+            else:
+                total = np.float32(total + np.float32(backoff + log_prob))
+            backoff = next_backoff
+            scores.append(float(total))
+        return scores
+
+    def score(self, sentence, bos=True, eos=True):
+        if bos or eos:
+            raise ValueError('the compact table only has scores without sentence boundaries')
+        words = sentence.split()
+        if len(words) == 0:
+            return 0.0
+        return self.score_prefixes(words)[-1]
+
+
+def load_compact_lms(path, mmap=True):
+    """The language models of a table written by `build_compact_lm`, in the order of LM_NAMES
+    """
+    return CompactLanguageModelTable(path, mmap).models()
+
+
+def _read_lines(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)['query'] if path.endswith('.jsonl') else line
+
+
+def _paper_texts(path):
+    from s2search.rank import S2Ranker
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                prepared = S2Ranker.prepare_text(json.loads(line))
+                yield prepared['paper_title_cleaned']
+                yield prepared['paper_abstract_cleaned']
+                yield prepared['paper_venue_cleaned']
+                yield from prepared['author_name']
+
+
+def main():
+    from s2search.rank import S2Ranker
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', required=True, help='where the full language models live')
+    parser.add_argument('--queries', required=True, help='a file with one query per line, or a JSONL file of {"query": ...}')
+    parser.add_argument('--papers', help='a JSONL file of papers whose words to add')
+    parser.add_argument('--min-count', type=int, default=2, help='how many times a word of the papers needs to appear')
+    parser.add_argument('--output', required=True, help='the table directory')
+    args = parser.parse_args()
+
+    ranker = S2Ranker(args.data_dir, lm_load_method='lazy')
+    texts = _paper_texts(args.papers) if args.papers else ()
+    n_entries = build_compact_lm(ranker.lms, args.output, _read_lines(args.queries), texts, args.min_count)
+    table = CompactLanguageModelTable(args.output)
+    print(f'{n_entries} entries, {table.nbytes / 2 ** 20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
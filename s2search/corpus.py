@@ -0,0 +1,321 @@
+import os
+import json
+import numpy as np
+from s2search.rank import S2Ranker
+from s2search.features import STATIC_FEATURE_NAMES, make_static_features, now
+
+
+# version 1 corpora have no static features, which are then computed when featurizing
+FORMAT_VERSION = 2
+SUPPORTED_FORMAT_VERSIONS = [1, 2]
+TEXT_COLUMNS = {
+    'paper_title_cleaned': 'title',
+    'paper_abstract_cleaned': 'abstract',
+    'paper_venue_cleaned': 'venue',
+}
+NUMERIC_COLUMNS = ['paper_year', 'n_citations', 'n_key_citations']
+
+
+def _year_to_float(year):
+    # featurization only ever uses int(year), so that's all we keep
+    try:
+        return float(int(year))
+    except:
+        return np.nan
+
+
+class CorpusWriter:
+    """Writes papers into a columnar corpus directory, one paper at a time.
+    Text fields are cleaned with `S2Ranker.prepare_result` as they are added
+    and stored as utf-8 bytes plus offsets; numbers are stored as float64.
+    The features that only depend on the paper (STATIC_FEATURE_NAMES) are
+    stored too, as one float64 row per paper.
+
+    Arguments:
+        path {str} -- the corpus directory, which is created if needed
+        id_field {str} -- the paper field that holds the paper id, if any
+    """
+    def __init__(self, path, id_field='id'):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.id_field = id_field
+        self.n_papers = 0
+        self.n_authors = 0
+        self.text_sizes = {column: 0 for column in list(TEXT_COLUMNS) + ['author_name', 'paper_id']}
+        self.files = {}
+        for column in list(TEXT_COLUMNS) + ['author_name', 'paper_id']:
+            self.files[f'{column}.data'] = open(os.path.join(path, f'{column}.data'), 'wb')
+            self.files[f'{column}.offsets'] = open(os.path.join(path, f'{column}.offsets'), 'wb')
+            self.files[f'{column}.offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+        self.files['paper_authors.offsets'] = open(os.path.join(path, 'paper_authors.offsets'), 'wb')
+        self.files['paper_authors.offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+        for column in NUMERIC_COLUMNS + ['static_features']:
+            self.files[column] = open(os.path.join(path, column), 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_text(self, column, text):
+        encoded = text.encode('utf-8')
+        self.files[f'{column}.data'].write(encoded)
+        self.text_sizes[column] += len(encoded)
+        self.files[f'{column}.offsets'].write(np.int64(self.text_sizes[column]).tobytes())
+
+    def add(self, paper):
+        """Add one raw paper (a dict like the ones `S2Ranker.score` takes)
+        """
+        prepared = S2Ranker.prepare_result(paper)
+        for column in TEXT_COLUMNS:
+            self._write_text(column, prepared[column])
+        for author in prepared['author_name']:
+            self._write_text('author_name', author)
+        self.n_authors += len(prepared['author_name'])
+        self.files['paper_authors.offsets'].write(np.int64(self.n_authors).tobytes())
+        paper_id = paper.get(self.id_field)
+        self._write_text('paper_id', '' if paper_id is None else str(paper_id))
+        self.files['paper_year'].write(np.float64(_year_to_float(prepared['paper_year'])).tobytes())
+        self.files['n_citations'].write(np.float64(prepared['n_citations']).tobytes())
+        self.files['n_key_citations'].write(np.float64(prepared['n_key_citations']).tobytes())
+        self.files['static_features'].write(np.array(make_static_features(prepared), dtype=np.float64).tobytes())
+        self.n_papers += 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'n_papers': self.n_papers,
+            'n_authors': self.n_authors,
+            'id_field': self.id_field,
+            # the year that the oldness features are relative to
+            'static_features_year': now.year,
+        }
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+def build_corpus(papers, path, id_field='id'):
+    """Offline step to write papers into a columnar corpus that `Corpus` can mmap.
+
+    Arguments:
+        papers {iterable of dicts} -- raw papers, e.g. streamed from a JSONL file
+        path {str} -- the corpus directory
+        id_field {str} -- the paper field that holds the paper id, if any
+
+    Returns:
+        n_papers {int} -- the number of papers written
+    """
+    with CorpusWriter(path, id_field) as writer:
+        for paper in papers:
+            writer.add(paper)
+    return writer.n_papers
+
+
+class CorpusRow:
+    """A read-only view of one prepared paper in a `Corpus`. It can be passed to
+    `make_paper_features` in place of the dict from `S2Ranker.prepare_result`, and
+    fields are only decoded when they are accessed.
+    """
+    __slots__ = ('corpus', 'index')
+
+    def __init__(self, corpus, index):
+        self.corpus = corpus
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.corpus.get(self.index, key)
+
+    def keys(self):
+        return list(TEXT_COLUMNS) + ['author_name'] + NUMERIC_COLUMNS
+
+
+class Corpus:
+    """A columnar corpus of prepared papers written by `build_corpus`. The
+    columns are memory-mapped, so many processes can share one copy of the
+    corpus and papers are never held in memory as dicts.
+
+    Arguments:
+        path {str} -- the corpus directory
+        mmap {bool} -- whether to memory-map the columns or read them into memory
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap = mmap
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] not in SUPPORTED_FORMAT_VERSIONS:
+            raise ValueError(f"unsupported corpus format version {self.meta['format_version']}")
+        self.n_papers = self.meta['n_papers']
+        self.columns = {}
+        for column in list(TEXT_COLUMNS) + ['author_name', 'paper_id']:
+            self.columns[f'{column}.data'] = self._load(f'{column}.data', np.uint8)
+            self.columns[f'{column}.offsets'] = self._load(f'{column}.offsets', np.int64)
+        self.columns['paper_authors.offsets'] = self._load('paper_authors.offsets', np.int64)
+        for column in NUMERIC_COLUMNS:
+            self.columns[column] = self._load(column, np.float64)
+        if self.meta['format_version'] >= 2:
+            self.columns['static_features'] = self._load('static_features', np.float64).reshape(
+                self.n_papers, len(STATIC_FEATURE_NAMES)
+            )
+        self._id_to_row = None
+
+    def _load(self, name, dtype):
+        filename = os.path.join(self.path, name)
+        if os.path.getsize(filename) == 0:
+            return np.zeros(0, dtype=dtype)
+        if self.mmap:
+            return np.memmap(filename, dtype=dtype, mode='r')
+        return np.fromfile(filename, dtype=dtype)
+
+    # only the path is pickled, so a corpus is cheap to send to worker processes
+    def __getstate__(self):
+        return {'path': self.path, 'mmap': self.mmap}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['mmap'])
+
+    def __len__(self):
+        return self.n_papers
+
+    def _text(self, column, i):
+        offsets = self.columns[f'{column}.offsets']
+        return bytes(self.columns[f'{column}.data'][offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def get(self, i, key):
+        """The value of one prepared field for paper i
+        """
+        if key in TEXT_COLUMNS:
+            return self._text(key, i)
+        elif key == 'author_name':
+            paper_authors = self.columns['paper_authors.offsets']
+            return [self._text('author_name', j) for j in range(paper_authors[i], paper_authors[i + 1])]
+        elif key in NUMERIC_COLUMNS:
+            return self.columns[key][i]
+        raise KeyError(key)
+
+    def row(self, i):
+        """A view of paper i that can be featurized like a prepared paper
+        """
+        if not -self.n_papers <= i < self.n_papers:
+            raise IndexError(f'paper {i} is out of range for a corpus of {self.n_papers} papers')
+        return CorpusRow(self, i % self.n_papers)
+
+    def paper_id(self, i):
+        return self._text('paper_id', i)
+
+    @property
+    def has_static_features(self):
+        """Whether the stored static features can be used, which needs them to be
+        relative to the current year. See `refresh_static_features` otherwise.
+        """
+        return 'static_features' in self.columns and self.meta.get('static_features_year') == now.year
+
+    def static_features(self, rows):
+        """The stored STATIC_FEATURE_NAMES of some papers
+
+        Arguments:
+            rows {list of int} -- the rows of the papers
+
+        Returns:
+            static_features {np.array} -- one row per paper, or None if they can't be used
+        """
+        if not self.has_static_features:
+            return None
+        return self.columns['static_features'][np.asarray(rows, dtype=np.int64)]
+
+    @property
+    def id_to_row(self):
+        """Maps paper ids to rows. Built on first use. Papers that were written
+        without an id are stored with '', which isn't in the map, so they can't
+        be looked up by id.
+        """
+        if self._id_to_row is None:
+            paper_ids = (self.paper_id(i) for i in range(self.n_papers))
+            self._id_to_row = {paper_id: i for i, paper_id in enumerate(paper_ids) if paper_id != ''}
+        return self._id_to_row
+
+
+def _static_features_of_columns(oldness, n_citations, n_key_citations):
+    # the last three static features, vectorized. the same as `make_static_features`
+    # since oldness + 1 is exact and the division is the same
+    return np.stack([
+        n_citations,
+        n_key_citations,
+        np.where(np.isnan(oldness), np.nan, n_citations / (oldness + 1)),
+    ], axis=1)
+
+
+def update_citations(path, paper_ids, n_citations, n_key_citations=None):
+    """Rewrite the citation counts of some papers of a corpus in place, along with
+    the static features that depend on them. Nothing else is touched, so this is
+    cheap enough to run whenever new counts arrive. Processes that have the corpus
+    memory-mapped see the new counts, but may see some of them before others
+    while this runs.
+
+    Arguments:
+        path {str} -- the corpus directory
+        paper_ids {list} -- the ids of the papers to update. ids that aren't in the corpus are skipped
+        n_citations {list of int} -- the new citation count of each paper
+        n_key_citations {list of int} -- the new key citation count of each paper. if None,
+                                         it is estimated from n_citations like in `S2Ranker.prepare_result`
+
+    Returns:
+        n_updated {int} -- how many papers were updated
+    """
+    corpus = Corpus(path)
+    n_citations = np.asarray(n_citations, dtype=np.float64)
+    if n_key_citations is None:
+        n_key_citations = np.maximum(np.trunc(-1.4 + np.log1p(n_citations)), 0)
+    n_key_citations = np.asarray(n_key_citations, dtype=np.float64)
+    rows = np.array([corpus.id_to_row.get(str(paper_id), -1) for paper_id in paper_ids], dtype=np.int64)
+    found = rows >= 0
+    rows, n_citations, n_key_citations = rows[found], n_citations[found], n_key_citations[found]
+    if len(rows) == 0:
+        return 0
+
+    for column, values in [('n_citations', n_citations), ('n_key_citations', n_key_citations)]:
+        array = np.memmap(os.path.join(path, column), dtype=np.float64, mode='r+')
+        array[rows] = values
+        array.flush()
+    if corpus.meta['format_version'] >= 2:
+        if corpus.meta.get('static_features_year') != now.year:
+            # every oldness is out of date, so all of the static features are recomputed
+            refresh_static_features(path)
+        else:
+            static = np.memmap(os.path.join(path, 'static_features'), dtype=np.float64, mode='r+')
+            static = static.reshape(corpus.n_papers, len(STATIC_FEATURE_NAMES))
+            static[rows, 2:] = _static_features_of_columns(static[rows, 1], n_citations, n_key_citations)
+            static.flush()
+    return int(len(rows))
+
+
+def refresh_static_features(path):
+    """Recompute all of the static features of a corpus from its other columns,
+    e.g. when the year has changed since they were computed, or to add them to
+    a corpus written before they were stored. Processes that have the corpus
+    open keep using the old static features until they open it again.
+
+    Arguments:
+        path {str} -- the corpus directory
+    """
+    corpus = Corpus(path)
+    columns = corpus.columns
+    year = np.minimum(now.year, columns['paper_year'])  # nan stays nan
+    oldness = now.year - year
+    abstract_lengths = np.diff(columns['paper_abstract_cleaned.offsets'])
+    static = np.empty((corpus.n_papers, len(STATIC_FEATURE_NAMES)), dtype=np.float64)
+    if corpus.n_papers > 0:
+        # the cleaned abstracts are ascii, so bytes are characters
+        static[:, 0] = abstract_lengths > 1
+        static[:, 1] = oldness
+        static[:, 2:] = _static_features_of_columns(oldness, columns['n_citations'], columns['n_key_citations'])
+    # written next to the old files and then swapped in, so that processes that have them open keep working
+    static.tofile(os.path.join(path, 'static_features.tmp'))
+    os.replace(os.path.join(path, 'static_features.tmp'), os.path.join(path, 'static_features'))
+    meta = dict(corpus.meta, format_version=FORMAT_VERSION, static_features_year=now.year)
+    with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
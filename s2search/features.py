@@ -2,9 +2,11 @@ import numpy as np
 import datetime
 import re
 from collections import Counter
-from s2search.text import find_query_ngrams_in_text, fix_text, STOPWORDS
+from s2search.text import QueryNgramMatcher, fix_text, STOPWORDS
 from s2search.text import extract_from_between_quotations, fix_author_text
-from s2search.text import standardize_whitespace_length
+from s2search.text import standardize_whitespace_length, REGEX_TRANSLATION_TABLE
+from s2search.lm import NgramLogProbTable
+from s2search.metrics import timer
 
 now = datetime.datetime.now()
 
@@ -84,73 +86,421 @@ def make_feature_names_and_constraints():
     return np.array(feats), ','.join(constraints)
 
 
-def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
-    # the language model should have the beginning and end of sentences turned off
-    lm_tiab, lm_auth, lm_venu = lms
-    lm_dict = {
-        'title_abstract': lambda s: lm_tiab.score(s, eos=False, bos=False),
-        'author': lambda s: lm_auth.score(s, eos=False, bos=False),
-        'venue': lambda s: lm_venu.score(s, eos=False, bos=False)
-    }
+def _words_regex(words):
+    # finds any of words, or None if there aren't any
+    if len(words) == 0:
+        return None
+    return re.compile('|'.join(re.escape(word) for word in sorted(words)))
 
-    # apply the language model in the field as necessary
-    def lm_score(s, which_lm='title'):
+
+class CompiledQuery:
+    """Everything about the query that featurization needs, computed once
+    so it can be reused across all of the candidate papers.
+    
+    Arguments:
+        query {str} -- plain text search query
+        lms {tuple} -- title/abstract, author and venue language models
+        max_q_len {int} -- the query is truncated to this many characters
+        max_field_len {int} -- paper fields are truncated to this many characters
+        recorder {Metrics} -- optionally, where featurization with this query records its stages
+    """
+    def __init__(self, query, lms, max_q_len=128, max_field_len=1024, max_ngram_len=7, recorder=None):
+        self.max_field_len = max_field_len
+        self.max_ngram_len = max_ngram_len
+        self.recorder = recorder
+        
+        # fix the text and separate out quoted and unquoted
+        query = str(query)
+        q = fix_text(query)[:max_q_len]
+        q_quoted = [i for i in extract_from_between_quotations(q) if len(i) > 0]
+        q_split_on_quotes = [i.strip() for i in q.split('"') if len(i.strip()) > 0]
+        q_unquoted = [i.strip() for i in q_split_on_quotes if i not in q_quoted and len(i.strip()) > 0] 
+        
+        q_unquoted_split_set = set(' '.join(q_unquoted).split())
+        q_quoted_split_set = set(' '.join(q_quoted).split())
+        q_split_set = q_unquoted_split_set | q_quoted_split_set
+        q_split_set -= STOPWORDS
+
+        self.query = query
+        self.q = q
+        self.q_quoted = q_quoted
+        self.q_unquoted = q_unquoted
+        self.q_quoted_split_set = q_quoted_split_set
+        self.q_unquoted_split_set = q_unquoted_split_set - STOPWORDS
+        self.q_split_set = q_split_set
+        
+        # overall features for the query
+        q_quoted_len = np.sum([len(i) for i in q_quoted])  # total length of quoted snippets
+        q_unquoted_len = np.sum([len(i) for i in q_unquoted])   # total length of non-quoted snippets
+        self.q_len = q_unquoted_len + q_quoted_len
+        
+        # if year is in query, the year feature is whether the paper year appears in the query
+        self.has_year = re.search(r'\d{4}', q) is not None
+
+        # the ngram matchers for the title, abstract and venue
+        self.unquoted_matcher = QueryNgramMatcher(q_unquoted, quotes=False, max_ngram_len=max_ngram_len)
+        self.quoted_matcher = QueryNgramMatcher(q_quoted, quotes=True, max_ngram_len=max_ngram_len)
+        # a field that has none of the words that every match has to contain can't match anything
+        self.field_prefilter = _words_regex(self.unquoted_matcher.required_words | self.quoted_matcher.required_words)
+        
+        # every string that gets scored by a language model is either a matched query ngram,
+        # an unmatched query unigram or an unmatched quoted snippet, so we can score them all now
+        self.log_probs = NgramLogProbTable(lms, max_ngram_len)
+        if self.q_len > 0:
+            for q_sub in q_unquoted:
+                self.log_probs.add_ngrams(standardize_whitespace_length(q_sub.translate(REGEX_TRANSLATION_TABLE)))
+            for q_sub in q_quoted:
+                self.log_probs.add_phrase(standardize_whitespace_length(q_sub.translate(REGEX_TRANSLATION_TABLE)))
+                self.log_probs.add_phrase(q_sub)
+            for unigram in self.q_unquoted_split_set:
+                self.log_probs.add_phrase(unigram)
+        
+        # later we will filter some features based on nonsensical unigrams in the query
+        # this is the log probability lower-bound for sensible unigrams
+        if self.q_len == 0:
+            self.log_prob_nonsense = np.nan
+        else:
+            self.log_prob_nonsense = self.lm_score('qwertyuiop', 'max')
+        
+        # the author field gets its own version of the query
+        q_auth = fix_author_text(query)[:max_q_len]
+        q_quoted_auth = extract_from_between_quotations(q_auth)
+        q_split_on_quotes = [i.strip() for i in q_auth.split('"') if len(i.strip()) > 0]
+        self.q_quoted_auth = q_quoted_auth
+        self.q_unquoted_auth = [i for i in q_split_on_quotes if i not in q_quoted_auth]
+        # the author query depends on what each paper matched in its title and venue,
+        # but there are only a few distinct versions of it per query
+        self.author_matchers = {}
+        self.author_prefilters = {}
+
+    def author_matcher(self, q_auth, quotes):
+        """The ngram matcher for (a version of) the author query
+        """
+        key = (tuple(q_auth), quotes)
+        if key not in self.author_matchers:
+            self.author_matchers[key] = QueryNgramMatcher(
+                q_auth, 
+                quotes=quotes, 
+                len_filter=0,
+                remove_stopwords=True,  # only removes entire matches that are stopwords. too bad for people named 'the' or 'less'
+                use_word_boundaries=False,
+                max_ngram_len=self.max_ngram_len
+            )
+        return self.author_matchers[key]
+
+    def author_prefilter(self, q_unquoted_auth, q_quoted_auth):
+        """A regex that finds a word of (a version of) the author query that
+        every unquoted or quoted author match contains, or None if nothing can match.
+        Authors it doesn't find anything in can be skipped.
+        """
+        key = (tuple(q_unquoted_auth), tuple(q_quoted_auth))
+        if key not in self.author_prefilters:
+            words = self.author_matcher(q_unquoted_auth, False).required_words
+            words = words | self.author_matcher(q_quoted_auth, True).required_words
+            self.author_prefilters[key] = _words_regex(words)
+        return self.author_prefilters[key]
+
+    def lm_score(self, s, which_lm='title'):
+        """Apply the language model in the field as necessary.
+        The language models have the beginning and end of sentences turned off.
+        """
+        log_probs = self.log_probs.lookup(s)
         if 'title' in which_lm or 'abstract' in which_lm: 
-            return lm_dict['title_abstract'](s)
+            return log_probs[0]
         elif 'venue' in which_lm: 
-            return lm_dict['venue'](s)
+            return log_probs[2]
         elif 'author' in which_lm: 
-            return lm_dict['author'](s)
+            return log_probs[1]
         elif 'max' in which_lm:
-            return np.max([lm_dict['title_abstract'](s), lm_dict['venue'](s), lm_dict['author'](s)])
+            return log_probs[3]
+
+
+def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024, max_ngram_len=7, recorder=None):
+    """Featurize a single (query, paper) pair. When featurizing many papers
+    for the same query, use `CompiledQuery` and `make_paper_features` instead
+    so that the query is only processed once.
+    """
+    with timer(recorder, 'compile_query'):
+        compiled_query = CompiledQuery(query, lms, max_q_len, max_field_len, max_ngram_len, recorder)
+    return make_paper_features(compiled_query, result_paper)
+
+
+# the text fields, in the order that they are featurized
+FIELDS = ['paper_title_cleaned', 'paper_abstract_cleaned', 'paper_venue_cleaned']
+
+# the stages of featurization that can be skipped: matching each of FIELDS,
+# matching the authors and the features about matches across all fields
+FEATURIZATION_STAGES = frozenset(['title', 'abstract', 'venue', 'authors', 'across_fields'])
+FIELD_STAGES = ['title', 'abstract', 'venue']
+
+# what match_field would return for a field that isn't matched
+SKIPPED_FIELD = ([np.nan] * 3, [], [], [])
+
+
+class PaperMatches:
+    """What featurizing a paper against a query has found, stage by stage:
+    the year, the title/abstract/venue fields (see `match_field`) and the
+    authors. `finish_paper_features` puts it all together into the features.
+    """
+    __slots__ = ('abstract_is_available', 'year', 'year_feat', 'q_split_set', 'year_matches', 'fields',
+                 'authors', 'author_feats', 'author_matches')
+
+    def __init__(self, abstract_is_available, year, year_feat, q_split_set, year_matches, fields, authors,
+                 author_feats=None, author_matches=None):
+        self.abstract_is_available = abstract_is_available
+        self.year = year
+        self.year_feat = year_feat
+        self.q_split_set = q_split_set
+        # the (unquoted, quoted) matches of each stage
+        self.year_matches = year_matches
+        self.fields = fields
+        self.authors = authors
+        self.author_feats = author_feats
+        self.author_matches = author_matches
+
+    def copy(self, **changes):
+        matches = PaperMatches(*[getattr(self, attr) for attr in self.__slots__])
+        for attr, value in changes.items():
+            setattr(matches, attr, value)
+        return matches
+
+    @property
+    def title_and_venue_matches(self):
+        # the author query doesn't include what was matched in the title or venue
+        return _matched_unigrams([self.fields[0], self.fields[2]])
+
+
+def _matched_unigrams(field_matches):
+    unigrams = set()
+    for _, _, _, match_text_set in field_matches:
+        for i in match_text_set:
+            unigrams.update(i.split())
+    return unigrams
+
+
+def make_paper_features(compiled_query, result_paper):
+    """Featurize a paper that has been through `S2Ranker.prepare_result`
+    against a query that has been through `CompiledQuery`.
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query
+        result_paper {dict} -- the pre-processed paper
+
+    Returns:
+        feats {np.array} -- one value per entry of FEATURE_NAMES
+    """
+    return make_papers_features(compiled_query, [result_paper])[0]
+
+
+def feature_mask(groups):
+    """A column mask for `make_papers_features`
+
+    Arguments:
+        groups {list of str} -- keys of FEATURE_GROUPS and/or entries of FEATURE_NAMES
+
+    Returns:
+        columns {np.array} -- whether each of FEATURE_NAMES is in groups
+    """
+    columns = np.zeros(len(FEATURE_NAMES), dtype=bool)
+    for group in groups:
+        if group in FEATURE_GROUPS:
+            columns[[feature_names.index(name) for name in FEATURE_GROUPS[group]]] = True
+        elif group in feature_names:
+            columns[feature_names.index(group)] = True
+        else:
+            raise ValueError(f'{group!r} is neither a feature group nor a feature name')
+    return columns
+
+
+def featurization_stages(columns):
+    """The stages of featurization (see FEATURIZATION_STAGES) that the columns
+    in a mask need, including the stages that those stages depend on
+    """
+    stages = set()
+    for group, names in FEATURE_GROUPS.items():
+        if any(columns[feature_names.index(name)] for name in names):
+            stages |= FEATURE_GROUP_STAGES[group]
+    return frozenset(stages)
+
+
+def make_papers_features(compiled_query, result_papers, columns=None, out=None, dtype=np.float64, static_features=None):
+    """Featurize many papers that have been through `S2Ranker.prepare_result`
+    against a query that has been through `CompiledQuery`. The authors of all
+    of the papers are matched together (see `match_authors_many`), and the rows
+    are written straight into one array.
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query
+        result_papers {list of dicts} -- the pre-processed papers
+        columns {np.array} -- optionally, a boolean mask of the features to compute (see
+                              `feature_mask`). the stages of featurization that no column in
+                              it needs are skipped, and the other columns are nan
+        out {np.array} -- optionally, an array of shape (len(result_papers), len(FEATURE_NAMES))
+                          to write the features into
+        dtype {np.dtype} -- the dtype of the array, if out isn't given. float64 gives the
+                            model exactly the features it was trained on, and float32 takes
+                            half the memory
+        static_features {list} -- optionally, the already computed STATIC_FEATURE_NAMES of each
+                                  paper (e.g. from a `Corpus`), or None for the ones to compute
+
+    Returns:
+        X {np.array} -- one row of features per paper
+    """
+    if out is None:
+        out = np.empty((len(result_papers), len(FEATURE_NAMES)), dtype=dtype)
+    # if there's no query left at this point, we return NaNs
+    # which the model natively supports
+    if compiled_query.q_len == 0:
+        out[:] = np.nan
+        return out
     
-    try:
-        year = int(result_paper['paper_year'])
-        year = np.minimum(now.year, year) # papers can't be from the future.
-    except:
-        year = np.nan
+    stages = FEATURIZATION_STAGES if columns is None else featurization_stages(columns)
+    recorder = compiled_query.recorder
+    with timer(recorder, 'match_fields'):
+        may_match = prefilter_fields(compiled_query, result_papers)
+        paper_matches = [
+            match_paper_fields(compiled_query, result_paper, stages, paper_may_match)
+            for result_paper, paper_may_match in zip(result_papers, may_match)
+        ]
+    with timer(recorder, 'match_authors'):
+        if 'authors' in stages:
+            match_authors_many(compiled_query, paper_matches)
+        else:
+            for matches in paper_matches:
+                matches.author_feats, matches.author_matches = [np.nan] * 3, ([], [])
+    with timer(recorder, 'finish_features'):
+        if static_features is None:
+            static_features = [None] * len(result_papers)
+        for i, (result_paper, matches, static) in enumerate(zip(result_papers, paper_matches, static_features)):
+            out[i] = finish_paper_features(compiled_query, matches, result_paper, stages, static)
+    if columns is not None:
+        out[:, ~columns] = np.nan
+    return out
+
+
+def prefilter_fields(compiled_query, result_papers):
+    """Which of the title, abstract and venue of each paper could match the query at all.
+    The fields of all of the papers are searched together for the words that every match
+    has to contain (see `CompiledQuery.field_prefilter`), which is much cheaper than
+    matching them. Candidates from a first-stage retrieval often share no words with
+    the query in most of their fields.
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query
+        result_papers {list of dicts} -- the pre-processed papers
+
+    Returns:
+        may_match {np.array} -- of shape (len(result_papers), len(FIELDS))
+    """
+    may_match = np.zeros((len(result_papers), len(FIELDS)), dtype=bool)
+    for j, field in enumerate(FIELDS):
+        texts = [
+            '' if result_paper[field] is None else result_paper[field][:compiled_query.max_field_len]
+            for result_paper in result_papers
+        ]
+        may_match[:, j] = _prefilter_texts(compiled_query.field_prefilter, texts)
+    return may_match
+
+
+def match_paper_fields(compiled_query, result_paper, stages=FEATURIZATION_STAGES, may_match=None):
+    """The first stage of featurization: the year, title, abstract and venue.
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query (with q_len > 0)
+        result_paper {dict} -- the pre-processed paper
+        stages {set} -- which of the title, abstract and venue to match. the others are SKIPPED_FIELD
+        may_match {list of bool} -- optionally, which of the fields could match (see `prefilter_fields`).
+                                    the others get what `match_field` returns when nothing matches
+
+    Returns:
+        matches {PaperMatches} -- what was matched, with the authors still to do
+    """
+    year, year_feat, q_split_set, year_matches = match_year(compiled_query, result_paper)
     
     if result_paper['author_name'] is None:
         authors = []
     else:
         authors = result_paper['author_name']
-    
-    # fix the text and separate out quoted and unquoted
-    query = str(query)
-    q = fix_text(query)[:max_q_len]
-    q_quoted = [i for i in extract_from_between_quotations(q) if len(i) > 0]
-    q_split_on_quotes = [i.strip() for i in q.split('"') if len(i.strip()) > 0]
-    q_unquoted = [i.strip() for i in q_split_on_quotes if i not in q_quoted and len(i.strip()) > 0] 
-    
-    q_unquoted_split_set = set(' '.join(q_unquoted).split())
-    q_quoted_split_set = set(' '.join(q_quoted).split())
-    q_split_set = q_unquoted_split_set | q_quoted_split_set
-    q_split_set -= STOPWORDS
+
+    # features title, abstract, venue
+    fields = []
+    for j, (field, stage) in enumerate(zip(FIELDS, FIELD_STAGES)):
+        if stage not in stages:
+            fields.append(SKIPPED_FIELD)
+        elif may_match is not None and not may_match[j]:
+            fields.append(([0, 0, 0], [], [], []))
+        else:
+            fields.append(match_field(compiled_query, field, result_paper[field], q_split_set, _matched_unigrams(fields)))
+
+    return PaperMatches(
+        _abstract_is_available(result_paper), year, year_feat, q_split_set, year_matches, fields, authors
+    )
+
+
+def _paper_year(result_paper):
+    try:
+        year = int(result_paper['paper_year'])
+        return np.minimum(now.year, year) # papers can't be from the future.
+    except:
+        return np.nan
+
+
+def _abstract_is_available(result_paper):
+    return result_paper['paper_abstract_cleaned'] is not None and len(result_paper['paper_abstract_cleaned']) > 1
+
+
+def _citation_features(year, n_citations, n_key_citations):
+    return [
+        now.year - year,  # oldness (could be nan if year is missing)
+        n_citations,  # no need for log due to decision trees
+        n_key_citations,
+        np.nan if np.isnan(year) else n_citations / (now.year - year + 1)
+    ]
+
+
+def make_static_features(result_paper):
+    """The features that only depend on the paper and not on the query (see
+    STATIC_FEATURE_NAMES), e.g. to store them with the paper. The oldness is
+    relative to the current year, so they need to be recomputed when it changes.
+
+    Arguments:
+        result_paper {dict} -- the pre-processed paper
+
+    Returns:
+        feats {list} -- one value per entry of STATIC_FEATURE_NAMES
+    """
+    return [_abstract_is_available(result_paper)] + _citation_features(
+        _paper_year(result_paper), result_paper['n_citations'], result_paper['n_key_citations']
+    )
+
+
+def match_year(compiled_query, result_paper):
+    """The year of a paper and how it matches the query
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query (with q_len > 0)
+        result_paper {dict} -- the pre-processed paper
+
+    Returns:
+        year {int} -- the year, or nan if it's missing
+        year_feat {bool} -- whether the year appears in the query, or nan if the query has no year
+        q_split_set {set} -- the query unigrams that are left for the other fields to match
+        year_matches {tuple} -- (unquoted, quoted) lists of what the year matched
+    """
+    cq = compiled_query
+    q_quoted, q_unquoted = cq.q_quoted, cq.q_unquoted
+    year = _paper_year(result_paper)
     
     # we will find out how much of a match we have *across* fields
     unquoted_matched_across_fields = []
     quoted_matched_across_fields = []
     
-    # overall features for the paper and query
-    q_quoted_len = np.sum([len(i) for i in q_quoted])  # total length of quoted snippets
-    q_unquoted_len = np.sum([len(i) for i in q_unquoted])   # total length of non-quoted snippets
-    q_len = q_unquoted_len + q_quoted_len  
-    
-    # if there's no query left at this point, we return NaNs
-    # which the model natively supports
-    if q_len == 0:
-        return [np.nan] * len(FEATURE_NAMES)
-    
     # testing whether a year is somewhere in the query and making year-based features
-    if re.search('\d{4}', q):  # if year is in query, the feature is whether the paper year appears in the query
+    q_split_set = cq.q_split_set
+    if cq.has_year:  # if year is in query, the feature is whether the paper year appears in the query
         year_feat = (str(year) in q_split_set)
     else:  # if year isn't in the query, we don't care about matching
         year_feat = np.nan
-
-    feats = [
-        result_paper['paper_abstract_cleaned'] is not None and len(result_paper['paper_abstract_cleaned']) > 1,
-        year_feat,  # whether the year appears anywhere in the (split) query
-    ]
     
     # if year is matched, add it to the matched_across_all_fields but remove from query
     # so it doesn't get matched in author/title/venue/abstract later
@@ -160,185 +510,291 @@ def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
         unquoted_matched_across_fields.append(str(year))
         
     # if year is matched, we don't need to match it again, so removing
+    # (from a copy, since the compiled query is shared across papers)
     if year_feat is True and len(q_split_set) > 1: 
-        q_split_set.remove(str(year))
+        q_split_set = q_split_set - {str(year)}
+
+    return year, year_feat, q_split_set, (unquoted_matched_across_fields, quoted_matched_across_fields)
+
+
+def match_field(compiled_query, field, text, q_split_set, title_and_abstract_matches):
+    """Match the query in one of the title, abstract or venue
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query (with q_len > 0)
+        field {str} -- one of FIELDS
+        text {str} -- the prepared text of the field
+        q_split_set {set} -- the query unigrams, from `match_year`
+        title_and_abstract_matches {set} -- the unigrams matched in the title and abstract.
+                                            only used for the venue
+
+    Returns:
+        feats {list} -- the three features of the field
+        unquoted_match_text {list} -- everything the unquoted query matched
+        quoted_match_text {list} -- everything the quoted query matched
+        match_text_set {list} -- the distinct matches that the features are about
+    """
+    cq = compiled_query
+    lm_score = cq.lm_score
+    if text is not None:
+        text = text[:cq.max_field_len]
+    else:
+        text = ''
+    text_len = len(text)
+    
+    # unquoted matches
+    unquoted_match_spans, unquoted_match_text, unquoted_longest_starting_ngram = cq.unquoted_matcher.find(text)
+    unquoted_match_len = len(unquoted_match_spans)
+    
+    # quoted matches
+    quoted_match_spans, quoted_match_text, quoted_longest_starting_ngram = cq.quoted_matcher.find(text)
+    quoted_match_len = len(quoted_match_text)
+    
+    # now we (a) combine the quoted and unquoted results
+    match_spans = unquoted_match_spans + quoted_match_spans
+    match_text = unquoted_match_text + quoted_match_text
+    
+    # and (b) take the set of the results
+    # while excluding sub-ngrams if longer ngrams are found
+    # e.g. if we already have 'sentiment analysis', then 'sentiment' is excluded
+    match_spans_set = []
+    match_text_set = []
+    for t, s in sorted(zip(match_text, match_spans), key=lambda s: len(s[0]))[::-1]:
+        if t not in match_text_set and ~np.any([t in i for i in match_text_set]):
+            match_spans_set.append(s)
+            match_text_set.append(t)
+            
+    # remove venue results if they already entirely appeared
+    if 'venue' in field:
+        text_unigram_len = len(text.split(' '))
+        match_spans_set_filtered = []
+        match_text_set_filtered = []
+        for sp, tx in zip(match_spans_set, match_text_set):
+            tx_unigrams = set(tx.split(' '))
+            # already matched all of these unigrams in title or abstract
+            condition_1 = (tx_unigrams.intersection(title_and_abstract_matches) == tx_unigrams)
+            # and matched too little of the venue text
+            condition_2 = len(tx_unigrams) / text_unigram_len <= 2/3
+            if not (condition_1 and condition_2):
+                match_spans_set_filtered.append(sp)
+                match_text_set_filtered.append(tx)
+                
+        match_spans_set = match_spans_set_filtered
+        match_text_set = match_text_set_filtered
 
-    # later we will filter some features based on nonsensical unigrams in the query
-    # this is the log probability lower-bound for sensible unigrams
-    log_prob_nonsense = lm_score('qwertyuiop', 'max')
+    # match_text_set but unigrams
+    matched_text_unigrams = set()
+    for i in match_text_set:
+        matched_text_unigrams.update(i.split())
     
-    # features title, abstract, venue
-    title_and_venue_matches = set()
-    title_and_abstract_matches = set()
-    for field in ['paper_title_cleaned', 'paper_abstract_cleaned', 'paper_venue_cleaned']:
-        if result_paper[field] is not None:
-            text = result_paper[field][:max_field_len]
+    if len(match_text_set) > 0 and text_len > 0:  # if any matches and the text has any length
+        # log probabilities of the scores
+        if 'venue' in field:
+            lm_probs = [lm_score(match, 'venue') for match in match_text_set]
         else:
-            text = ''
-        text_len = len(text)
-        
-        # unquoted matches
-        unquoted_match_spans, unquoted_match_text, unquoted_longest_starting_ngram = find_query_ngrams_in_text(q_unquoted, text, quotes=False)
-        unquoted_matched_across_fields.extend(unquoted_match_text)
-        unquoted_match_len = len(unquoted_match_spans)
+            lm_probs = [lm_score(match, 'max') for match in match_text_set]
         
-        # quoted matches
-        quoted_match_spans, quoted_match_text, quoted_longest_starting_ngram = find_query_ngrams_in_text(q_quoted, text, quotes=True)
-        quoted_matched_across_fields.extend(quoted_match_text)
-        quoted_match_len = len(quoted_match_text)
-        
-        # now we (a) combine the quoted and unquoted results
-        match_spans = unquoted_match_spans + quoted_match_spans
-        match_text = unquoted_match_text + quoted_match_text
+        # match character lengths
+        match_lens = [len(i) for i in match_text_set]
+
+        # match word lens
+        match_word_lens = [len(i.split()) for i in match_text_set]
         
-        # and (b) take the set of the results
-        # while excluding sub-ngrams if longer ngrams are found
-        # e.g. if we already have 'sentiment analysis', then 'sentiment' is excluded
-        match_spans_set = []
-        match_text_set = []
-        for t, s in sorted(zip(match_text, match_spans), key=lambda s: len(s[0]))[::-1]:
-            if t not in match_text_set and ~np.any([t in i for i in match_text_set]):
-                match_spans_set.append(s)
-                match_text_set.append(t)
-                
-        # remove venue results if they already entirely appeared
-        if 'venue' in field:
-            text_unigram_len = len(text.split(' '))
-            match_spans_set_filtered = []
-            match_text_set_filtered = []
-            for sp, tx in zip(match_spans_set, match_text_set):
-                tx_unigrams = set(tx.split(' '))
-                # already matched all of these unigrams in title or abstract
-                condition_1 = (tx_unigrams.intersection(title_and_abstract_matches) == tx_unigrams)
-                # and matched too little of the venue text
-                condition_2 = len(tx_unigrams) / text_unigram_len <= 2/3
-                if not (condition_1 and condition_2):
-                    match_spans_set_filtered.append(sp)
-                    match_text_set_filtered.append(tx)
-                    
-            match_spans_set = match_spans_set_filtered
-            match_text_set = match_text_set_filtered
-
-        # match_text_set but unigrams
-        matched_text_unigrams = set()
-        for i in match_text_set:
-            i_split = i.split()
-            matched_text_unigrams.update(i_split)
-            if 'title' in field or 'venue' in field:
-                title_and_venue_matches.update(i_split)
-            if 'title' in field or 'abstract' in field:
-                title_and_abstract_matches.update(i_split)
+        # we have one feature that takes into account repetition of matches
+        match_text_counter = Counter(match_text)
+        match_spans_len_normed = np.log1p(list(match_text_counter.values())).sum()
+
+        # remove stopwords from unigrams
+        matched_text_unigrams -= STOPWORDS
         
-        if len(match_text_set) > 0 and text_len > 0:  # if any matches and the text has any length
-            # log probabilities of the scores
-            if 'venue' in field:
-                lm_probs = [lm_score(match, 'venue') for match in match_text_set]
-            else:
-                lm_probs = [lm_score(match, 'max') for match in match_text_set]
-            
-            # match character lengths
-            match_lens = [len(i) for i in match_text_set]
+        feats = [
+            len(q_split_set.intersection(matched_text_unigrams)) / np.maximum(len(q_split_set), 1),  # total fraction of the query that was matched in text
+            np.nanmean(lm_probs),  # average log-prob of the matches
+            np.nansum(np.array(lm_probs) * np.array(match_word_lens)),  # sum of log-prob of matches times word-lengths
+        ]
+    else:
+        # if we have no matches, then the features are deterministically 0
+        feats = [0, 0, 0]
 
-            # match word lens
-            match_word_lens = [len(i.split()) for i in match_text_set]
-            
-            # we have one feature that takes into account repetition of matches
-            match_text_counter = Counter(match_text)
-            match_spans_len_normed = np.log1p(list(match_text_counter.values())).sum()
+    return feats, unquoted_match_text, quoted_match_text, match_text_set
 
-            # remove stopwords from unigrams
-            matched_text_unigrams -= STOPWORDS
-            
-            feats.extend([
-                len(q_split_set.intersection(matched_text_unigrams)) / np.maximum(len(q_split_set), 1),  # total fraction of the query that was matched in text
-                np.nanmean(lm_probs),  # average log-prob of the matches
-                np.nansum(np.array(lm_probs) * np.array(match_word_lens)),  # sum of log-prob of matches times word-lengths
-            ])
-        else:
-            # if we have no matches, then the features are deterministically 0
-            feats.extend([0, 0, 0])
 
+def match_authors_many(compiled_query, paper_matches):
+    """The author features of many papers at once. Only authors that contain
+    a word that every author match has to contain are actually matched against
+    the query (see `CompiledQuery.author_prefilter`), which is what makes papers
+    with hundreds of authors cheap. The features and the matched texts of each
+    paper are set as its author_feats and author_matches.
 
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query (with q_len > 0)
+        paper_matches {list of PaperMatches} -- the papers, from `match_paper_fields`
+    """
     # features for author field only
     # note: we aren't using citation info
     # because we don't know which author we are matching
     # in the case of multiple authors with the same name
-    q_auth = fix_author_text(query)[:max_q_len]
-    q_quoted_auth = extract_from_between_quotations(q_auth)
-    q_split_on_quotes = [i.strip() for i in q_auth.split('"') if len(i.strip()) > 0]
-    q_unquoted_auth = [i for i in q_split_on_quotes if i not in q_quoted_auth]
     # remove any unigrams that we already matched in title or venue
     # but not abstract since citations are included there
     # note: not sure if this make sense for quotes, but keeping it for those now
-    q_quoted_auth = [remove_unigrams(i, title_and_venue_matches) for i in q_quoted_auth]
-    q_unquoted_auth = [remove_unigrams(i, title_and_venue_matches) for i in q_unquoted_auth]
+    # papers whose titles and venues matched the same unigrams share a version of the author query
+    groups = {}
+    for matches in paper_matches:
+        title_and_venue_matches = matches.title_and_venue_matches
+        q_unquoted_auth = tuple(remove_unigrams(i, title_and_venue_matches) for i in compiled_query.q_unquoted_auth)
+        q_quoted_auth = tuple(remove_unigrams(i, title_and_venue_matches) for i in compiled_query.q_quoted_auth)
+        groups.setdefault((q_unquoted_auth, q_quoted_auth), []).append(matches)
+
+    for (q_unquoted_auth, q_quoted_auth), members in groups.items():
+        for matches, author_feats in zip(members, _match_authors(compiled_query, members, q_unquoted_auth, q_quoted_auth)):
+            matches.author_feats = author_feats
+
+
+def _match_authors(cq, paper_matches, q_unquoted_auth, q_quoted_auth):
+    q_len = cq.q_len
     
-    unquoted_match_lens = []  # normalized author matches
-    quoted_match_lens = []  # quoted author matches
-    match_fracs = []
-    for paper_author in authors:
+    # the non-empty authors of all of the papers, one after the other
+    authors = []
+    bounds = [0]
+    for matches in paper_matches:
+        authors.extend(paper_author for paper_author in matches.authors if len(paper_author) > 0)
+        bounds.append(len(authors))
+    bounds = np.array(bounds)
+    owners = np.repeat(np.arange(len(paper_matches)), np.diff(bounds))
+    
+    for matches in paper_matches:
+        matches.author_matches = ([], [])
+    unquoted_match_lens = np.zeros(len(authors))  # normalized author matches
+    quoted_match_lens = np.zeros(len(authors))  # quoted author matches
+    prefilter = cq.author_prefilter(q_unquoted_auth, q_quoted_auth)
+    for a in np.flatnonzero(_prefilter_texts(prefilter, authors)):
+        paper_author = authors[a]
+        matches = paper_matches[owners[a]]
         len_author = len(paper_author)
-        if len_author > 0:
-             # higher weight for the last name
-            paper_author_weights = np.ones(len_author)
-            len_last_name = len(paper_author.split(' ')[-1])
-            paper_author_weights[-len_last_name:] *= 10  # last name is ten times more important to match
-            paper_author_weights /= paper_author_weights.sum()
-            
-            # 
-            for quotes_flag, q_loop in zip([False, True], [q_unquoted_auth, q_quoted_auth]):
-                matched_spans, match_text, _ = find_query_ngrams_in_text(
-                    q_loop, 
-                    paper_author, 
-                    quotes=quotes_flag, 
-                    len_filter=0,
-                    remove_stopwords=True,  # only removes entire matches that are stopwords. too bad for people named 'the' or 'less'
-                    use_word_boundaries=False  
-                )
-                if len(matched_spans) > 0:
-                    matched_text_joined = ' '.join(match_text)
-                    # edge case: single character matches are not good
-                    if len(matched_text_joined) == 1:
-                        matched_text_joined = ''
-                    weight = np.sum([paper_author_weights[i:j].sum() for i, j in matched_spans]) 
-                    match_frac = np.minimum((len(matched_text_joined) / q_len), 1)
-                    match_fracs.append(match_frac)
-                    if quotes_flag:
-                        quoted_match_lens.append(match_frac * weight)
-                        quoted_matched_across_fields.append(matched_text_joined)
-                    else:
-                        unquoted_match_lens.append(match_frac * weight)
-                        unquoted_matched_across_fields.append(matched_text_joined)
+        # higher weight for the last name
+        paper_author_weights = np.ones(len_author)
+        len_last_name = len(paper_author.split(' ')[-1])
+        paper_author_weights[-len_last_name:] *= 10  # last name is ten times more important to match
+        paper_author_weights /= paper_author_weights.sum()
+        
+        for quotes_flag, q_loop in zip([False, True], [q_unquoted_auth, q_quoted_auth]):
+            matched_spans, match_text, _ = cq.author_matcher(q_loop, quotes_flag).find(paper_author)
+            if len(matched_spans) > 0:
+                matched_text_joined = ' '.join(match_text)
+                # edge case: single character matches are not good
+                if len(matched_text_joined) == 1:
+                    matched_text_joined = ''
+                weight = np.sum([paper_author_weights[i:j].sum() for i, j in matched_spans]) 
+                match_frac = np.minimum((len(matched_text_joined) / q_len), 1)
+                if quotes_flag:
+                    quoted_match_lens[a] = match_frac * weight
+                    matches.author_matches[1].append(matched_text_joined)
                 else:
-                    if quotes_flag:
-                        quoted_match_lens.append(0)
-                    else:
-                        unquoted_match_lens.append(0)
+                    unquoted_match_lens[a] = match_frac * weight
+                    matches.author_matches[0].append(matched_text_joined)
     
     # since we ran this separately (per author) for quoted and uquoted, we want to avoid potential double counting
     match_lens_max = np.maximum(unquoted_match_lens, quoted_match_lens)
     nonzero_inds = np.flatnonzero(match_lens_max)
-    # the closest index to the ends of author lists
-    if len(nonzero_inds) == 0:
-        author_ind_feature = np.nan
-    else:
-        author_ind_feature = np.minimum(nonzero_inds[0], len(authors) - 1 - nonzero_inds[-1]) 
-    feats.extend([
-        np.nansum(match_lens_max),  # total amount of (weighted) matched authors 
-        nanwrapper(np.nanmax, match_lens_max),  # largest (weighted) author match
-        author_ind_feature,  # penalizing matches that are far away from ends of author list
-    ])
+    
+    # papers without any matched authors get the same features as an all-zero author list would
+    n_papers = len(paper_matches)
+    sums = np.zeros(n_papers)
+    maxes = np.where(bounds[1:] > bounds[:-1], 0.0, np.nan)
+    author_ind_features = np.full(n_papers, np.nan)
+    if len(nonzero_inds) > 0:
+        # the first and last matched author of each paper with any
+        matched_papers, firsts = np.unique(owners[nonzero_inds], return_index=True)
+        lasts = len(nonzero_inds) - 1 - np.unique(owners[nonzero_inds][::-1], return_index=True)[1]
+        n_authors = np.array([len(paper_matches[n].authors) for n in matched_papers])
+        # the closest index to the ends of author lists
+        author_ind_features[matched_papers] = np.minimum(
+            nonzero_inds[firsts] - bounds[matched_papers],
+            n_authors - 1 - (nonzero_inds[lasts] - bounds[matched_papers])
+        )
+        for n in matched_papers:
+            paper_match_lens_max = match_lens_max[bounds[n]:bounds[n + 1]]
+            sums[n] = np.nansum(paper_match_lens_max)
+            maxes[n] = nanwrapper(np.nanmax, paper_match_lens_max)
+    
+    return [
+        [
+            sums[n],  # total amount of (weighted) matched authors 
+            maxes[n],  # largest (weighted) author match
+            author_ind_features[n],  # penalizing matches that are far away from ends of author list
+        ]
+        for n in range(n_papers)
+    ]
+
+
+def _prefilter_texts(prefilter, texts):
+    """Which of the texts (e.g. authors) contain a match of the prefilter regex. The texts
+    are searched as one string, the same way `QueryNgramMatcher.find` sees each of them.
+    """
+    candidates = np.zeros(len(texts), dtype=bool)
+    if prefilter is None or len(texts) == 0:
+        return candidates
+    joined = '\n'.join(texts).translate(REGEX_TRANSLATION_TABLE)
+    # the character offsets of the separators tell us which text a match is in
+    chars = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32)
+    separators = np.flatnonzero(chars == ord('\n'))
+    if len(separators) != len(texts) - 1:
+        # fix_text and fix_author_text never leave a newline in a text, but if one did, match them all
+        candidates[:] = True
+        return candidates
+    # a match never spans a separator, so each one lands inside a single text
+    starts = [m.start() for m in prefilter.finditer(joined)]
+    candidates[np.searchsorted(separators, starts)] = True
+    return candidates
+
+
+def finish_paper_features(compiled_query, paper_matches, result_paper, stages=FEATURIZATION_STAGES,
+                          static_features=None):
+    """The last stage of featurization: citations and the features that are
+    about matches across all of the fields.
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query (with q_len > 0)
+        paper_matches {PaperMatches} -- the paper's matches, including its authors
+        result_paper {dict} -- the pre-processed paper
+        stages {set} -- the across-field features are nan unless 'across_fields' is in it
+        static_features {list} -- optionally, the paper's already computed STATIC_FEATURE_NAMES
+
+    Returns:
+        feats {list} -- one value per entry of FEATURE_NAMES
+    """
+    cq = compiled_query
+    lm_score = cq.lm_score
+    log_prob_nonsense = cq.log_prob_nonsense
+    q_quoted = cq.q_quoted
+    year = paper_matches.year
+    feats = [
+        paper_matches.abstract_is_available if static_features is None else static_features[0],
+        paper_matches.year_feat,  # whether the year appears anywhere in the (split) query
+    ]
+    
+    # we will find out how much of a match we have *across* fields
+    unquoted_matched_across_fields = list(paper_matches.year_matches[0])
+    quoted_matched_across_fields = list(paper_matches.year_matches[1])
+    for field_feats, unquoted_match_text, quoted_match_text, _ in paper_matches.fields:
+        feats.extend(field_feats)
+        unquoted_matched_across_fields.extend(unquoted_match_text)
+        quoted_matched_across_fields.extend(quoted_match_text)
+    feats.extend(paper_matches.author_feats)
+    unquoted_matched_across_fields.extend(paper_matches.author_matches[0])
+    quoted_matched_across_fields.extend(paper_matches.author_matches[1])
 
     # oldness and citations 
-    feats.extend([
-        now.year - year,  # oldness (could be nan if year is missing)
-        result_paper['n_citations'],  # no need for log due to decision trees
-        result_paper['n_key_citations'],
-        np.nan if np.isnan(year) else result_paper['n_citations'] / (now.year - year + 1)
-    ])
+    if static_features is None:
+        feats.extend(_citation_features(year, result_paper['n_citations'], result_paper['n_key_citations']))
+    else:
+        feats.extend(static_features[1:])
+    if 'across_fields' not in stages:
+        feats.extend([np.nan] * 4)
+        return feats
     
     # special features for how much of the unquoted query was matched/unmatched across all fields
-    q_unquoted_split_set -= STOPWORDS
+    q_unquoted_split_set = cq.q_unquoted_split_set
     if len(q_unquoted_split_set) > 0:
         matched_split_set = set()
         for i in unquoted_matched_across_fields:
@@ -358,7 +814,7 @@ def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
     # special features for how much of the quoted query was matched/unmatched across all fields
     if len(q_quoted) > 0:
         numerator = len(set(' '.join(quoted_matched_across_fields).split()))
-        feats.append(numerator / len(q_quoted_split_set))
+        feats.append(numerator / len(cq.q_quoted_split_set))
         # the log-prob of the unmatched quotes
         unmatched_quoted = set(q_quoted) - set(quoted_matched_across_fields)
         feats.append(np.nansum([lm_score(i, 'max') for i in unmatched_quoted]))
@@ -368,9 +824,149 @@ def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
     return feats
 
 
+# the fields that can be masked by `make_ablation_features`, and what
+# masking each one does to a paper from `S2Ranker.prepare_result`
+ABLATION_MASKS = {
+    'title': {'paper_title_cleaned': ''},
+    'abstract': {'paper_abstract_cleaned': ''},
+    'venue': {'paper_venue_cleaned': ''},
+    'authors': {'author_name': []},
+    'year': {'paper_year': np.nan},
+    'n_citations': {'n_citations': 0, 'n_key_citations': 0},
+    'full': {},
+}
+ABLATION_VARIANTS = list(ABLATION_MASKS)
+
+
+def mask_result(result_paper, variant):
+    """A copy of a prepared paper with one field masked (see ABLATION_MASKS)
+    """
+    masked = {key: result_paper[key] for key in result_paper.keys()}
+    masked.update(ABLATION_MASKS[variant])
+    return masked
+
+
+def make_ablation_features(compiled_query, result_papers, variants=ABLATION_VARIANTS):
+    """Featurize papers as they are and with each of their fields masked, which is
+    the same as featurizing every masked version of the papers separately. Each
+    paper is only featurized once, and for each variant only the stages that
+    depend on the masked field are redone: e.g. masking the venue re-matches the
+    authors only if the venue changed the author query, and masking the citations
+    only changes the citation columns.
+
+    Arguments:
+        compiled_query {CompiledQuery} -- the pre-processed query
+        result_papers {list of dicts} -- the pre-processed papers
+        variants {list of str} -- which field to mask in each variant. see ABLATION_MASKS
+
+    Returns:
+        X {np.array} -- features of shape (len(variants), len(result_papers), len(FEATURE_NAMES))
+    """
+    for variant in variants:
+        if variant not in ABLATION_MASKS:
+            raise ValueError(f'variants should be in {ABLATION_VARIANTS}, not {variant!r}')
+    cq = compiled_query
+    X = np.full((len(variants), len(result_papers), len(FEATURE_NAMES)), np.nan)
+    if cq.q_len == 0:
+        return X
+    
+    paper_matches = [match_paper_fields(cq, result_paper) for result_paper in result_papers]
+    match_authors_many(cq, paper_matches)
+    X_full = np.array([
+        finish_paper_features(cq, matches, result_paper) for result_paper, matches in zip(result_papers, paper_matches)
+    ], dtype=float).reshape(len(result_papers), len(FEATURE_NAMES))
+    
+    # the (variant, paper, matches, result paper) that still need their authors matched
+    rematch_authors = []
+    # the ones that only need to be finished
+    finish = []
+    for v, variant in enumerate(variants):
+        if variant == 'full':
+            X[v] = X_full
+        elif variant == 'n_citations':
+            X[v] = X_full
+            X[v, :, n_citations_ind] = 0
+            X[v, :, n_key_citations_ind] = 0
+            X[v, :, n_citations_per_year_ind] = np.where(np.isnan(X_full[:, n_citations_per_year_ind]), np.nan, 0.0)
+        elif variant == 'year':
+            for n, (result_paper, matches) in enumerate(zip(result_papers, paper_matches)):
+                year = matches.year
+                if np.isnan(year):
+                    X[v, n] = X_full[n]
+                elif not any(s in i for i in cq.q_quoted + cq.q_unquoted for s in (str(year), str(np.nan))):
+                    # the year (and the missing year) can't have matched anything, so only the year columns change
+                    X[v, n] = X_full[n]
+                    X[v, n, year_match_ind] = False if cq.has_year else np.nan
+                    X[v, n, oldness_ind] = np.nan
+                    X[v, n, n_citations_per_year_ind] = np.nan
+                else:
+                    masked = mask_result(result_paper, variant)
+                    rematch_authors.append((v, n, match_paper_fields(cq, masked), masked))
+        elif variant == 'authors':
+            for n, (result_paper, matches) in enumerate(zip(result_papers, paper_matches)):
+                # the author features of a paper without authors
+                masked = matches.copy(authors=[], author_feats=[0.0, np.nan, np.nan], author_matches=([], []))
+                finish.append((v, n, masked, result_paper))
+        else:
+            i = FIELDS.index(next(iter(ABLATION_MASKS[variant])))
+            for n, (result_paper, matches) in enumerate(zip(result_papers, paper_matches)):
+                masked_paper = mask_result(result_paper, variant)
+                fields = list(matches.fields)
+                fields[i] = match_field(cq, FIELDS[i], '', matches.q_split_set, set())
+                # the venue features depend on what the title and abstract matched
+                if i < 2:
+                    fields[2] = match_field(cq, FIELDS[2], result_paper[FIELDS[2]], matches.q_split_set,
+                                            _matched_unigrams(fields[:2]))
+                masked = matches.copy(fields=fields)
+                if i == 1:
+                    masked.abstract_is_available = False
+                # the author query only depends on what the title and venue matched
+                if masked.title_and_venue_matches == matches.title_and_venue_matches:
+                    finish.append((v, n, masked, masked_paper))
+                else:
+                    rematch_authors.append((v, n, masked, masked_paper))
+    
+    match_authors_many(cq, [matches for _, _, matches, _ in rematch_authors])
+    for v, n, matches, result_paper in finish + rematch_authors:
+        X[v, n] = finish_paper_features(cq, matches, result_paper)
+    return X
+
+
 #  globals to use for posthoc_score_adjust
 FEATURE_NAMES, FEATURE_CONSTRAINTS = make_feature_names_and_constraints()
 feature_names = list(FEATURE_NAMES)
+
+# the features that only depend on the paper. see `make_static_features`
+STATIC_FEATURE_NAMES = ['abstract_is_available', 'paper_oldness', 'paper_n_citations', 'paper_n_key_citations',
+                        'paper_n_citations_divided_by_oldness']
+
+# the features that can be asked for together with `feature_mask`
+FEATURE_GROUPS = {
+    'abstract_is_available': ['abstract_is_available'],
+    'year': ['paper_year_is_in_query'],
+    **{
+        field: [f'{field}_frac_of_query_matched_in_text', f'{field}_mean_of_log_probs',
+                f'{field}_sum_of_log_probs*match_lens']
+        for field in FIELD_STAGES
+    },
+    'authors': ['sum_matched_authors_len_divided_by_query_len', 'max_matched_authors_len_divided_by_query_len',
+                'author_match_distance_from_ends'],
+    'citations': ['paper_oldness', 'paper_n_citations', 'paper_n_key_citations', 'paper_n_citations_divided_by_oldness'],
+    'across_fields': ['fraction_of_unquoted_query_matched_across_all_fields', 'sum_log_prob_of_unquoted_unmatched_unigrams',
+                      'fraction_of_quoted_query_matched_across_all_fields', 'sum_log_prob_of_quoted_unmatched_unigrams'],
+}
+# the stages of featurization that each group needs. the venue matches leave out what the
+# title and abstract matched, and the author query leaves out what the title and venue matched
+FEATURE_GROUP_STAGES = {
+    'abstract_is_available': set(),
+    'year': set(),
+    'title': {'title'},
+    'abstract': {'abstract'},
+    'venue': {'title', 'abstract', 'venue'},
+    'authors': {'title', 'abstract', 'venue', 'authors'},
+    'citations': set(),
+    'across_fields': set(FEATURIZATION_STAGES),
+}
 quotes_feat_ind = feature_names.index('fraction_of_quoted_query_matched_across_all_fields')
 year_match_ind = feature_names.index('paper_year_is_in_query')
 author_match_ind = feature_names.index('max_matched_authors_len_divided_by_query_len')
@@ -378,6 +974,10 @@ matched_all_ind = feature_names.index('fraction_of_unquoted_query_matched_across
 title_match_ind = feature_names.index('title_frac_of_query_matched_in_text')
 abstract_match_ind = feature_names.index('abstract_frac_of_query_matched_in_text')
 venue_match_ind = feature_names.index('venue_frac_of_query_matched_in_text')
+oldness_ind = feature_names.index('paper_oldness')
+n_citations_ind = feature_names.index('paper_n_citations')
+n_key_citations_ind = feature_names.index('paper_n_key_citations')
+n_citations_per_year_ind = feature_names.index('paper_n_citations_divided_by_oldness')
 
 
 def posthoc_score_adjust(scores, X, query=None):
@@ -433,3 +1033,265 @@ def posthoc_score_adjust(scores, X, query=None):
                     scores[top_inds[pattern_of_matches == most_common_pattern]] += 10000
 
     return scores
+
+
+def _posthoc_row_adjust(scores, X, long_query, has_quotes):
+    """The parts of the posthoc correction that only depend on each row itself,
+    i.e. everything except for the most common match pattern boost.
+
+    Arguments:
+        scores {np.array} -- model scores, which are adjusted in place
+        X {np.array} -- features
+        long_query {np.array or bool} -- whether the query of each row has more than one word
+        has_quotes {np.array or bool} -- whether the query of each row has quotes
+
+    Returns:
+        scores {np.array} -- the adjusted scores
+        qualifying_for_cutoff {np.array} -- whether each row can be above the pattern cutoff
+        pattern_of_matches {np.array} -- which fields each row matched in, coded as bits:
+                                          8 title/abstract, 4 author, 2 venue, 1 year
+    """
+    # need to modify scores if there are any quote matches
+    # this ensures quoted-matching results are on top
+    quotes_frac_found = X[:, quotes_feat_ind]
+    has_quotes_to_match = ~np.isnan(quotes_frac_found)
+    scores[has_quotes_to_match] += 1000 * quotes_frac_found[has_quotes_to_match]
+
+    # if there is a year match, we want to boost that a lot
+    year_match = np.isclose(X[:, year_match_ind], 1.0)
+    scores += 100 * year_match
+
+    # full author matches if the query is long enough
+    full_author_match = np.isclose(X[:, author_match_ind], 1.0) & long_query
+    scores += 100 * full_author_match
+
+    # then those with all ngrams matched anywhere
+    matched_all_flag = np.isclose(X[:, matched_all_ind], 1.0)
+    scores += 10 * matched_all_flag  
+    
+    # need to heavily penalize those with 0 percent ngram match
+    matched_none_flag = np.isclose(X[:, matched_all_ind], 0.0) 
+    scores -= 10 * matched_none_flag
+
+    qualifying_for_cutoff = np.where(has_quotes, np.isclose(X[:, quotes_feat_ind], 1.0) & matched_all_flag, matched_all_flag)
+    pattern_of_matches = 8 * ((X[:, title_match_ind] > 0) | (X[:, abstract_match_ind] > 0)) + \
+                         4 * (X[:, author_match_ind] > 0) + \
+                         2 * (X[:, venue_match_ind] > 0) + \
+                             year_match
+    return scores, qualifying_for_cutoff, pattern_of_matches
+
+
+# the match pattern of rows that only matched in the title/abstract
+TITLE_ABSTRACT_ONLY_PATTERN = 8
+
+
+def posthoc_score_adjust_many(scores, X, queries, lengths):
+    """Vectorized `posthoc_score_adjust` for many queries at once. The rows of
+    scores and X are the per-query segments stacked one after another, and the
+    adjustment of each segment is the same as calling `posthoc_score_adjust`
+    on that segment alone.
+
+    Arguments:
+        scores {np.array} -- model scores, for all of the segments
+        X {np.array} -- features, for all of the segments
+        queries {list of str} -- the query of each segment
+        lengths {list of int} -- the number of rows in each segment
+
+    Returns:
+        scores {np.array} -- the adjusted scores
+    """
+    lengths = np.asarray(lengths, dtype=int)
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    query_len = np.array([100 if query is None else len(str(query).split(' ')) for query in queries], dtype=int)
+    long_query = (query_len > 1)[segment]
+    has_quotes = np.array([query is not None and '"' in str(query) for query in queries], dtype=bool)[segment]
+
+    scores, qualifying_for_cutoff, pattern_of_matches = _posthoc_row_adjust(scores, X, long_query, has_quotes)
+    return posthoc_pattern_boost(scores, qualifying_for_cutoff, pattern_of_matches, segment, query_len > 1)
+
+
+def posthoc_pattern_boost(scores, qualifying_for_cutoff, pattern_of_matches, segment, long_query):
+    """The last part of the posthoc correction, which boosts the most common match
+    pattern among the best rows of each query. It needs all of the rows of a query,
+    while the rest of the correction (`_posthoc_row_adjust`) can be done a row at a time.
+
+    Arguments:
+        scores {np.array} -- scores from `_posthoc_row_adjust`, which are adjusted in place
+        qualifying_for_cutoff {np.array} -- from `_posthoc_row_adjust`
+        pattern_of_matches {np.array} -- from `_posthoc_row_adjust`
+        segment {np.array} -- which query each row is for. the rows of a query don't
+                              need to be next to each other
+        long_query {np.array} -- whether each query has more than one word
+
+    Returns:
+        scores {np.array} -- the adjusted scores
+    """
+    n_rows = len(scores)
+    n_segments = len(long_query)
+    lengths = np.bincount(segment, minlength=n_segments)
+    segment_start = np.cumsum(lengths) - lengths
+
+    # find the most common match appearance pattern and upweight those
+    # sort by descending score within each segment. each segment is sorted on its own
+    # with np.argsort(scores)[::-1], like `posthoc_score_adjust`, so that tied scores
+    # come out in the same order
+    row = np.arange(n_rows)
+    by_segment = np.argsort(segment, kind='stable')
+    scores_argsort = np.empty(n_rows, dtype=int)
+    for start, length in zip(segment_start, lengths):
+        rows = by_segment[start:start + length]
+        scores_argsort[start:start + length] = rows[np.argsort(scores[rows])[::-1]]
+    rank = np.empty(n_rows, dtype=int)
+    rank[scores_argsort] = row - segment_start[segment[scores_argsort]]
+    # the cutoff of each segment is the rank of its best non-qualifying row
+    no_cutoff = n_rows + 1
+    top_cutoff = np.full(n_segments, no_cutoff)
+    np.minimum.at(top_cutoff, segment[~qualifying_for_cutoff], rank[~qualifying_for_cutoff])
+    segment_qualifies = long_query & (top_cutoff != no_cutoff) & (top_cutoff > 1)
+    in_top = segment_qualifies[segment] & (rank < top_cutoff[segment])
+
+    segment_pattern = (16 * segment + pattern_of_matches)[in_top]
+    counts = np.bincount(segment_pattern, minlength=16 * n_segments).reshape(n_segments, 16)
+    # Counter.most_common breaks ties in favor of the pattern that appears first
+    first_rank = np.full(16 * n_segments, no_cutoff)
+    np.minimum.at(first_rank, segment_pattern, rank[in_top])
+    first_rank = first_rank.reshape(n_segments, 16)
+    most_common_pattern = np.argmax(counts * (no_cutoff + 1) - first_rank, axis=1)
+    # don't do this if title/abstract matches are the most common
+    # because usually the error is usually not irrelevant matches in author/venue
+    # but usually irrelevant matches in title + abstract
+    boost = in_top & (pattern_of_matches == most_common_pattern[segment]) & \
+        (most_common_pattern[segment] != TITLE_ABSTRACT_ONLY_PATTERN)
+    scores[boost] += 10000
+
+    return scores
+
+
+def _ranked(scores, index):
+    """Positions of rows in descending order of score. Ties are broken the same
+    way as np.argsort(scores, kind='stable')[::-1], i.e. later rows first.
+    """
+    return np.lexsort((index, scores))[::-1]
+
+
+def _above(scores, index, score, i):
+    """Which rows rank above the row (score, i)
+    """
+    return (scores > score) | ((scores == score) & (index > i))
+
+
+class PosthocTopK:
+    """Keeps the top k of a stream of scored rows in bounded memory. The result
+    is the same as scoring the whole stream at once with `posthoc_score_adjust`
+    and taking the k best rows: the adjustments that only depend on a row are
+    applied as rows arrive, and just enough is kept to apply the most common
+    match pattern boost with the correct global cutoff at the end. Rows with
+    exactly the same score are ranked later rows first. `posthoc_score_adjust`
+    does that too for up to 16 rows, but its sort isn't stable beyond that, so
+    when tied rows straddle the cutoff, the boosted rows can differ.
+
+    Memory doesn't depend on the length of the stream, except for 17 bytes per
+    row that is currently above the cutoff (i.e. a qualifying row that scores
+    better than every non-qualifying row so far).
+
+    Arguments:
+        k {int} -- how many rows to keep
+        query {str} -- the query that the rows were scored for
+        use_posthoc_correction {bool} -- whether to use posthoc correction
+    """
+    def __init__(self, k, query, use_posthoc_correction=True):
+        self.k = k
+        self.use_posthoc_correction = use_posthoc_correction
+        self.long_query = len(str(query).split(' ')) > 1
+        self.has_quotes = '"' in str(query)
+        self.n_seen = 0
+        empty = (np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), [])
+        # the k best rows: score, stream index, match pattern, qualifying flag and payload
+        self.best = empty
+        # the k best qualifying rows of each match pattern, in the same format
+        self.best_qualifying = empty
+        # the best non-qualifying row so far, as (score, stream index)
+        self.cutoff = None
+        # the rows that are above the cutoff: score, stream index and match pattern
+        self.top = empty[:3]
+
+    @staticmethod
+    def _concat(a, b):
+        return tuple(np.concatenate([i, j]) for i, j in zip(a[:4], b[:4])) + (a[4] + b[4],)
+
+    @staticmethod
+    def _take(rows, keep):
+        return tuple(i[keep] for i in rows[:4]) + ([rows[4][i] for i in keep],)
+
+    def add(self, scores, X, payloads):
+        """Add a chunk of rows
+
+        Arguments:
+            scores {np.array} -- model scores of the rows
+            X {np.array} -- features of the rows
+            payloads {list} -- anything to return along with each row, e.g. the papers
+        """
+        n = len(scores)
+        index = np.arange(self.n_seen, self.n_seen + n)
+        self.n_seen += n
+        if self.use_posthoc_correction:
+            scores, qualifying, pattern = _posthoc_row_adjust(scores, X, self.long_query, self.has_quotes)
+        else:
+            qualifying, pattern = np.zeros(n, dtype=bool), np.zeros(n, dtype=np.int64)
+        chunk = (scores, index, pattern.astype(np.int64), qualifying, list(payloads))
+
+        best = self._concat(self.best, chunk)
+        self.best = self._take(best, _ranked(best[0], best[1])[:self.k])
+
+        if not (self.use_posthoc_correction and self.long_query):
+            return
+
+        if (~qualifying).any():
+            i = _ranked(scores[~qualifying], index[~qualifying])[0]
+            candidate = (scores[~qualifying][i], index[~qualifying][i])
+            if self.cutoff is None or _above(np.array([candidate[0]]), np.array([candidate[1]]), *self.cutoff)[0]:
+                self.cutoff = candidate
+
+        best_qualifying = self._concat(self.best_qualifying, self._take(chunk, np.flatnonzero(qualifying)))
+        ranked = _ranked(best_qualifying[0], best_qualifying[1])
+        # the position of each row within its pattern, best first
+        by_pattern = ranked[np.argsort(best_qualifying[2][ranked], kind='stable')]
+        pattern_sorted = best_qualifying[2][by_pattern]
+        group_start = np.searchsorted(pattern_sorted, pattern_sorted)
+        keep = by_pattern[np.arange(len(by_pattern)) - group_start < self.k]
+        self.best_qualifying = self._take(best_qualifying, np.sort(keep))
+
+        top = tuple(np.concatenate([i, j[qualifying]]) for i, j in zip(self.top, chunk[:3]))
+        if self.cutoff is not None:
+            above = _above(top[0], top[1], *self.cutoff)
+            top = tuple(i[above] for i in top)
+        self.top = top
+
+    def result(self):
+        """The k best rows of everything added so far
+
+        Returns:
+            payloads {list} -- the payloads of the k best rows, best first
+            scores {np.array} -- their posthoc-corrected scores
+            indices {np.array} -- their positions in the stream
+        """
+        candidates = self.best
+        top_scores, top_index, top_pattern = self.top
+        if self.cutoff is not None and len(top_index) > 1:
+            # the most common match pattern above the cutoff, ties going to the pattern that appears first
+            ranked = _ranked(top_scores, top_index)
+            counts = np.bincount(top_pattern, minlength=16)
+            first_rank = np.full(16, len(ranked))
+            np.minimum.at(first_rank, top_pattern[ranked], np.arange(len(ranked)))
+            most_common_pattern = np.argmax(counts * (len(ranked) + 1) - first_rank)
+            if most_common_pattern != TITLE_ABSTRACT_ONLY_PATTERN:
+                candidates = self._concat(candidates, self.best_qualifying)
+                _, unique = np.unique(candidates[1], return_index=True)
+                candidates = self._take(candidates, unique)
+                scores, index, pattern, qualifying, _ = candidates
+                boost = qualifying & (pattern == most_common_pattern) & _above(scores, index, *self.cutoff)
+                scores = scores.copy()
+                scores[boost] += 10000
+                candidates = (scores,) + candidates[1:]
+        candidates = self._take(candidates, _ranked(candidates[0], candidates[1])[:self.k])
+        return candidates[4], candidates[0], candidates[1]
@@ -0,0 +1,198 @@
+import os
+import threading
+import numpy as np
+import kenlm
+
+
+# how kenlm gets a binary model into memory. the mmap-based methods share
+# one page-cache copy of the model between all of the processes using it
+LOAD_METHODS = {
+    'lazy': kenlm.LoadMethod.LAZY,  # mmap and page things in as they are used
+    'populate_or_lazy': kenlm.LoadMethod.POPULATE_OR_LAZY,  # mmap and prefault everything if possible
+    'populate': kenlm.LoadMethod.POPULATE_OR_READ,  # the kenlm default
+    'read': kenlm.LoadMethod.READ,  # a private copy in each process
+    'parallel_read': kenlm.LoadMethod.PARALLEL_READ,
+}
+
+
+def load_language_model(path, load_method='populate'):
+    """Load a kenlm model
+
+    Arguments:
+        path {str} -- the model file
+        load_method {str} -- one of the keys of LOAD_METHODS
+
+    Returns:
+        model {kenlm.Model} -- the loaded model
+    """
+    if load_method not in LOAD_METHODS:
+        raise ValueError(f'load_method should be one of {sorted(LOAD_METHODS)}, not {load_method!r}')
+    config = kenlm.Config()
+    config.load_method = LOAD_METHODS[load_method]
+    return kenlm.Model(path, config)
+
+
+def warm_page_cache(paths, chunk_size=64 * 1024 * 1024):
+    """Read files once so that they are in the OS page cache. Processes that
+    then mmap the language models (e.g. with load_method='lazy') all share
+    that one copy instead of each faulting in their own pages from disk.
+
+    Arguments:
+        paths {list of str} -- the files to read
+        chunk_size {int} -- how many bytes to read at a time
+    """
+    for path in paths:
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while f.read(chunk_size):
+                pass
+
+
+class LazyLanguageModel:
+    """A kenlm model that is only loaded the first time it is used.
+
+    Arguments:
+        path {str} -- the model file
+        load_method {str} -- one of the keys of LOAD_METHODS
+    """
+    def __init__(self, path, load_method='populate'):
+        if load_method not in LOAD_METHODS:
+            raise ValueError(f'load_method should be one of {sorted(LOAD_METHODS)}, not {load_method!r}')
+        self.path = path
+        self.load_method = load_method
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = load_language_model(self.path, self.load_method)
+        return self._model
+
+    def __getattr__(self, attr):
+        return getattr(self.model, attr)
+
+    def score(self, sentence, bos=True, eos=True):
+        return self.model.score(sentence, bos=bos, eos=eos)
+
+
+def score_prefixes(model, words):
+    """Score every prefix of a list of words in one pass by chaining the
+    kenlm state from one word to the next. The n-th result is identical to
+    model.score(' '.join(words[:n]), bos=False, eos=False).
+
+    Arguments:
+        model {kenlm.Model} -- the language model
+        words {list of str} -- the words to score
+
+    Returns:
+        scores {list of float} -- log10 probability of each prefix
+    """
+    if hasattr(model, 'score_prefixes'):
+        return model.score_prefixes(words)
+    state, out_state = kenlm.State(), kenlm.State()
+    model.NullContextWrite(state)
+    # kenlm accumulates in a C float, so we do the same to get the same bits
+    total = np.float32(0)
+    scores = []
+    for word in words:
+        total = np.float32(total + np.float32(model.BaseScore(state, word, out_state)))
+        state, out_state = out_state, state
+        scores.append(float(total))
+    return scores
+
+
+class NgramLogProbTable:
+    """Log-probabilities of query n-grams under the title/abstract, author
+    and venue language models. Every string that featurization scores is
+    derived from the query, so the table is filled once per query and the
+    per-paper work is only dictionary lookups.
+
+    Arguments:
+        lms {tuple} -- title/abstract, author and venue language models
+        max_ngram_len {int} -- longest n-grams added by `add_ngrams`
+    """
+    def __init__(self, lms, max_ngram_len=7):
+        self.lms = lms
+        self.max_ngram_len = max_ngram_len
+        # maps a string to its (title_abstract, author, venue, max) log-probs
+        self.table = {}
+
+    def _add_chain(self, words):
+        # one state chain per language model covers every prefix of words
+        chains = [score_prefixes(lm, words) for lm in self.lms]
+        for n in range(1, len(words) + 1):
+            key = ' '.join(words[:n])
+            if key not in self.table:
+                log_probs = tuple(chain[n - 1] for chain in chains)
+                self.table[key] = log_probs + (np.max([log_probs[0], log_probs[2], log_probs[1]]),)
+
+    def add_ngrams(self, text):
+        """Add every n-gram of text up to max_ngram_len words long
+        """
+        words = text.split()
+        for i in range(len(words)):
+            self._add_chain(words[i:i + self.max_ngram_len])
+
+    def add_phrase(self, text):
+        """Add text as a whole, regardless of how many words it has
+        """
+        words = text.split()
+        if len(words) > 0:
+            self._add_chain(words)
+
+    def lookup(self, s):
+        """The (title_abstract, author, venue, max) log-probs of s.
+        Strings that weren't added up front are scored directly.
+        """
+        try:
+            return self.table[s]
+        except KeyError:
+            log_probs = tuple(lm.score(s, eos=False, bos=False) for lm in self.lms)
+            self.table[s] = log_probs + (np.max([log_probs[0], log_probs[2], log_probs[1]]),)
+            return self.table[s]
+
+
+class CachedLanguageModel:
+    """Wraps a kenlm.Model so that the scores it computes go through an
+    `LMScoreCache`. Anything other than scoring is passed through to the
+    wrapped model.
+
+    Arguments:
+        model {kenlm.Model} -- the language model
+        name {str} -- identifies the model in the cache
+        cache {LMScoreCache} -- where scores are kept
+    """
+    def __init__(self, model, name, cache):
+        self.model = model
+        self.name = name
+        self.cache = cache
+
+    def __getattr__(self, attr):
+        return getattr(self.model, attr)
+
+    def score(self, sentence, bos=True, eos=True):
+        name = f'{self.name}:{int(bos)}{int(eos)}'
+        found = self.cache.get_many(name, [sentence])
+        if sentence in found:
+            return found[sentence]
+        score = self.model.score(sentence, bos=bos, eos=eos)
+        self.cache.put_many(name, [(sentence, score)])
+        return score
+
+    def score_prefixes(self, words):
+        name = f'{self.name}:00'
+        prefixes = [' '.join(words[:n]) for n in range(1, len(words) + 1)]
+        found = self.cache.get_many(name, prefixes)
+        if len(found) == len(prefixes):
+            return [found[prefix] for prefix in prefixes]
+        scores = score_prefixes(self.model, words)
+        self.cache.put_many(name, [(prefix, score) for prefix, score in zip(prefixes, scores) if prefix not in found])
+        return scores
@@ -0,0 +1,277 @@
+"""Opt-in instrumentation of scoring: how long each stage takes, how many calls
+go to the language models, and how many candidates (and how long their fields)
+each request has. Give S2Ranker a `Metrics` to turn it on:
+
+    metrics = Metrics()
+    metrics.add_callback(lambda record: print(record['seconds'], record['stages']))
+    s2ranker = S2Ranker(data_dir, metrics=metrics)
+    s2ranker.score(query, papers)
+    print(metrics.to_prometheus())
+
+Without one, each stage only costs entering a shared no-op context manager.
+"""
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+from s2search.lm import score_prefixes
+
+# the stages of a request, in the order they happen. the language model time
+# ('lm') is also part of the time of the stages that the calls happen in
+STAGES = ['prepare', 'compile_query', 'lm', 'match_fields', 'match_authors', 'finish_features', 'predict', 'posthoc']
+
+# upper bounds of the histogram buckets
+CANDIDATE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+FIELD_LENGTH_BUCKETS = {
+    'title': (16, 32, 64, 128, 256, 512, 1024),
+    'abstract': (128, 256, 512, 1024, 2048, 4096, 8192),
+    'venue': (8, 16, 32, 64, 128, 256),
+    'authors': (1, 2, 5, 10, 20, 50, 100, 1000),  # authors per paper, not characters
+}
+
+_NO_TIMER = contextlib.nullcontext()
+
+
+def timer(recorder, stage):
+    """A context manager that adds the time spent in it to stage of the current
+    request of recorder, or does nothing if recorder is None
+    """
+    if recorder is None:
+        return _NO_TIMER
+    return recorder.timer(stage)
+
+
+def recording(recorder, kind):
+    """A context manager that records the block as a request of recorder (see
+    `Metrics.request`), or does nothing if recorder is None
+    """
+    if recorder is None:
+        return _NO_TIMER
+    return recorder.request(kind)
+
+
+class Histogram:
+    """Cumulative histogram in the format of Prometheus
+
+    Arguments:
+        buckets {tuple} -- the upper bounds of the buckets, in increasing order
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = np.zeros(len(self.buckets) + 1, dtype=np.int64)
+        self.sum = 0.0
+
+    def observe(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        # np.searchsorted with side='left' puts a value equal to a bound in that bound's bucket
+        self.counts += np.bincount(np.searchsorted(self.buckets, values), minlength=len(self.counts))
+        self.sum += float(values.sum())
+
+    def snapshot(self):
+        return {
+            'buckets': {str(bound): int(n) for bound, n in zip(self.buckets, np.cumsum(self.counts))},
+            'count': int(self.counts.sum()),
+            'sum': self.sum,
+        }
+
+
+class CountingLanguageModel:
+    """Wraps a language model to count and time the calls that reach it.
+    Anything other than scoring is passed through to the wrapped model.
+
+    Arguments:
+        model {kenlm.Model} -- the language model
+        name {str} -- which model it is in the metrics
+        metrics {Metrics} -- where the calls are recorded
+    """
+    def __init__(self, model, name, metrics):
+        self.model = model
+        self.name = name
+        self.metrics = metrics
+
+    def __getattr__(self, attr):
+        return getattr(self.model, attr)
+
+    def score(self, sentence, bos=True, eos=True):
+        with self.metrics.timer('lm'):
+            score = self.model.score(sentence, bos=bos, eos=eos)
+        self.metrics.count_lm_calls(self.name, 1)
+        return score
+
+    def score_prefixes(self, words):
+        # one BaseScore call per word
+        with self.metrics.timer('lm'):
+            scores = score_prefixes(self.model, words)
+        self.metrics.count_lm_calls(self.name, len(words))
+        return scores
+
+
+class Metrics:
+    """Records what happens in each request (a call to S2Ranker.score and the like),
+    passes the record of every finished request to the callbacks, and keeps
+    totals over all of them for export. Requests in different threads are
+    recorded separately. With forked workers, every process has its own totals.
+
+    Arguments:
+        callbacks {list of callables} -- called with the record (a dict) of each finished request
+    """
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Zero all of the totals
+        """
+        with self._lock:
+            self.requests = {}
+            self.request_seconds = 0.0
+            self.stage_seconds = {}
+            self.lm_calls = {}
+            self.candidates = Histogram(CANDIDATE_BUCKETS)
+            self.field_lengths = {field: Histogram(buckets) for field, buckets in FIELD_LENGTH_BUCKETS.items()}
+
+    def add_callback(self, callback):
+        """Call callback(record) after every request. See `request` for what's in a record
+        """
+        self.callbacks.append(callback)
+
+    @property
+    def current(self):
+        """The record of the request that this thread is in, if any
+        """
+        return getattr(self._local, 'record', None)
+
+    @contextlib.contextmanager
+    def request(self, kind):
+        """Record everything in the block as one request. A request inside of
+        another one (e.g. featurize inside of score) is part of the outer one.
+
+        The record is a dict with:
+            kind {str} -- e.g. 'score'
+            seconds {float} -- wall time of the whole request
+            stages {dict} -- wall time of each of STAGES that ran
+            lm_calls {dict} -- calls that reached each language model
+            n_candidates {int} -- how many papers were scored
+            field_lengths {dict} -- the 'total' and 'max' length of each field over the papers,
+                                    in characters (authors are counted per paper instead)
+        """
+        if self.current is not None:
+            yield self.current
+            return
+        record = {'kind': kind, 'seconds': 0.0, 'stages': {}, 'lm_calls': {}, 'n_candidates': 0, 'field_lengths': {}}
+        self._local.record = record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self._local.record = None
+            self._add(record)
+            for callback in self.callbacks:
+                callback(record)
+
+    def _add(self, record):
+        with self._lock:
+            self.requests[record['kind']] = self.requests.get(record['kind'], 0) + 1
+            self.request_seconds += record['seconds']
+            for stage, seconds in record['stages'].items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            for name, n in record['lm_calls'].items():
+                self.lm_calls[name] = self.lm_calls.get(name, 0) + n
+            self.candidates.observe([record['n_candidates']])
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Add the time spent in the block to stage of the current request
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.current
+            if record is not None:
+                record['stages'][stage] = record['stages'].get(stage, 0.0) + time.perf_counter() - start
+
+    def count_lm_calls(self, name, n):
+        record = self.current
+        if record is not None:
+            record['lm_calls'][name] = record['lm_calls'].get(name, 0) + n
+
+    def observe_papers(self, prepared_papers):
+        """Record the number of candidates of the current request and the lengths
+        of their fields, from papers that have been through S2Ranker.prepare_result
+        """
+        record = self.current
+        if record is None:
+            return
+        record['n_candidates'] += len(prepared_papers)
+        lengths = {
+            'title': [len(paper['paper_title_cleaned']) for paper in prepared_papers],
+            'abstract': [len(paper['paper_abstract_cleaned']) for paper in prepared_papers],
+            'venue': [len(paper['paper_venue_cleaned']) for paper in prepared_papers],
+            'authors': [len(paper['author_name'] or []) for paper in prepared_papers],
+        }
+        for field, values in lengths.items():
+            summary = record['field_lengths'].setdefault(field, {'total': 0, 'max': 0})
+            summary['total'] += int(np.sum(values))
+            summary['max'] = max([summary['max']] + values)
+        with self._lock:
+            for field, values in lengths.items():
+                self.field_lengths[field].observe(values)
+
+    def snapshot(self):
+        """The totals over all of the requests so far
+
+        Returns:
+            totals {dict} -- JSON-serializable totals
+        """
+        with self._lock:
+            return {
+                'requests': dict(self.requests),
+                'request_seconds': self.request_seconds,
+                'stage_seconds': dict(self.stage_seconds),
+                'lm_calls': dict(self.lm_calls),
+                'candidates': self.candidates.snapshot(),
+                'field_lengths': {field: h.snapshot() for field, h in self.field_lengths.items()},
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix='s2search'):
+        """The totals in the Prometheus text exposition format, e.g. for a /metrics endpoint
+        """
+        totals = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f'{prefix}_{name}{suffix}' + (f'{{{label_text}}}' if label_text else '') + f' {value}')
+
+        def histogram_samples(snapshot, labels):
+            samples = [('_bucket', dict(labels, le=bound), n) for bound, n in snapshot['buckets'].items()]
+            samples.append(('_bucket', dict(labels, le='+Inf'), snapshot['count']))
+            samples.append(('_sum', labels, snapshot['sum']))
+            samples.append(('_count', labels, snapshot['count']))
+            return samples
+
+        metric('requests_total', 'counter', 'Requests by kind',
+               [('', {'kind': kind}, n) for kind, n in sorted(totals['requests'].items())])
+        metric('request_seconds_total', 'counter', 'Wall time of all requests',
+               [('', {}, totals['request_seconds'])])
+        metric('stage_seconds_total', 'counter', 'Wall time spent in each stage of scoring',
+               [('', {'stage': stage}, seconds) for stage, seconds in sorted(totals['stage_seconds'].items())])
+        metric('lm_calls_total', 'counter', 'Calls that reached each language model',
+               [('', {'lm': name}, n) for name, n in sorted(totals['lm_calls'].items())])
+        metric('candidates', 'histogram', 'Candidate papers per request',
+               histogram_samples(totals['candidates'], {}))
+        metric('field_length', 'histogram', 'Characters per paper field (authors per paper for authors)',
+               [sample for field, snapshot in totals['field_lengths'].items()
+                for sample in histogram_samples(snapshot, {'field': field})])
+        return '\n'.join(lines) + '\n'
@@ -1,9 +1,26 @@
 import os
-import pickle
-import kenlm
+import itertools
+import multiprocessing
 import numpy as np
+import pandas as pd
 from s2search.text import fix_text, fix_author_text
-from s2search.features import make_features, posthoc_score_adjust
+from s2search.lm import CachedLanguageModel, LazyLanguageModel, load_language_model
+from s2search.backends import load_backend
+from s2search.metrics import CountingLanguageModel, timer, recording
+from s2search.features import CompiledQuery, make_papers_features, posthoc_score_adjust, posthoc_score_adjust_many
+from s2search.features import PosthocTopK, ABLATION_VARIANTS, make_ablation_features, FEATURE_NAMES
+
+# the title/abstract, author and venue language models, in the order that featurization expects
+LM_NAMES = ['titles_abstracts_lm', 'authors_lm', 'venues_lm']
+
+# the ranker that the parallel featurization workers use. it is set right before
+# the workers are forked so that they inherit the loaded models copy-on-write
+_worker_ranker = None
+
+
+def _featurize_chunk(args):
+    query, papers, corpus, columns = args
+    return _worker_ranker.featurize(query, papers, parallel=False, corpus=corpus, columns=columns)
 
 
 class S2Ranker:
@@ -12,48 +29,352 @@ class S2Ranker:
     Arguments:
         data_dir {str} -- where the language models and lightgbm model live.
         use_posthoc_correction {bool} -- whether to use posthoc correction
+        lm_cache {LMScoreCache} -- optional cache for language model scores that
+                                   can be shared across queries and processes
+        lm_load_method {str} -- how kenlm loads the language models. 'lazy' and
+                                'populate_or_lazy' mmap the models so that all processes
+                                share one page-cache copy. see s2search.lm.LOAD_METHODS
+        lazy_lms {bool} -- whether to defer loading each language model until it is first used
+        n_jobs {int} -- number of forked worker processes to featurize with. 1 means no workers
+        parallel_threshold {int} -- calls with fewer papers than this are featurized serially
+                                    because it isn't worth the inter-process communication
+        prepared_cache {PreparedPaperCache} -- optional cache of prepared papers
+        backend {str} -- how the lightgbm model is evaluated: 'pickle' (the sklearn wrapper),
+                         'booster' (native lightgbm) or 'numpy' (no lightgbm at all).
+                         see s2search.backends
+        backend_options {dict} -- passed on to the backend, e.g. {'num_threads': 4}
+        lms {tuple} -- optionally, already loaded language models in the order of LM_NAMES
+                       (anything with kenlm's interface, e.g. the stubs in benchmarks/synthetic.py)
+                       instead of the ones in data_dir
+        lm_table {str} -- optionally, a compact n-gram table (see s2search.compact_lm) to use instead of
+                          the language models in data_dir. it takes a fraction of their memory, but the
+                          n-grams that aren't in it are estimated, so scores can differ
+        metrics {Metrics} -- optionally, where to record the stage timings, language model calls
+                             and candidates of each request. see s2search.metrics. the stages of
+                             featurization that runs in the worker processes aren't recorded
+        feature_dtype {np.dtype} -- the dtype of the feature matrices. float32 halves their memory,
+                                    but features that are rounded across one of the model's thresholds
+                                    change the scores a little, so float64 is the default
+        feature_store {Corpus} -- optionally, a corpus (see s2search.corpus) of papers to take by id
+                                  instead of preparing them: papers whose id is in it are featurized
+                                  with its prepared text, citation counts and static features
     """
-    def __init__(self, data_dir, use_posthoc_correction=True):
+    def __init__(self, data_dir, use_posthoc_correction=True, lm_cache=None, lm_load_method='populate', lazy_lms=False,
+                 n_jobs=1, parallel_threshold=1000, prepared_cache=None, backend='pickle', backend_options=None,
+                 lms=None, metrics=None, feature_dtype=np.float64, feature_store=None, lm_table=None):
         self.use_posthoc_correction = use_posthoc_correction
         self.data_dir = data_dir
+        self.lm_cache = lm_cache
+        self.prepared_cache = prepared_cache
+        self.lm_paths = [os.path.join(data_dir, f'{name}.binary') for name in LM_NAMES]
         
-        lm_title_abstracts = kenlm.Model(os.path.join(data_dir, 'titles_abstracts_lm.binary'))
-        lm_authors = kenlm.Model(os.path.join(data_dir, 'authors_lm.binary'))
-        lm_venues = kenlm.Model(os.path.join(data_dir, 'venues_lm.binary'))
-        self.lms = (lm_title_abstracts, lm_authors, lm_venues)
+        if lms is not None:
+            self.lms = tuple(lms)
+        elif lm_table is not None:
+            # imported here since compact_lm imports this module when it's run as a script
+            from s2search.compact_lm import load_compact_lms
+            self.lms = load_compact_lms(lm_table)
+        elif lazy_lms:
+            self.lms = tuple(LazyLanguageModel(path, lm_load_method) for path in self.lm_paths)
+        else:
+            self.lms = tuple(load_language_model(path, lm_load_method) for path in self.lm_paths)
+        self.metrics = metrics
+        self.feature_dtype = feature_dtype
+        self.feature_store = feature_store
+        if metrics is not None:
+            self.lms = tuple(CountingLanguageModel(lm, name, metrics) for lm, name in zip(self.lms, LM_NAMES))
+        if lm_cache is not None:
+            self.lms = tuple(CachedLanguageModel(lm, name, lm_cache) for lm, name in zip(self.lms, LM_NAMES))
+
+        self.model = load_backend(data_dir, backend, **(backend_options or {}))
+
+        self.n_jobs = n_jobs
+        self.parallel_threshold = parallel_threshold
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the featurization worker processes, if there are any
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
 
-        with open(os.path.join(data_dir, 'lightgbm_model.pickle'), 'rb') as f:
-            self.model = pickle.load(f)
+    @property
+    def pool(self):
+        """The persistent pool of featurization workers, which is forked on first use
+        """
+        global _worker_ranker
+        if self._pool is None:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise RuntimeError('parallel featurization needs the fork start method')
+            _worker_ranker = self
+            self._pool = multiprocessing.get_context('fork').Pool(self.n_jobs)
+        return self._pool
+
+    def featurize(self, query, papers, parallel=True, corpus=None, compiled_query=None, columns=None, out=None):
+        """Featurize each pair of (query, paper) for all papers. If n_jobs > 1 and
+        there are at least parallel_threshold papers, the papers are split into
+        chunks that the worker processes prepare and featurize. The rows come out
+        in the same order and with the same values either way.
+
+        Arguments:
+            query {str} -- plain text search query 
+            papers {list of dicts} -- A list of candidate papers, each of which
+                                      is a dictionary. If corpus is given, these
+                                      are row indices into the corpus instead.
+            parallel {bool} -- whether the worker processes may be used
+            corpus {Corpus} -- optional corpus of already prepared papers
+            compiled_query {CompiledQuery} -- optionally, the already compiled query
+            columns {np.array} -- optionally, a boolean mask of the features to compute, e.g. for
+                                  a cheap first-pass model. the others are nan, and the stages of
+                                  featurization that only they need are skipped. see `feature_mask`
+            out {np.array} -- optionally, an array of shape (len(papers), len(FEATURE_NAMES)) to
+                              write the features into
+
+        Returns:
+            X {np.array} -- the features, one row per paper in papers
+        """
+        query = str(query)
+        with recording(self.metrics, 'featurize'):
+            if parallel and self.n_jobs > 1 and len(papers) >= self.parallel_threshold:
+                # a few chunks per worker keeps them all busy when some chunks are slower
+                chunk_size = int(np.ceil(len(papers) / (4 * self.n_jobs)))
+                chunks = [(query, papers[i:i + chunk_size], corpus, columns) for i in range(0, len(papers), chunk_size)]
+                if out is None:
+                    out = np.empty((len(papers), len(FEATURE_NAMES)), dtype=self.feature_dtype)
+                for i, rows in zip(range(0, len(papers), chunk_size), self.pool.imap(_featurize_chunk, chunks)):
+                    out[i:i + len(rows)] = rows
+                return out
+            if compiled_query is None:
+                with timer(self.metrics, 'compile_query'):
+                    compiled_query = CompiledQuery(query, self.lms, recorder=self.metrics)
+            with timer(self.metrics, 'prepare'):
+                if corpus is not None:
+                    prepared = [corpus.row(i) for i in papers]
+                    static_features = corpus.static_features(papers)
+                elif self.feature_store is not None:
+                    prepared, static_features = self.prepare_from_store(papers)
+                else:
+                    prepared = [self.prepare_result(paper, self.prepared_cache) for paper in papers]
+                    static_features = None
+            if self.metrics is not None:
+                self.metrics.observe_papers(prepared)
+            return make_papers_features(compiled_query, prepared, columns, out, self.feature_dtype, static_features)
+
+    def prepare_from_store(self, papers):
+        """Prepare papers, taking the ones whose id is in the feature store from it
+
+        Arguments:
+            papers {list of dicts} -- A list of candidate papers, each of which
+                                      is a dictionary.
+
+        Returns:
+            prepared {list} -- a prepared paper (or a row of the store) per paper
+            static_features {list} -- the stored static features of each paper, or None
+                                      for the ones that have to be computed
+        """
+        store = self.feature_store
+        id_field = store.meta['id_field']
+        has_static_features = store.has_static_features
+        prepared, static_features = [], []
+        for paper in papers:
+            paper_id = paper.get(id_field)
+            row = None if paper_id is None else store.id_to_row.get(str(paper_id))
+            if row is None:
+                prepared.append(self.prepare_result(paper, self.prepared_cache))
+                static_features.append(None)
+            else:
+                prepared.append(store.row(row))
+                static_features.append(store.columns['static_features'][row] if has_static_features else None)
+        return prepared, static_features
     
-    def score(self, query, papers):
+    def score(self, query, papers, explain=False):
         """Score each pair of (query, paper) for all papers
 
         Arguments:
             query {str} -- plain text search query 
             papers {list of dicts} -- A list of candidate papers, each of which
                                       is a dictionary.
+            explain {bool} -- whether to also return how much each feature contributed
+                              to each score (see `contributions`)
 
         Returns:
             scores {np.array} -- an array of scores, one per paper in papers
+            contributions {pd.DataFrame} -- only if explain. one row per paper in papers
         """
         query = str(query)
-        X = np.array([
-            make_features(query, self.prepare_result(paper), self.lms) 
-            for paper in papers
-        ])
+        with recording(self.metrics, 'score'):
+            X = self.featurize(query, list(papers))
+            with timer(self.metrics, 'predict'):
+                scores = self.model.predict(X)
+            # the posthoc correction adjusts the scores in place
+            raw_scores = scores.copy() if explain else None
+            if self.use_posthoc_correction:
+                with timer(self.metrics, 'posthoc'):
+                    scores = posthoc_score_adjust(scores, X, query)
+            if explain:
+                return scores, self.contributions(X, raw_scores, scores)
+            return scores
+
+    def contributions(self, X, raw_scores, scores, chunk_size=10000):
+        """Split scores into exact per-feature contributions with lightgbm's
+        pred_contrib (TreeSHAP), which takes one multithreaded pass over X.
+        The model's part of each score is the sum of the FEATURE_NAMES columns
+        and 'bias' (the model's expected value). 'posthoc_adjustment' is what
+        the posthoc correction added on top, so each row adds up to its score.
+
+        Arguments:
+            X {np.array} -- the features, one row per paper
+            raw_scores {np.array} -- the model's predictions for X
+            scores {np.array} -- the final scores, after any posthoc correction
+            chunk_size {int} -- rows explained at a time, which bounds the memory used
+
+        Returns:
+            contributions {pd.DataFrame} -- one row per row of X
+        """
+        n_features = len(FEATURE_NAMES)
+        contributions = np.zeros((len(X), n_features + 2))
+        for start in range(0, len(X), chunk_size):
+            contributions[start:start + chunk_size, :n_features + 1] = self.model.predict_contrib(
+                X[start:start + chunk_size]
+            )
+        contributions[:, -1] = np.asarray(scores) - np.asarray(raw_scores)
+        return pd.DataFrame(contributions, columns=list(FEATURE_NAMES) + ['bias', 'posthoc_adjustment'])
+
+    def top_k(self, query, papers, k=100, chunk_size=1000):
+        """Find the k best papers for a query among a (possibly very long) stream
+        of candidates. Papers are featurized and scored in chunks and only what's
+        needed for the final ranking is kept, so memory doesn't grow with the
+        number of candidates. The result is the same as taking the k best papers
+        by `score`, except that papers with exactly tied scores are ranked later
+        papers first (see `PosthocTopK`).
+
+        Arguments:
+            query {str} -- plain text search query 
+            papers {iterable of dicts} -- candidate papers, e.g. a generator
+            k {int} -- how many papers to return
+            chunk_size {int} -- how many papers to featurize and predict at a time
+
+        Returns:
+            top_papers {list of dicts} -- the k best papers, best first
+            top_scores {np.array} -- their scores
+            top_indices {np.array} -- their positions in papers
+        """
+        query = str(query)
+        with recording(self.metrics, 'top_k'):
+            with timer(self.metrics, 'compile_query'):
+                compiled_query = CompiledQuery(query, self.lms, recorder=self.metrics)
+            top = PosthocTopK(k, query, self.use_posthoc_correction)
+            papers = iter(papers)
+            while True:
+                chunk = list(itertools.islice(papers, chunk_size))
+                if len(chunk) == 0:
+                    break
+                X = self.featurize(query, chunk, compiled_query=compiled_query)
+                with timer(self.metrics, 'predict'):
+                    scores = self.model.predict(X)
+                with timer(self.metrics, 'posthoc'):
+                    top.add(scores, X, chunk)
+            return top.result()
+
+    def score_corpus(self, query, corpus, rows=None):
+        """Score papers of a columnar `Corpus` (see s2search.corpus) by row index,
+        without building a dict per paper.
+
+        Arguments:
+            query {str} -- plain text search query 
+            corpus {Corpus} -- the corpus of prepared papers
+            rows {list of int} -- the rows to score. all of them if None
+
+        Returns:
+            scores {np.array} -- an array of scores, one per row
+        """
+        query = str(query)
+        if rows is None:
+            rows = range(len(corpus))
+        with recording(self.metrics, 'score_corpus'):
+            X = self.featurize(query, list(rows), corpus=corpus)
+            with timer(self.metrics, 'predict'):
+                scores = self.model.predict(X)
+            if self.use_posthoc_correction:
+                with timer(self.metrics, 'posthoc'):
+                    scores = posthoc_score_adjust(scores, X, query)
+            return scores
+
+    def score_many(self, queries, papers_lists):
+        """Score many queries, each with its own list of candidate papers.
+        The features of all the queries are stacked into one matrix so that
+        there is one model prediction and one (vectorized) posthoc correction.
+        The scores are the same as calling `score` once per query.
+
+        Arguments:
+            queries {list of str} -- plain text search queries
+            papers_lists {list of lists of dicts} -- the candidate papers of each query
+
+        Returns:
+            scores {list of np.array} -- the scores of the papers of each query
+        """
+        queries = [str(query) for query in queries]
+        papers_lists = [list(papers) for papers in papers_lists]
+        lengths = [len(papers) for papers in papers_lists]
+        if sum(lengths) == 0:
+            return [np.array([]) for _ in queries]
+        with recording(self.metrics, 'score_many'):
+            # every query's rows are written straight into its slice of one matrix
+            X = np.empty((sum(lengths), len(FEATURE_NAMES)), dtype=self.feature_dtype)
+            for query, papers, start, end in zip(queries, papers_lists, np.cumsum([0] + lengths), np.cumsum(lengths)):
+                self.featurize(query, papers, out=X[start:end])
+            with timer(self.metrics, 'predict'):
+                scores = self.model.predict(X)
+            if self.use_posthoc_correction:
+                with timer(self.metrics, 'posthoc'):
+                    scores = posthoc_score_adjust_many(scores, X, queries, lengths)
+            return np.split(scores, np.cumsum(lengths)[:-1])
+    
+    def score_ablations(self, query, papers, variants=ABLATION_VARIANTS):
+        """Score papers as they are and with each of their fields masked, e.g. to see how
+        much each field contributes to the ranking. Column j is the same as calling `score`
+        with field variants[j] masked in all of the papers (see ABLATION_MASKS in
+        s2search.features), but every paper is only featurized once.
+
+        Arguments:
+            query {str} -- plain text search query 
+            papers {list of dicts} -- A list of candidate papers, each of which
+                                      is a dictionary.
+            variants {list of str} -- the field to mask for each column, or 'full' for none
+
+        Returns:
+            scores {np.array} -- scores of shape (len(papers), len(variants))
+        """
+        query = str(query)
+        papers = [self.prepare_result(paper, self.prepared_cache) for paper in papers]
+        X = make_ablation_features(CompiledQuery(query, self.lms), papers, variants)
+        n_variants, n_papers, n_features = X.shape
+        if n_variants * n_papers == 0:
+            return np.zeros((n_papers, n_variants))
+        X = X.reshape(n_variants * n_papers, n_features)
         scores = self.model.predict(X)
         if self.use_posthoc_correction:
-            scores = posthoc_score_adjust(scores, X, query)
-        return scores
-    
+            # each variant is corrected on its own, like a separate call to score
+            scores = posthoc_score_adjust_many(scores, X, [query] * n_variants, [n_papers] * n_variants)
+        return scores.reshape(n_variants, n_papers).T
+
     @classmethod
-    def prepare_result(cls, paper):
+    def prepare_result(cls, paper, cache=None):
         """Prepare the raw text result for featurization
 
         Arguments:
             paper {dict} -- A dictionary that has the required paper fields:
                             'title', 'abstract', 'authors', 'venues', 'year',
                             'n_citations', 'n_key_citations'
+            cache {PreparedPaperCache} -- optional cache of the prepared text fields
         Returns:
             out {dict} -- A dictionary where the paper fields have been pre-processed.
         """
@@ -63,8 +384,24 @@ class S2Ranker:
         out['n_key_citations'] = paper.get('n_key_citations', int(-1.4 + np.log1p(out['n_citations'])))
         if out['n_key_citations'] < 0:
             out['n_key_citations'] = 0
-        out['paper_title_cleaned'] = fix_text(paper.get('title', ''))
-        out['paper_abstract_cleaned'] = fix_text(paper.get('abstract', ''))
-        out['paper_venue_cleaned'] = fix_text(paper.get('venue', ''))
-        out['author_name'] = [fix_author_text(i) for i in paper.get('authors', [])]
+        if cache is None:
+            out.update(cls.prepare_text(paper))
+        else:
+            out.update(cache.get_or_prepare(paper, cls.prepare_text))
         return out
+
+    @staticmethod
+    def prepare_text(paper):
+        """Prepare the text fields of a paper, which is the expensive part of `prepare_result`
+
+        Arguments:
+            paper {dict} -- A dictionary with 'title', 'abstract', 'venue' and 'authors' 
+        Returns:
+            out {dict} -- A dictionary of the pre-processed text fields.
+        """
+        return {
+            'paper_title_cleaned': fix_text(paper.get('title', '')),
+            'paper_abstract_cleaned': fix_text(paper.get('abstract', '')),
+            'paper_venue_cleaned': fix_text(paper.get('venue', '')),
+            'author_name': [fix_author_text(i) for i in paper.get('authors', [])],
+        }
@@ -0,0 +1,264 @@
+"""A first-stage BM25 retriever for collections that are too big to rerank in
+full, but too small to need a search cluster in front of the ranker. The index
+is built from the cleaned fields of a `Corpus` (see s2search.corpus), stored as
+compact postings arrays that are memory-mapped, and `Searcher.search` reranks
+what it retrieves with the ranker, so the cost of a query depends on the
+postings of its words and on how many candidates are reranked rather than on
+the size of the collection:
+
+    build_bm25_index(Corpus('my_corpus/'), 'my_index/')
+    searcher = Searcher(s2ranker, Corpus('my_corpus/'), BM25Index('my_index/'))
+    paper_ids, scores, rows = searcher.search('neural networks', k=100)
+"""
+import os
+import json
+import bisect
+import numpy as np
+from s2search.text import fix_text, STOPWORDS
+
+FORMAT_VERSION = 1
+
+# how much a word counts in each field. these are the cleaned fields of a Corpus
+FIELD_WEIGHTS = {
+    'paper_title_cleaned': 3.0,
+    'paper_abstract_cleaned': 1.0,
+    'paper_venue_cleaned': 1.0,
+    'author_name': 2.0,
+}
+
+
+def tokenize(text):
+    """The words of cleaned text that are indexed: everything but stopwords
+    and punctuation
+    """
+    return [word for word in text.split() if word not in STOPWORDS and any(c.isalnum() for c in word)]
+
+
+def _paper_terms(corpus, i, field_weights):
+    # the weighted term frequencies of paper i
+    counts = {}
+    for field, weight in field_weights.items():
+        texts = corpus.get(i, field)
+        if field != 'author_name':
+            texts = [texts]
+        for text in texts:
+            for word in tokenize(text):
+                counts[word] = counts.get(word, 0.0) + weight
+    return counts
+
+
+def build_bm25_index(corpus, path, field_weights=FIELD_WEIGHTS, chunk_size=100000):
+    """Offline step to index the papers of a corpus for `BM25Index`. The postings
+    of each chunk of papers are collected as arrays, so the memory this takes is
+    about the size of the index.
+
+    Arguments:
+        corpus {Corpus} -- the papers, already cleaned
+        path {str} -- the index directory, which is created if needed
+        field_weights {dict} -- how much a word counts in each field of the corpus
+        chunk_size {int} -- how many papers to collect postings of at a time
+
+    Returns:
+        n_terms {int} -- the number of distinct indexed words
+    """
+    vocabulary = {}
+    term_chunks, doc_chunks, tf_chunks = [], [], []
+    doc_lengths = np.zeros(len(corpus), dtype=np.float32)
+    for start in range(0, len(corpus), chunk_size):
+        terms, docs, tfs = [], [], []
+        for i in range(start, min(start + chunk_size, len(corpus))):
+            counts = _paper_terms(corpus, i, field_weights)
+            for word, tf in counts.items():
+                terms.append(vocabulary.setdefault(word, len(vocabulary)))
+                tfs.append(tf)
+            docs.extend([i] * len(counts))
+            doc_lengths[i] = sum(counts.values())
+        term_chunks.append(np.array(terms, dtype=np.int64))
+        doc_chunks.append(np.array(docs, dtype=np.int32))
+        tf_chunks.append(np.array(tfs, dtype=np.float32))
+
+    # the terms are stored sorted, so that they can be looked up with a binary search
+    words = sorted(vocabulary)
+    new_ids = np.zeros(len(vocabulary), dtype=np.int64)
+    new_ids[[vocabulary[word] for word in words]] = np.arange(len(words))
+    terms = new_ids[np.concatenate(term_chunks)] if len(term_chunks) > 0 else np.zeros(0, dtype=np.int64)
+    docs = np.concatenate(doc_chunks) if len(doc_chunks) > 0 else np.zeros(0, dtype=np.int32)
+    tfs = np.concatenate(tf_chunks) if len(tf_chunks) > 0 else np.zeros(0, dtype=np.float32)
+    # the docs were added in order, so a stable sort by term keeps each posting list sorted by doc
+    order = np.argsort(terms, kind='stable')
+    offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(words)))
+
+    os.makedirs(path, exist_ok=True)
+    encoded = [word.encode('utf-8') for word in words]
+    with open(os.path.join(path, 'terms.data'), 'wb') as f:
+        f.write(b''.join(encoded))
+    term_offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(word) for word in encoded])
+    term_offsets.tofile(os.path.join(path, 'terms.offsets'))
+    offsets.tofile(os.path.join(path, 'postings.offsets'))
+    docs[order].tofile(os.path.join(path, 'postings.docs'))
+    tfs[order].tofile(os.path.join(path, 'postings.tfs'))
+    doc_lengths.tofile(os.path.join(path, 'doc_lengths'))
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'n_docs': len(corpus),
+        'n_terms': len(words),
+        'n_postings': len(docs),
+        'avg_doc_length': float(doc_lengths.mean()) if len(corpus) > 0 else 0.0,
+        'field_weights': field_weights,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return len(words)
+
+
+class _Terms:
+    # the sorted terms of an index as a sequence, for bisect
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+
+class BM25Index:
+    """An index written by `build_bm25_index`. The postings are memory-mapped,
+    so many processes can share one copy of the index.
+
+    Arguments:
+        path {str} -- the index directory
+        mmap {bool} -- whether to memory-map the arrays or read them into memory
+        k1 {float} -- BM25's term frequency saturation
+        b {float} -- BM25's document length normalization
+    """
+    def __init__(self, path, mmap=True, k1=1.2, b=0.75):
+        self.path = path
+        self.mmap = mmap
+        self.k1 = k1
+        self.b = b
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"unsupported index format version {self.meta['format_version']}")
+        self.n_docs = self.meta['n_docs']
+        self.terms = _Terms(self._load('terms.data', np.uint8), self._load('terms.offsets', np.int64))
+        self.offsets = self._load('postings.offsets', np.int64)
+        self.docs = self._load('postings.docs', np.int32)
+        self.tfs = self._load('postings.tfs', np.float32)
+        self.doc_lengths = self._load('doc_lengths', np.float32)
+
+    def _load(self, name, dtype):
+        filename = os.path.join(self.path, name)
+        if os.path.getsize(filename) == 0:
+            return np.zeros(0, dtype=dtype)
+        if self.mmap:
+            return np.memmap(filename, dtype=dtype, mode='r')
+        return np.fromfile(filename, dtype=dtype)
+
+    # only the path and parameters are pickled, so an index is cheap to send to worker processes
+    def __getstate__(self):
+        return {'path': self.path, 'mmap': self.mmap, 'k1': self.k1, 'b': self.b}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return self.n_docs
+
+    def term_id(self, term):
+        """The id of an indexed word, or -1 if it isn't in the index
+        """
+        i = bisect.bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return -1
+
+    def idf(self, term_id):
+        df = self.offsets[term_id + 1] - self.offsets[term_id]
+        return np.log1p((self.n_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query, k=100):
+        """The k papers with the highest BM25 score for a query. Papers that
+        have none of the query's words are never returned.
+
+        Arguments:
+            query {str} -- plain text search query
+            k {int} -- how many papers to return, at least 1
+
+        Returns:
+            rows {np.array} -- the rows of the papers in the corpus, best first
+            scores {np.array} -- their BM25 scores
+        """
+        if k < 1:
+            raise ValueError(f'k should be at least 1, not {k}')
+        avg_doc_length = max(self.meta['avg_doc_length'], 1e-9)
+        docs, weights = [], []
+        # sorted, so that the scores are added up in the same order in every process
+        for term in sorted(set(tokenize(fix_text(str(query))))):
+            term_id = self.term_id(term)
+            if term_id < 0:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            term_docs, tfs = self.docs[start:end], self.tfs[start:end]
+            norms = self.k1 * (1 - self.b + self.b * self.doc_lengths[term_docs] / avg_doc_length)
+            docs.append(term_docs)
+            weights.append(np.float32(self.idf(term_id)) * tfs * (self.k1 + 1) / (tfs + norms))
+        if len(docs) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # only the papers in the query's posting lists are scored, so this doesn't depend on the size of the corpus
+        rows, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        rows = rows.astype(np.int64)
+        if len(rows) > k:
+            # the k best, ties with the k-th best going to the earlier rows (rows are sorted)
+            kth_score = -np.partition(-scores, k - 1)[k - 1]
+            better = np.flatnonzero(scores > kth_score)
+            tied = np.flatnonzero(scores == kth_score)[:k - len(better)]
+            keep = np.concatenate([better, tied])
+            rows, scores = rows[keep], scores[keep]
+        # best first, ties going to the earlier row
+        order = np.lexsort((rows, -scores))
+        return rows[order], scores[order]
+
+
+class Searcher:
+    """Retrieves candidates from a `BM25Index` and reranks them with a ranker in one call
+
+    Arguments:
+        ranker {S2Ranker} -- the ranker
+        corpus {Corpus} -- the papers that the index was built from
+        index {BM25Index} -- the index
+    """
+    def __init__(self, ranker, corpus, index):
+        if len(corpus) != len(index):
+            raise ValueError(f'the index has {len(index)} papers, but the corpus has {len(corpus)}')
+        self.ranker = ranker
+        self.corpus = corpus
+        self.index = index
+
+    def search(self, query, k=100):
+        """Retrieve the k best papers by BM25 and rerank them with `S2Ranker.score_corpus`
+
+        Arguments:
+            query {str} -- plain text search query
+            k {int} -- how many papers to retrieve and rerank, at least 1
+
+        Returns:
+            paper_ids {list of str} -- the ids of the papers, best first
+            scores {np.array} -- their scores from the ranker
+            rows {np.array} -- their rows in the corpus
+        """
+        if k < 1:
+            raise ValueError(f'k should be at least 1, not {k}')
+        rows, _ = self.index.search(query, k)
+        if len(rows) == 0:
+            return [], np.zeros(0), rows
+        scores = self.ranker.score_corpus(query, self.corpus, rows)
+        order = np.argsort(-scores, kind='stable')
+        rows, scores = rows[order], scores[order]
+        return [self.corpus.paper_id(row) for row in rows], scores, rows
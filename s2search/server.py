@@ -0,0 +1,208 @@
+"""HTTP scoring server. The ranker is loaded once in the gunicorn master and
+the workers are forked from it, so they share the models' memory, e.g.
+
+    S2SEARCH_DATA_DIR=s2search/ gunicorn --preload --workers 4 --worker-class gthread --threads 32 \\
+        --bind 0.0.0.0:8000 's2search.server:create_app()'
+
+or, for a single process, `python -m s2search.server --data-dir s2search/`.
+
+POST /score takes {"query": "...", "papers": [...]} and returns {"scores": [...]}.
+Requests that arrive within max_wait of each other in a worker are scored
+together with one `S2Ranker.score_many` call, so the workers need threads
+(the gthread worker class) for requests to be batched. Neither /healthz nor
+/readyz answers until the models are loaded and warmed up, and /readyz also
+fails if the worker's batching thread has died. /metrics exports the ranker's
+metrics (see s2search.metrics), if it has any, as Prometheus text or ?format=json.
+"""
+import os
+import time
+import queue
+import argparse
+import threading
+import concurrent.futures
+from s2search.rank import S2Ranker
+
+
+class MicroBatcher:
+    """Merges the scoring calls of concurrent requests into batches. A thread
+    waits up to max_wait seconds after the first call for more of them, then
+    scores them all with one `score_many` call. The thread is started on first
+    use in each process, so a batcher made before forking works in every worker.
+
+    Arguments:
+        ranker {S2Ranker} -- the ranker
+        max_wait {float} -- how long the first call of a batch waits for others, in seconds
+        max_batch_size {int} -- the most calls per batch
+        max_batch_papers {int} -- a batch is closed once it has this many papers
+    """
+    def __init__(self, ranker, max_wait=0.005, max_batch_size=64, max_batch_papers=20000):
+        self.ranker = ranker
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_batch_papers = max_batch_papers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # threads don't survive a fork, so every process needs its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._thread = threading.Thread(target=self._run, args=(self._queue,), daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    @property
+    def alive(self):
+        """Whether calls can be scored, i.e. this process's batching thread is
+        running or hasn't been needed yet
+        """
+        return self._pid != os.getpid() or self._thread.is_alive()
+
+    def submit(self, query, papers):
+        """Queue (query, papers) for the next batch
+
+        Returns:
+            future {Future} -- resolves to the scores of papers
+        """
+        self._ensure_started()
+        future = concurrent.futures.Future()
+        self._queue.put((str(query), list(papers), future))
+        return future
+
+    def score(self, query, papers, timeout=None):
+        """Score papers for query as part of a batch, like `S2Ranker.score`
+        """
+        future = self.submit(query, papers)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # it's dropped from its batch if it hasn't started yet
+            future.cancel()
+            raise
+
+    def _next_batch(self, calls):
+        batch = [calls.get()]
+        n_papers = len(batch[0][1])
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size and n_papers < self.max_batch_papers:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(calls.get(timeout=remaining))
+            except queue.Empty:
+                break
+            n_papers += len(batch[-1][1])
+        return batch
+
+    def _run(self, calls):
+        while True:
+            batch = [call for call in self._next_batch(calls) if call[2].set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            try:
+                scores = self.ranker.score_many([call[0] for call in batch], [call[1] for call in batch])
+            except Exception:
+                # score the calls one at a time so a bad one doesn't fail the others
+                for query, papers, future in batch:
+                    try:
+                        future.set_result(self.ranker.score(query, papers))
+                    except Exception as e:
+                        future.set_exception(e)
+            else:
+                for (_, _, future), call_scores in zip(batch, scores):
+                    future.set_result(call_scores)
+
+
+def create_app(data_dir=None, ranker=None, max_wait=None, max_batch_size=None, max_batch_papers=None,
+               request_timeout=30.0, **ranker_options):
+    """Make the Flask app. The ranker is loaded here, so with gunicorn --preload
+    it is loaded once, before the workers are forked.
+
+    Arguments:
+        data_dir {str} -- where the models live. $S2SEARCH_DATA_DIR if None
+        ranker {S2Ranker} -- optionally, an already loaded ranker to serve
+        max_wait {float} -- how long requests wait to be batched with others, in seconds.
+                            $S2SEARCH_MAX_WAIT (default 0.005) if None
+        max_batch_size {int} -- the most requests per batch. $S2SEARCH_MAX_BATCH_SIZE (default 64) if None
+        max_batch_papers {int} -- a batch is closed once it has this many papers.
+                                  $S2SEARCH_MAX_BATCH_PAPERS (default 20000) if None
+        request_timeout {float} -- seconds before a request gives up on its scores
+        ranker_options -- passed on to S2Ranker, e.g. lm_load_method='lazy'
+
+    Returns:
+        app {flask.Flask} -- the app
+    """
+    from flask import Flask, jsonify, request
+
+    if ranker is None:
+        data_dir = data_dir or os.environ['S2SEARCH_DATA_DIR']
+        ranker_options.setdefault('lm_load_method', os.environ.get('S2SEARCH_LM_LOAD_METHOD', 'lazy'))
+        ranker = S2Ranker(data_dir, **ranker_options)
+    if max_wait is None:
+        max_wait = float(os.environ.get('S2SEARCH_MAX_WAIT', 0.005))
+    if max_batch_size is None:
+        max_batch_size = int(os.environ.get('S2SEARCH_MAX_BATCH_SIZE', 64))
+    if max_batch_papers is None:
+        max_batch_papers = int(os.environ.get('S2SEARCH_MAX_BATCH_PAPERS', 20000))
+    batcher = MicroBatcher(ranker, max_wait, max_batch_size, max_batch_papers)
+    # scoring a paper once touches every model, so the first request isn't the slow one
+    ranker.score('warm up', [{'title': 'warm up', 'authors': ['warm up'], 'venue': 'warm up', 'year': 2000}])
+
+    app = Flask(__name__)
+
+    @app.route('/healthz')
+    def healthz():
+        return jsonify(status='ok')
+
+    @app.route('/readyz')
+    def readyz():
+        # the app only exists once the models are loaded and warmed up
+        if not batcher.alive:
+            return jsonify(status='batching thread died'), 503
+        return jsonify(status='ready')
+
+    @app.route('/metrics')
+    def metrics():
+        # only if the ranker was made with metrics=Metrics(). the totals are per worker process
+        if ranker.metrics is None:
+            return jsonify(error='the ranker has no metrics'), 404
+        if request.args.get('format') == 'json':
+            return app.response_class(ranker.metrics.to_json(), mimetype='application/json')
+        return app.response_class(ranker.metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/score', methods=['POST'])
+    def score():
+        body = request.get_json(force=True, silent=True)
+        if (not isinstance(body, dict) or 'query' not in body or not isinstance(body.get('papers'), list)
+                or not all(isinstance(paper, dict) for paper in body['papers'])):
+            return jsonify(error='expected a JSON object with a "query" and a list of "papers"'), 400
+        try:
+            scores = batcher.score(body['query'], body['papers'], timeout=request_timeout)
+        except concurrent.futures.TimeoutError:
+            return jsonify(error='timed out'), 503
+        return jsonify(scores=[float(s) for s in scores])
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-wait', type=float)
+    parser.add_argument('--max-batch-size', type=int)
+    parser.add_argument('--max-batch-papers', type=int)
+    args = parser.parse_args()
+    app = create_app(args.data_dir, max_wait=args.max_wait, max_batch_size=args.max_batch_size,
+                     max_batch_papers=args.max_batch_papers)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
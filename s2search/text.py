@@ -60,18 +60,49 @@ def standardize_whitespace_length(text: str) -> str:
     return re.sub(r" +", " ", text).strip()
 
 
+# \s matches these ascii characters. text that has been through unidecode has no other characters
+ASCII_WHITESPACE = ''.join(chr(i) for i in range(128) if re.match(r'\s', chr(i)))
+# the single character replacements of fix_text and fix_author_text, all in one str.translate pass
+FIX_TEXT_TABLE = str.maketrans({c: ' ' for c in ASCII_WHITESPACE + '-'})
+FIX_AUTHOR_TEXT_TABLE = str.maketrans({c: ' ' for c in ASCII_WHITESPACE + '.'})
+REPEATED_QUOTES_REGEX = re.compile('""+')
+REPEATED_SPACES_REGEX = re.compile('  +')
+SINGLE_NON_ALPHANUMERICS_REGEX = re.compile(r"\B[^\w\"\s]\B")
+
+
+class UnidecodeTable(dict):
+    """unidecode of each character, by code point, for str.translate. unidecode
+    transliterates every character on its own, so translating a string with this
+    is the same as unidecode of the whole string, but each character is only
+    looked up once.
+    """
+    def __missing__(self, codepoint):
+        self[codepoint] = unidecode(chr(codepoint))
+        return self[codepoint]
+
+
+UNIDECODE_TABLE = UnidecodeTable()
+
+
+def to_ascii(s):
+    """unidecode(s), without any work for strings that are already ascii
+    """
+    if s.isascii():
+        return s
+    return s.translate(UNIDECODE_TABLE)
+
+
 def fix_text(s):
     """General purpose text fixing using nlpre package
     and then tokenizing with blingfire
     """
-    if pd.isnull(s):
+    if type(s) is not str and pd.isnull(s):
         return ''
-    s = unidecode(s)
-    # fix cases when quotes are repeated
-    s = re.sub('"+', '"', s)
-    # dashes make quote matching difficult
-    s = re.sub('-', ' ', s)
-    s = replace_special_whitespace_chars(s)
+    # quotes that are repeated become one, and dashes (which make quote matching
+    # difficult) and all kinds of whitespace become spaces
+    s = to_ascii(s).translate(FIX_TEXT_TABLE)
+    if '""' in s:
+        s = REPEATED_QUOTES_REGEX.sub('"', s)
     # tokenize
     s = text_to_words(s).lower().strip()
     # note: removing single non-alphanumerics
@@ -79,7 +110,10 @@ def fix_text(s):
     # usually separate by e.g. commas in the text
     # this will improve # of matches but also
     # surface false positives
-    return remove_single_non_alphanumerics(s)
+    s = SINGLE_NON_ALPHANUMERICS_REGEX.sub('', s)
+    if '  ' in s:
+        s = REPEATED_SPACES_REGEX.sub(' ', s)
+    return s.strip()
 
 
 def fix_author_text(s):
@@ -87,27 +121,136 @@ def fix_author_text(s):
     No de-dashing, no tokenization, and 
     replace periods by white space.
     """
-    if pd.isnull(s):
+    if type(s) is not str and pd.isnull(s):
         return ''
-    s = unidecode(s) 
-    # fix cases when quotes are repeated
-    s = re.sub('"+', '"', s)
-    # no periods as those make author first letter matching hard
-    s = re.sub(r'\.', ' ', s)
-    s = replace_special_whitespace_chars(s)
-    s = standardize_whitespace_length(s)
-    return text_to_words(s).lower().strip()
+    # quotes that are repeated become one, and periods (which make author
+    # first letter matching hard) and all kinds of whitespace become spaces
+    s = to_ascii(s).translate(FIX_AUTHOR_TEXT_TABLE)
+    if '""' in s:
+        s = REPEATED_QUOTES_REGEX.sub('"', s)
+    if '  ' in s:
+        s = REPEATED_SPACES_REGEX.sub(' ', s)
+    return text_to_words(s.strip()).lower().strip()
 
 
-def find_query_ngrams_in_text(q, t, quotes=False, len_filter=1, remove_stopwords=True, use_word_boundaries=True, max_ngram_len=7):
-    """A function to find instances of ngrams of query q
-    inside text t. Finds all possible ngrams and returns their
-    character-level span.
+class QueryNgramMatcher:
+    """Finds instances of ngrams of query q inside of texts.
+    Everything that only depends on the query (the ngrams and
+    the regular expressions built from them) is done once here,
+    so that `find` can be called on many texts cheaply.
     
-    Note: because of the greedy match this function can miss
+    Note: because of the greedy match this can miss
     some matches when there's repetition in the query, but
     this is likely rare enough that we can ignore it
     
+    Arguments:
+        q {list of str} -- query snippets
+        quotes {bool} -- whether to find exact quotes or not
+        len_filter {int} -- shortest allowable matches in characters
+        remove_stopwords {bool} -- whether to remove stopwords from matches
+        use_word_boundaries {bool} -- whether to care about word boundaries
+                                      when finding matches
+        max_ngram_len {int} -- longest allowable derived word n-grams
+    """
+    def __init__(self, q, quotes=False, len_filter=1, remove_stopwords=True, use_word_boundaries=True, max_ngram_len=7):
+        self.quotes = quotes
+        self.len_filter = len_filter
+        self.remove_stopwords = remove_stopwords
+        # one regex per query snippet, matching its ngrams in priority order
+        self.regexes = []
+        # matches the longest ngram that a text starts with
+        self.starting_regex = None
+        # every match that survives the filters contains at least one of these words
+        self.required_words = set()
+
+        if len(q) == 0 or type(q[0]) is not str:
+            return
+
+        q = [standardize_whitespace_length(i.translate(REGEX_TRANSLATION_TABLE)) 
+             for i in q]
+        q = [i for i in q if len(i) > 0]
+
+        starting_ngrams = []
+        for q_sub in q:
+            # if not between quotes, we get all ngrams
+            # otherwise we only care about exact matches
+            if quotes is False:
+                q_split = q_sub.split() 
+                n_grams = [] 
+                longest_ngram = np.minimum(max_ngram_len, len(q_split))
+                for i in range(int(longest_ngram), 0, -1): 
+                    n_grams += [' '.join(ngram).replace('|', r'\|') for ngram in ngrams(q_split, i)]
+                # a stopword can only be in a match that isn't removed if it's next to another word.
+                # if that word isn't a stopword it's required already, so we only need stopword pairs
+                for i, word in enumerate(q_split):
+                    neighbors = q_split[max(i - 1, 0):i] + q_split[i + 1:i + 2]
+                    if not remove_stopwords or word not in STOPWORDS or any(n in STOPWORDS for n in neighbors):
+                        self.required_words.add(word)
+            else:
+                n_grams = [q_sub]
+                self.required_words.add(max(q_sub.split(), key=len))
+            starting_ngrams.extend(n_grams)
+            if use_word_boundaries:
+                self.regexes.append(re.compile('|'.join(['\\b' + i + '\\b' for i in n_grams])))
+            else:
+                self.regexes.append(re.compile('|'.join(n_grams)))
+
+        # longest first, and the earliest ngram wins ties
+        if len(starting_ngrams) > 0:
+            starting_ngrams = sorted(starting_ngrams, key=len, reverse=True)
+            self.starting_regex = re.compile('|'.join(starting_ngrams))
+
+    def find(self, t):
+        """Find the query ngrams in text t and return their character-level span.
+
+        Arguments:
+            t {str} -- text to find the query within
+
+        Returns:
+            match_spans -- a list of span tuples
+            match_text_tokenized -- a list of matched tokens
+            longest_starting_ngram -- the longest matching ngram that
+                                      matches at the start of the text 
+        """
+        longest_starting_ngram = ''
+        
+        if self.starting_regex is None or type(t) is not str or len(t) == 0:
+            return [], [], longest_starting_ngram
+
+        t = standardize_whitespace_length(t.translate(REGEX_TRANSLATION_TABLE))
+
+        starting_match = self.starting_regex.match(t)
+        if starting_match is not None:
+            longest_starting_ngram = starting_match.group()
+
+        match_spans = []
+        match_text_tokenized = []
+        for regex in self.regexes:
+            matches = list(regex.finditer(t))
+            if self.quotes is False:
+                match_spans.extend([i.span() for i in matches
+                                   if i.span()[1] - i.span()[0] > self.len_filter])
+                match_text_tokenized.extend([i.group()
+                                             for i in matches
+                                             if i.span()[1] - i.span()[0] > self.len_filter])
+            else:
+                match_spans.extend([i.span() for i in matches])
+                match_text_tokenized.extend([i.group() for i in matches]) 
+
+        # now we remove any of the results if the entire matched ngram is just a stopword
+        if self.quotes is False and self.remove_stopwords:
+            match_spans = [span for i, span in enumerate(match_spans) if match_text_tokenized[i] not in STOPWORDS]
+            match_text_tokenized = [text for text in match_text_tokenized if text not in STOPWORDS]  
+        
+        return match_spans, match_text_tokenized, longest_starting_ngram
+
+
+def find_query_ngrams_in_text(q, t, quotes=False, len_filter=1, remove_stopwords=True, use_word_boundaries=True, max_ngram_len=7):
+    """A function to find instances of ngrams of query q
+    inside text t. Finds all possible ngrams and returns their
+    character-level span. To match the same query against many
+    texts, build a `QueryNgramMatcher` once instead.
+    
     Arguments:
         q {str} -- query
         t {str} -- text to find the query within
@@ -124,59 +267,10 @@ def find_query_ngrams_in_text(q, t, quotes=False, len_filter=1, remove_stopwords
         longest_starting_ngram -- the longest matching ngram that
                                   matches at the start of the text 
     """
-    longest_starting_ngram = ''
-    
     if len(q) == 0 or len(t) == 0:
-        return [], [], longest_starting_ngram
+        return [], [], ''
     if type(q[0]) is not str or type(t) is not str:
-        return [], [], longest_starting_ngram
+        return [], [], ''
 
-    q = [standardize_whitespace_length(i.translate(REGEX_TRANSLATION_TABLE)) 
-         for i in q]
-    q = [i for i in q if len(i) > 0]
-    t = standardize_whitespace_length(t.translate(REGEX_TRANSLATION_TABLE))
-
-    # if not between quotes, we get all ngrams
-    if quotes is False:
-        match_spans = []
-        match_text_tokenized = []
-        for q_sub in q:
-            q_split = q_sub.split() 
-            n_grams = [] 
-            longest_ngram = np.minimum(max_ngram_len, len(q_split))
-            for i in range(int(longest_ngram), 0, -1): 
-                n_grams += [' '.join(ngram).replace('|', '\|')for ngram in ngrams(q_split, i)]
-            for i in n_grams:
-                if t.startswith(i) and len(i) > len(longest_starting_ngram):
-                    longest_starting_ngram = i 
-            if use_word_boundaries:
-                matches = list(re.finditer('|'.join(['\\b' + i + '\\b' for i in n_grams]), t))
-            else:
-                matches = list(re.finditer('|'.join(n_grams), t))
-            match_spans.extend([i.span() for i in matches
-                               if i.span()[1] - i.span()[0] > len_filter])
-            match_text_tokenized.extend([i.group()
-                                         for i in matches
-                                         if i.span()[1] - i.span()[0] > len_filter])
-            
-        # now we remove any of the results if the entire matched ngram is just a stopword
-        if remove_stopwords:
-            match_spans = [span for i, span in enumerate(match_spans) if match_text_tokenized[i] not in STOPWORDS]
-            match_text_tokenized = [text for text in match_text_tokenized if text not in STOPWORDS]  
-        
-    # now matches for the between-quotes texts
-    # we only care about exact matches
-    else:
-        match_spans = []
-        match_text_tokenized = []
-        for q_sub in q:
-            if use_word_boundaries:
-                matches = list(re.finditer('\\b' + q_sub + '\\b', t))
-            else:
-                matches = list(re.finditer(q_sub, t))
-            if t.startswith(q_sub) and len(q_sub) > len(longest_starting_ngram):
-                longest_starting_ngram = q_sub 
-            match_spans.extend([i.span() for i in matches])
-            match_text_tokenized.extend([i.group() for i in matches]) 
-    
-    return match_spans, match_text_tokenized, longest_starting_ngram
+    matcher = QueryNgramMatcher(q, quotes, len_filter, remove_stopwords, use_word_boundaries, max_ngram_len)
+    return matcher.find(t)
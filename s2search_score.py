@@ -1,13 +1,16 @@
 from s2search.rank import S2Ranker
+from s2search.batch import score_files
 import os
-import json
-import numpy as np
+import shutil
 from pathlib import Path
 
 # data_dir = './s2search_data'
 s2_dir = './s2search_data'
 root_dir = '/Users/ayuee/Documents/GitHub/XAI_PROJECT/data_process/masking'
 features = ['title', 'abstract', 'venue', 'authors', 'year', 'n_citations', 'full']
+query = 'machine learning'
+# how many files to score at the same time. they all share one copy of the models
+n_workers = 4
 papers_example = [
     {
         'title': 'Jumping NLP Curves: A Review of Natural Language Processing Research',
@@ -35,40 +38,29 @@ def S2_Rank(related_keywords, paper_dict_list, file=s2_dir):
     return score
 
 
-def S2_open_json(path):
-    data = []
-    with open(path) as f:
-        Lines = f.readlines()
-        for line in Lines:
-            line_strip = line.strip()
-            jso = json.loads(line_strip, strict=False)
-            data.append(jso)
-    return S2_Rank('machine learning', data, s2_dir)
-
-
-def S2_save_score_as_np(s2score, feature):
-    base_dir = str(Path(__file__).resolve().parent)
-    data_dir = os.path.join(base_dir)
-    os.environ.setdefault("DATA_DIR", data_dir)
-    output_data_file_name = os.path.join(os.environ.get("DATA_DIR"), "score" + feature)
-    np.save(output_data_file_name, s2score)
-
-
 def S2_get_score(root_dir):
-    score = []
+    # see s2search/batch.py. the models are loaded once for all of the files, which are streamed
+    # in chunks, and rerunning this after a crash picks up from the last checkpoint. the outputs
+    # and checkpoints go in DATA_DIR/scores, and the scores are then copied to DATA_DIR/score<feature>.npy
+    paths = []
     for root, dirs, files in os.walk(root_dir):
         for name in files:
-            if name.endswith((".json")):
-                for feature in features:
-                    if feature in name:
-                        full_path = os.path.join(root, name)
-                        print(full_path)
-                        score = S2_open_json(full_path)
-                        score = np.array(score)
-                        S2_save_score_as_np(score, feature)
+            if name.endswith((".json")) and any(feature in name for feature in features):
+                paths.append(os.path.join(root, name))
+    base_dir = str(Path(__file__).resolve().parent)
+    os.environ.setdefault("DATA_DIR", base_dir)
+    output_dir = os.path.join(os.environ.get("DATA_DIR"), "scores")
+    outputs = score_files(S2Ranker(s2_dir), paths, output_dir, query=query, query_field=None, n_workers=n_workers)
+    for path, output in zip(paths, outputs):
+        for feature in features:
+            if feature in os.path.basename(path):
+                feature_output = os.path.join(os.environ.get("DATA_DIR"), "score" + feature + ".npy")
+                shutil.copyfile(output, feature_output)
+                print(path, '->', feature_output)
 
 
-S2_get_score(root_dir)
-# print(S2_Rank('NLP', papers_example, s2_dir))
-# score = np.load('/Users/ayuee/Documents/GitHub/XAI_PROJECT/data_process/masking/full_Score.npy')
-# print(score, np.shape(score))
+if __name__ == '__main__':
+    S2_get_score(root_dir)
+    # print(S2_Rank('NLP', papers_example, s2_dir))
+    # score = np.load('/Users/ayuee/Documents/GitHub/XAI_PROJECT/data_process/masking/full_Score.npy')
+    # print(score, np.shape(score))
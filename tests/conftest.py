@@ -0,0 +1,19 @@
+# so the tests run from a checkout without installing the package, and can use
+# the synthetic fixtures of the benchmarks
+import os
+import sys
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [REPO_ROOT, os.path.join(REPO_ROOT, 'benchmarks')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope='session')
+def stub_ranker(tmp_path_factory):
+    """An S2Ranker with stub language models and a tiny model (see benchmarks/synthetic.py)
+    """
+    pytest.importorskip('lightgbm')
+    from synthetic import make_stub_ranker
+    return make_stub_ranker(str(tmp_path_factory.mktemp('model')), n_papers=300, n_queries=20)
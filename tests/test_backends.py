@@ -0,0 +1,76 @@
+"""NumpyTreeBackend against lightgbm's own predictions, on tiny models trained
+on features with nans, zeros and values below ZERO_THRESHOLD.
+"""
+import sys
+import numpy as np
+import pytest
+from s2search.backends import NumpyTreeBackend, ZERO_THRESHOLD
+
+lightgbm = pytest.importorskip('lightgbm')
+
+N_FEATURES = 6
+
+MODEL_PARAMS = {
+    'missing_as_nan': {},
+    'zero_as_missing': {'zero_as_missing': True},
+    'no_missing': {'use_missing': False},
+    'stumps': {'max_depth': 1, 'num_leaves': 2},
+    # no split has enough data, so the tree is a single leaf
+    'single_leaf': {'min_data_in_leaf': 5000},
+    # random forests average their trees (average_output)
+    'average_output': {'boosting': 'rf', 'bagging_fraction': 0.5, 'bagging_freq': 1},
+}
+
+
+def make_features(rng, n):
+    X = rng.normal(size=(n, N_FEATURES))
+    X[rng.random(X.shape) < 0.2] = np.nan
+    X[rng.random(X.shape) < 0.1] = 0
+    return X
+
+
+@pytest.fixture(scope='module', params=sorted(MODEL_PARAMS))
+def model(request, tmp_path_factory):
+    rng = np.random.default_rng(0)
+    X = make_features(rng, 3000)
+    y = np.nan_to_num(X[:, 0]) + np.isnan(X[:, 1]) + (X[:, 2] == 0) + rng.normal(size=len(X)) * 0.1
+    params = dict(objective='regression', verbose=-1, seed=0, **MODEL_PARAMS[request.param])
+    booster = lightgbm.train(params, lightgbm.Dataset(X, y), 20)
+    path = str(tmp_path_factory.mktemp(request.param) / 'lightgbm_model.txt')
+    booster.save_model(path)
+    return booster, path
+
+
+@pytest.fixture(scope='module')
+def features():
+    X = make_features(np.random.default_rng(1), 5000)
+    # lightgbm treats these as zeros
+    X[np.random.default_rng(2).random(X.shape) < 0.05] = ZERO_THRESHOLD / 10
+    return X
+
+
+def test_float64_is_exact(model, features):
+    booster, path = model
+    backend = NumpyTreeBackend(path, dtype=np.float64, chunk_size=777)
+    assert np.array_equal(backend.predict(features), booster.predict(features))
+
+
+def test_float32_is_close(model, features):
+    booster, path = model
+    backend = NumpyTreeBackend(path)
+    np.testing.assert_allclose(backend.predict(features), booster.predict(features), rtol=1e-5, atol=1e-5)
+
+
+def test_wrong_number_of_features(model):
+    _, path = model
+    with pytest.raises(ValueError):
+        NumpyTreeBackend(path).predict(np.zeros((2, N_FEATURES + 1)))
+
+
+def test_contributions_without_lightgbm(model, features, monkeypatch):
+    _, path = model
+    backend = NumpyTreeBackend(path)
+    monkeypatch.setitem(sys.modules, 'lightgbm', None)
+    backend.predict(features)
+    with pytest.raises(ImportError, match="'numpy' backend"):
+        backend.predict_contrib(features)
@@ -0,0 +1,54 @@
+import json
+import os
+import numpy as np
+import pytest
+from s2search.batch import score_files
+
+
+@pytest.fixture(scope='module')
+def papers():
+    from synthetic import make_papers
+    return make_papers(50, seed=3)
+
+
+def write_jsonl(path, papers):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        for paper in papers:
+            f.write(json.dumps(paper) + '\n')
+
+
+def test_scores_match_score(stub_ranker, papers, tmp_path):
+    path = str(tmp_path / 'papers.jsonl')
+    write_jsonl(path, papers)
+    [output] = score_files(stub_ranker, [path], str(tmp_path / 'out'), query='neural networks', chunk_size=7)
+    assert np.array_equal(np.load(output), stub_ranker.score('neural networks', papers))
+
+
+def test_changed_input_is_scored_again(stub_ranker, papers, tmp_path):
+    path = str(tmp_path / 'papers.jsonl')
+    write_jsonl(path, papers[:20])
+    output_dir = str(tmp_path / 'out')
+    score_files(stub_ranker, [path], output_dir, query='neural networks')
+    write_jsonl(path, papers)
+    [output] = score_files(stub_ranker, [path], output_dir, query='neural networks')
+    assert np.array_equal(np.load(output), stub_ranker.score('neural networks', papers))
+
+
+def test_other_query_is_scored_again(stub_ranker, papers, tmp_path):
+    path = str(tmp_path / 'papers.jsonl')
+    write_jsonl(path, papers)
+    output_dir = str(tmp_path / 'out')
+    score_files(stub_ranker, [path], output_dir, query='neural networks')
+    [output] = score_files(stub_ranker, [path], output_dir, query='graph learning')
+    assert np.array_equal(np.load(output), stub_ranker.score('graph learning', papers))
+
+
+def test_same_names_in_different_directories(stub_ranker, papers, tmp_path):
+    paths = [str(tmp_path / 'in' / 'a' / 'papers.jsonl'), str(tmp_path / 'in' / 'b' / 'papers.jsonl')]
+    write_jsonl(paths[0], papers[:20])
+    write_jsonl(paths[1], papers[20:])
+    outputs = score_files(stub_ranker, paths, str(tmp_path / 'out'), query='neural networks', n_workers=2)
+    assert [os.path.basename(output) for output in outputs] == ['a__papers.npy', 'b__papers.npy']
+    assert np.array_equal(np.load(outputs[0]), stub_ranker.score('neural networks', papers[:20]))
+    assert np.array_equal(np.load(outputs[1]), stub_ranker.score('neural networks', papers[20:]))
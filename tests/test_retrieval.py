@@ -0,0 +1,79 @@
+"""BM25Index.search against dense brute-force scoring of every paper, and its
+tie-breaking at the k boundary.
+"""
+import numpy as np
+import pytest
+from synthetic import make_papers
+from s2search.corpus import build_corpus, Corpus
+from s2search.retrieval import build_bm25_index, BM25Index, tokenize
+from s2search.text import fix_text
+
+QUERIES = ['neural networks', 'the of and', 'deep learning for graphs', 'protein structure prediction',
+           'zzz not a word', 'attention attention attention']
+
+
+def brute_force_scores(index, query):
+    # the BM25 score of every paper, in float64
+    scores = np.zeros(index.n_docs)
+    for term in set(tokenize(fix_text(query))):
+        term_id = index.term_id(term)
+        if term_id < 0:
+            continue
+        for j in range(index.offsets[term_id], index.offsets[term_id + 1]):
+            doc, tf = index.docs[j], float(index.tfs[j])
+            norm = index.k1 * (1 - index.b + index.b * index.doc_lengths[doc] / index.meta['avg_doc_length'])
+            scores[doc] += index.idf(term_id) * tf * (index.k1 + 1) / (tf + norm)
+    return scores
+
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    path = tmp_path_factory.mktemp('retrieval')
+    papers = make_papers(500, seed=3)
+    build_corpus(papers, str(path / 'corpus'))
+    build_bm25_index(Corpus(str(path / 'corpus')), str(path / 'index'))
+    return BM25Index(str(path / 'index'))
+
+
+@pytest.fixture(scope='module')
+def queries(index):
+    # words the papers actually have, as well as the fixed queries
+    words = [index.terms[i] for i in np.random.default_rng(0).choice(len(index.terms), 60, replace=False)]
+    return QUERIES + [' '.join(words[i:i + 3]) for i in range(0, len(words), 3)]
+
+
+@pytest.mark.parametrize('k', [1, 5, 50, 1000])
+def test_matches_brute_force(index, queries, k):
+    for query in queries:
+        expected = brute_force_scores(index, query)
+        rows, scores = index.search(query, k=k)
+        n_matched = np.count_nonzero(expected > 0)
+        assert len(rows) == min(k, n_matched)
+        assert len(np.unique(rows)) == len(rows)
+        np.testing.assert_allclose(scores, expected[rows], rtol=1e-5)
+        np.testing.assert_allclose(scores, np.sort(expected)[::-1][:len(rows)], rtol=1e-5)
+        # best first, ties going to the earlier row
+        assert all(a > b or (a == b and i < j) for a, b, i, j in zip(scores, scores[1:], rows, rows[1:]))
+
+
+def test_ties_at_k_go_to_earlier_rows(tmp_path):
+    # enough tied papers that a partial sort would pick arbitrary ones
+    papers = [{'id': str(i), 'title': 'graph networks' if i % 3 else 'unrelated words', 'abstract': ''}
+              for i in range(3000)]
+    build_corpus(papers, str(tmp_path / 'corpus'))
+    build_bm25_index(Corpus(str(tmp_path / 'corpus')), str(tmp_path / 'index'))
+    index = BM25Index(str(tmp_path / 'index'))
+    for k in [1, 7, 100, 1500, 1999, 2000, 5000]:
+        rows, scores = index.search('graph', k=k)
+        assert rows.tolist() == [i for i in range(3000) if i % 3][:k]
+        assert len(set(scores.tolist())) == 1
+
+
+def test_no_matches(index):
+    rows, scores = index.search('zzz not a word', k=10)
+    assert len(rows) == 0 and len(scores) == 0
+
+
+def test_k_must_be_positive(index):
+    with pytest.raises(ValueError):
+        index.search('neural networks', k=0)
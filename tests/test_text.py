@@ -0,0 +1,104 @@
+"""Differential test of fix_text and fix_author_text against the multi-pass
+implementations they replaced, on every unicode code point, random strings
+and the values that papers can have in place of text.
+"""
+import random
+import re
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from blingfire import text_to_words
+from unidecode import unidecode
+from s2search.text import fix_text, fix_author_text
+from s2search.text import remove_single_non_alphanumerics, replace_special_whitespace_chars, standardize_whitespace_length
+
+
+def reference_fix_text(s):
+    if pd.isnull(s):
+        return ''
+    s = unidecode(s)
+    s = re.sub('"+', '"', s)
+    s = re.sub('-', ' ', s)
+    s = replace_special_whitespace_chars(s)
+    s = text_to_words(s).lower().strip()
+    return remove_single_non_alphanumerics(s)
+
+
+def reference_fix_author_text(s):
+    if pd.isnull(s):
+        return ''
+    s = unidecode(s)
+    s = re.sub('"+', '"', s)
+    s = re.sub(r'\.', ' ', s)
+    s = replace_special_whitespace_chars(s)
+    s = standardize_whitespace_length(s)
+    return text_to_words(s).lower().strip()
+
+
+PAIRS = [('fix_text', fix_text, reference_fix_text), ('fix_author_text', fix_author_text, reference_fix_author_text)]
+
+# the code points of the blocks that random strings draw from: latin, greek,
+# cyrillic, cjk, punctuation, symbols, emoji, combining marks and whitespace
+BLOCKS = [(0x20, 0x7f), (0xa0, 0x250), (0x300, 0x370), (0x370, 0x400), (0x400, 0x500), (0x2000, 0x2070),
+          (0x2100, 0x2200), (0x3000, 0x3040), (0x4e00, 0x4f00), (0xac00, 0xad00), (0x1f600, 0x1f650)]
+SPECIAL = ['"', '""', '-', '--', '.', ' ', '  ', '\t', '\n', '\x1c', '\xa0', ' ', "'", ',', '(', ')']
+
+# the code points are checked in chunks, so that they can run in parallel (e.g. with pytest -n)
+CODE_POINT_CHUNK = 0x8000
+
+
+def code_point_strings(start, end):
+    """Every code point in [start, end), on its own and between the characters
+    the normalizers treat specially (quotes, dashes, periods and whitespace)
+    """
+    for codepoint in range(start, end):
+        c = chr(codepoint)
+        yield c
+        yield f'a{c}b {c}-"{c}".{c}\t{c}  x{c}{c}'
+
+
+def random_strings(n, seed):
+    """Random strings mixing ascii punctuation, unusual whitespace and characters from many scripts
+    """
+    rng = random.Random(seed)
+    for _ in range(n):
+        parts = []
+        for _ in range(rng.randint(0, 30)):
+            roll = rng.random()
+            if roll < 0.3:
+                parts.append(rng.choice(SPECIAL))
+            elif roll < 0.6:
+                parts.append(''.join(chr(rng.randint(0x61, 0x7a)) for _ in range(rng.randint(1, 8))))
+            else:
+                start, end = rng.choice(BLOCKS)
+                parts.append(''.join(chr(rng.randrange(start, end)) for _ in range(rng.randint(1, 4))))
+        yield ''.join(parts)
+
+
+def differences(strings, limit=5):
+    found = []
+    with warnings.catch_warnings():
+        # unidecode warns about surrogates
+        warnings.simplefilter('ignore')
+        for s in strings:
+            for name, fn, reference in PAIRS:
+                if fn(s) != reference(s):
+                    found.append(f'{name}({s!r}) = {fn(s)!r}, not {reference(s)!r}')
+                    if len(found) == limit:
+                        return found
+    return found
+
+
+@pytest.mark.parametrize('start', range(0, 0x110000, CODE_POINT_CHUNK), ids=hex)
+def test_code_points(start):
+    assert differences(code_point_strings(start, min(start + CODE_POINT_CHUNK, 0x110000))) == []
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_random_strings(seed):
+    assert differences(random_strings(50000, seed)) == []
+
+
+def test_missing_values():
+    assert differences([None, np.nan, float('nan'), pd.NA, '']) == []